@@ -0,0 +1,81 @@
+"""
+Measures the bytes on the wire and the CPU time per response of a referral
+listing, in each representation (JSON, MessagePack) and each encoding
+(none, gzip, brotli, zstd) that is installed.
+
+CPU time covers everything done to the response after the referrals are read:
+converting them to dictionaries, encoding and compressing them.
+
+Run with: python benchmarks/compression.py
+"""
+
+import random
+import time
+import timeit
+
+from carton_caps.compression import COMPRESSIBLE_MIMETYPES, ENCODINGS, compress
+from carton_caps.database import Referral, ReferralUser
+from carton_caps.serialization import REPRESENTATIONS, referral_to_dict
+
+SIZES = [1, 10, 100, 1_000, 10_000]
+
+FIRST_NAMES = ["Fox", "Dana", "Walter", "Monica", "John", "Melvin", "Richard", "John Fitzgerald", "Alex", "Jeffrey"]
+LAST_NAMES = ["Mulder", "Scully", "Skinner", "Reyes", "Doggett", "Frohike", "Langly", "Byers", "Krycek", "Spender"]
+
+
+def make_referrals(count: int) -> list[Referral]:
+    """Referrals to a varied set of users, so that they don't compress unrealistically well."""
+    rng = random.Random(count)
+    return [
+        Referral(
+            id=1_000_000 + i,
+            user=ReferralUser(
+                id=rng.randrange(1, 10_000_000),
+                name=f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                avatar_url="https://place-hold.it/64x64",
+            ),
+            status=rng.choice(["pending", "confirmed", "held"]),
+            created_at=time.strftime(
+                "%Y-%m-%dT%H:%M:%S.000000+00:00", time.gmtime(1_700_000_000 + rng.randrange(50_000_000))
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+def encode(referrals: list[Referral], mimetype: str, encoding: str | None) -> bytes:
+    body = REPRESENTATIONS[mimetype]([referral_to_dict(referral) for referral in referrals])
+    return compress(body, encoding) if encoding is not None else body
+
+
+def cpu_per_response(referrals: list[Referral], mimetype: str, encoding: str | None) -> float:
+    """Returns the best observed CPU time per response, in microseconds."""
+    number = max(1, 20_000 // len(referrals))
+    best = min(
+        timeit.repeat(lambda: encode(referrals, mimetype, encoding), number=number, repeat=5, timer=time.process_time)
+    )
+    return best / number * 1e6
+
+
+def main() -> None:
+    # application/x-msgpack is only an alias
+    mimetypes = [mimetype for mimetype in REPRESENTATIONS if mimetype != "application/x-msgpack"]
+    assert set(mimetypes) <= COMPRESSIBLE_MIMETYPES
+    encodings: list[str | None] = [None, *ENCODINGS]
+
+    print(f"{'rows':>6} | {'format':<20} | {'encoding':<8} | {'bytes':>9} | {'ratio':>5} | {'us/response':>11}")
+    for size in SIZES:
+        referrals = make_referrals(size)
+        baseline = len(encode(referrals, "application/json", None))
+        for mimetype in mimetypes:
+            for encoding in encodings:
+                size_on_wire = len(encode(referrals, mimetype, encoding))
+                cpu = cpu_per_response(referrals, mimetype, encoding)
+                print(
+                    f"{size:>6} | {mimetype:<20} | {encoding or 'identity':<8} | {size_on_wire:>9} | "
+                    f"{baseline / size_on_wire:>5.1f} | {cpu:>11.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
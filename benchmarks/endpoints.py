@@ -0,0 +1,193 @@
+"""
+Benchmarks the API end to end against a synthetic dataset.
+
+The app is created with `create_app()` and driven in-process through its test
+client, with startup run so that the connection pool and writer are used just
+as they are in production. Each scenario reports p50/p95/p99 latency and
+throughput.
+
+Run with: python benchmarks/endpoints.py --users 100000
+
+Save the results with --save, and compare a later run against them with
+--compare to fail (exit code 1) when a scenario's p95 latency regresses.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable
+
+from carton_caps.app import create_app, get_db
+from carton_caps.generate import generate_referrals, generate_users, make_referral_code
+
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    throughput: float
+
+
+def percentile(samples: list[float], p: float) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(p) - 1]
+
+
+async def run_scenario(name: str, request: Callable[[], Awaitable[int]], requests: int, concurrency: int) -> Result:
+    """Sends `requests` requests, `concurrency` at a time, and measures their latency."""
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            started = time.perf_counter()
+            status = await request()
+            latencies.append(time.perf_counter() - started)
+            if status >= 400 and status != 404:
+                raise RuntimeError(f"{name}: unexpected status {status}")
+
+    # Warm up, so that connections are open and caches are populated
+    for _ in range(min(10, requests)):
+        await request()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return Result(
+        scenario=name,
+        requests=requests,
+        p50_ms=percentile(latencies_ms, 50),
+        p95_ms=percentile(latencies_ms, 95),
+        p99_ms=percentile(latencies_ms, 99),
+        throughput=requests / elapsed,
+    )
+
+
+def pick_users(db_path: str) -> dict[str, int]:
+    """Picks users whose referral lists represent the interesting cases."""
+    with sqlite3.connect(db_path) as conn:
+        counts = conn.execute(
+            "SELECT source_user_id, COUNT(*) FROM referrals GROUP BY source_user_id ORDER BY 2 DESC"
+        ).fetchall()
+        no_referrals = conn.execute(
+            "SELECT id FROM users WHERE id NOT IN (SELECT source_user_id FROM referrals) LIMIT 1"
+        ).fetchone()[0]
+    return {
+        "top": counts[0][0],
+        "median": counts[len(counts) // 2][0],
+        "none": no_referrals,
+        "missing": 10**9,
+    }
+
+
+async def benchmark(user_count: int, requests: int, concurrency: int, seed: int) -> list[Result]:
+    with tempfile.TemporaryDirectory() as instance_path:
+        db_path = os.path.join(instance_path, "benchmark.sqlite")
+        # A single client would soon be rate limited, and the slow query log (as would every 404 being logged
+        # as an error) would drown out the results. Skipping the warm up loads the code index before serving,
+        # rather than in the background.
+        app = create_app(
+            test_config={"DATABASE": db_path, "SLOW_QUERY_THRESHOLD": None, "RATE_LIMITS": None, "WARM_UP": False},
+            instance_path=instance_path,
+        )
+        app.logger.setLevel(logging.CRITICAL)
+
+        async with app.app_context():
+            db = get_db()
+            await db.init_db()
+            await db.bulk_create_users(generate_users(user_count))
+            await db.bulk_create_referrals(generate_referrals(user_count, seed=seed))
+
+        users = pick_users(db_path)
+
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+
+            async def get(url: str, headers: dict | None = None) -> int:
+                response = await client.get(url, headers=headers)
+                await response.get_data()
+                return response.status_code
+
+            etag = (await client.get(f"/users/{users['median']}/referrals")).headers["ETag"]
+            batch_ids = ",".join(str(user_id) for user_id in range(1, 101))
+            # A different invalid code every time, as bot traffic would send
+            invalid_codes = (f"BOGUS{i}" for i in itertools.count())
+
+            scenarios: dict[str, Callable[[], Awaitable[int]]] = {
+                "referrals, top referrer": lambda: get(f"/users/{users['top']}/referrals"),
+                "referrals, median referrer": lambda: get(f"/users/{users['median']}/referrals"),
+                "referrals, no referrals": lambda: get(f"/users/{users['none']}/referrals"),
+                "referrals, missing user": lambda: get(f"/users/{users['missing']}/referrals"),
+                "referrals, first page of 50": lambda: get(f"/users/{users['top']}/referrals?limit=50"),
+                "referrals, streamed top referrer": lambda: get(f"/users/{users['top']}/referrals?stream=true"),
+                "referrals, not modified": lambda: get(
+                    f"/users/{users['median']}/referrals", headers={"If-None-Match": etag}
+                ),
+                "batch, 100 users": lambda: get(f"/referrals?user_ids={batch_ids}"),
+                "referral code, valid": lambda: get(f"/referral-codes/{make_referral_code(users['median'])}"),
+                "referral code, invalid": lambda: get(f"/referral-codes/{next(invalid_codes)}"),
+            }
+
+            return [await run_scenario(name, request, requests, concurrency) for name, request in scenarios.items()]
+
+
+def print_results(results: list[Result]) -> None:
+    width = max(len(result.scenario) for result in results)
+    print(f"{'scenario':<{width}} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'req/s':>8}")
+    for r in results:
+        print(f"{r.scenario:<{width}} | {r.p50_ms:>8.2f} | {r.p95_ms:>8.2f} | {r.p99_ms:>8.2f} | {r.throughput:>8.0f}")
+
+
+def compare(results: list[Result], baseline_path: str, threshold: float) -> list[str]:
+    """Returns a description of each scenario whose p95 latency regressed past the threshold."""
+    with open(baseline_path) as f:
+        baseline = {entry["scenario"]: entry for entry in json.load(f)}
+    regressions = []
+    for result in results:
+        before = baseline.get(result.scenario)
+        if before is not None and result.p95_ms > before["p95_ms"] * threshold:
+            regressions.append(f"{result.scenario}: p95 {before['p95_ms']:.2f}ms -> {result.p95_ms:.2f}ms")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000, help="Users in the synthetic dataset.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic dataset.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against results saved with --save.")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Allowed p95 slowdown ratio for --compare.")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args.users, args.requests, args.concurrency, args.seed))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
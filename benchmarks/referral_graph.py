@@ -0,0 +1,157 @@
+"""
+Compares answering referral tree queries from the closure table against
+walking the referrals table with a recursive query, on deep and wide trees.
+
+Also reports what the closure table costs: the time to insert the referrals,
+with the triggers maintaining it, and how many rows it holds.
+
+Run with: python benchmarks/referral_graph.py
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import timeit
+from typing import Iterator
+
+from carton_caps.connection import apply_pragmas
+from carton_caps.database import REFERRAL_STATUSES
+from carton_caps.generate import generate_referrals
+from carton_caps.migrations import migrate
+from carton_caps.timestamps import now_microseconds
+
+DOWNLINE_CLOSURE = """
+    SELECT descendant_id, depth FROM referral_paths
+    WHERE ancestor_id = ? AND depth <= ?
+    ORDER BY depth, descendant_id
+"""
+
+DOWNLINE_RECURSIVE = """
+    WITH RECURSIVE downline (user_id, depth) AS (
+        SELECT target_user_id, 1 FROM referrals WHERE source_user_id = ?1
+        UNION ALL
+        SELECT r.target_user_id, d.depth + 1
+        FROM downline d
+        JOIN referrals r ON r.source_user_id = d.user_id
+        WHERE d.depth < ?2
+    )
+    SELECT user_id, depth FROM downline ORDER BY depth, user_id
+"""
+
+UPLINE_CLOSURE = """
+    SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = ? ORDER BY depth
+"""
+
+UPLINE_RECURSIVE = """
+    WITH RECURSIVE upline (user_id, depth) AS (
+        SELECT source_user_id, 1 FROM referrals WHERE target_user_id = ?
+        UNION ALL
+        SELECT r.source_user_id, u.depth + 1
+        FROM upline u
+        JOIN referrals r ON r.target_user_id = u.user_id
+    )
+    SELECT user_id, depth FROM upline ORDER BY depth
+"""
+
+SIZE_CLOSURE = "SELECT COUNT(*) FROM referral_paths WHERE ancestor_id = ?"
+
+SIZE_RECURSIVE = """
+    WITH RECURSIVE downline (user_id) AS (
+        SELECT target_user_id FROM referrals WHERE source_user_id = ?
+        UNION ALL
+        SELECT r.target_user_id FROM downline d JOIN referrals r ON r.source_user_id = d.user_id
+    )
+    SELECT COUNT(*) FROM downline
+"""
+
+
+def deep_tree(user_count: int, chain_length: int = 200) -> Iterator[tuple[int, int]]:
+    """
+    Chains of `chain_length` users hanging from the root, in which every user referred the next one.
+
+    The closure table holds a row per user for each of their ancestors, so a
+    single chain of n users would need n²/2 rows.
+    """
+    for target in range(2, user_count + 1):
+        yield (1 if (target - 2) % chain_length == 0 else target - 1), target
+
+
+def wide_tree(user_count: int, fanout: int = 50) -> Iterator[tuple[int, int]]:
+    """A shallow tree, in which every user referred `fanout` others."""
+    for target in range(2, user_count + 1):
+        yield 1 + (target - 2) // fanout, target
+
+
+def skewed_tree(user_count: int) -> Iterator[tuple[int, int]]:
+    """The power-law tree made by `generate_referrals`."""
+    for referral in generate_referrals(user_count, referred_fraction=1.0):
+        yield referral.source_user_id, referral.target_user_id
+
+
+TREES = {"deep": deep_tree, "wide": wide_tree, "skewed": skewed_tree}
+
+
+def build(path: str, user_count: int, edges: Iterator[tuple[int, int]]) -> float:
+    """Creates a database holding the tree, and returns how long inserting the referrals took."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    apply_pragmas(conn)
+    migrate(conn)
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO users (id, name, referral_code) VALUES (?, ?, ?)",
+            ((i, f"User {i}", f"CODE{i}") for i in range(1, user_count + 1)),
+        )
+    created_at = now_microseconds()
+    confirmed = REFERRAL_STATUSES.index("confirmed")
+    started = time.perf_counter()
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO referrals (source_user_id, target_user_id, created_at, status) VALUES (?, ?, ?, ?)",
+            ((source_id, target_id, created_at, confirmed) for source_id, target_id in edges),
+        )
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return elapsed
+
+
+def best_ms(conn: sqlite3.Connection, sql: str, parameters: tuple) -> float:
+    """Returns the best observed time to run a query to completion, in milliseconds."""
+    return min(timeit.repeat(lambda: conn.execute(sql, parameters).fetchall(), number=1, repeat=5)) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000, help="How many users each tree holds.")
+    parser.add_argument("--depth", type=int, default=3, help="The depth limit for the downline queries.")
+    args = parser.parse_args()
+
+    print(f"{'tree':<7} | {'query':<22} | {'closure ms':>10} | {'recursive ms':>12} | speedup")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, tree in TREES.items():
+            path = os.path.join(directory, f"{name}.sqlite")
+            insert_seconds = build(path, args.users, tree(args.users))
+
+            conn = sqlite3.connect(path)
+            apply_pragmas(conn)
+            paths = conn.execute("SELECT COUNT(*) FROM referral_paths").fetchone()[0]
+            # The root has the largest downline, and the last user the longest upline.
+            queries = [
+                (f"downline to depth {args.depth}", DOWNLINE_CLOSURE, DOWNLINE_RECURSIVE, (1, args.depth)),
+                ("full downline", DOWNLINE_CLOSURE, DOWNLINE_RECURSIVE, (1, args.users)),
+                ("downline size", SIZE_CLOSURE, SIZE_RECURSIVE, (1,)),
+                ("upline", UPLINE_CLOSURE, UPLINE_RECURSIVE, (args.users,)),
+            ]
+            for query, closure_sql, recursive_sql, parameters in queries:
+                closure = best_ms(conn, closure_sql, parameters)
+                recursive = best_ms(conn, recursive_sql, parameters)
+                print(f"{name:<7} | {query:<22} | {closure:>10.2f} | {recursive:>12.2f} | {recursive / closure:.1f}x")
+            print(f"{name:<7} | inserted {args.users - 1} referrals in {insert_seconds:.2f}s, {paths} paths stored")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Measures the database work behind each referral listing request: the time
+from asking for a user's referrals to having them, with nothing else in the
+way.
+
+Each scenario is read three ways: as two trips to the connection's thread
+(`get_referral_version`, then `get_referrals_by_source_id`), as one
+(`get_referral_page`), and as one with the statement cache turned off, so
+that every statement is parsed and planned again. No referral cache is used,
+so every request reads the database.
+
+Run with: python benchmarks/referral_reads.py --users 20000
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from carton_caps import connection
+from carton_caps.database import Database, ReferralFilter
+from carton_caps.generate import generate_referrals, generate_users
+
+
+def pick_median_referrer(db_path: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        counts = conn.execute(
+            "SELECT source_user_id FROM referrals GROUP BY source_user_id ORDER BY COUNT(*) DESC"
+        ).fetchall()
+    return counts[len(counts) // 2][0]
+
+
+async def per_request(read: Callable[[], Awaitable[object]], requests: int) -> float:
+    """Returns the best observed time per request over five runs, in microseconds."""
+    for _ in range(10):
+        await read()
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(requests):
+            await read()
+        best = min(best, (time.perf_counter() - started) / requests)
+    return best * 1e6
+
+
+async def benchmark(user_count: int, requests: int, seed: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "benchmark.sqlite")
+        db = Database(db_path)
+        await db.init_db()
+        await db.bulk_create_users(generate_users(user_count))
+        await db.bulk_create_referrals(generate_referrals(user_count, seed=seed))
+        await db.close()
+        median = pick_median_referrer(db_path)
+        pending = ReferralFilter(status="pending")
+
+        scenarios: dict[str, dict] = {
+            "first page of 50": {"limit": 51},
+            "full list": {},
+            "pending, first page of 50": {"limit": 51, "filter": pending},
+            "newest first, page of 50": {"limit": 51, "descending": True},
+        }
+
+        async def two_trips(db: Database, user_id: int, **kwargs) -> object:
+            if await db.get_referral_version(user_id) is None:
+                return None
+            return await db.get_referrals_by_source_id(user_id, **kwargs)
+
+        async def one_trip(db: Database, user_id: int, **kwargs) -> object:
+            return await db.get_referral_page(user_id, **kwargs)
+
+        rows = []
+        for name, kwargs in [*scenarios.items(), ("missing user", {})]:
+            user_id = 10**9 if name == "missing user" else median
+            timings = []
+            for read, cache_size in [
+                (two_trips, connection.STATEMENT_CACHE_SIZE),
+                (one_trip, connection.STATEMENT_CACHE_SIZE),
+                (one_trip, 0),
+            ]:
+                default = connection.STATEMENT_CACHE_SIZE
+                connection.STATEMENT_CACHE_SIZE = cache_size
+                db = Database(db_path)
+                try:
+                    timings.append(await per_request(lambda: read(db, user_id, **kwargs), requests))
+                finally:
+                    await db.close()
+                    connection.STATEMENT_CACHE_SIZE = default
+            rows.append((name, *timings))
+
+    width = max(len(row[0]) for row in rows)
+    print(f"{'scenario':<{width}} | {'two trips us':>12} | {'one trip us':>12} | {'no stmt cache us':>16}")
+    for name, two, one, uncached in rows:
+        print(f"{name:<{width}} | {two:>12.1f} | {one:>12.1f} | {uncached:>16.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000, help="Users in the synthetic dataset.")
+    parser.add_argument("--requests", type=int, default=2_000, help="Requests per run of each scenario.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic dataset.")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.users, args.requests, args.seed))
+
+
+if __name__ == "__main__":
+    main()
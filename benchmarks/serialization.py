@@ -0,0 +1,57 @@
+"""
+Compares the cost of serializing referral lists with `dataclasses.asdict`
+and the standard library encoder, against `referral_to_dict` and `dumps`.
+
+Run with: python benchmarks/serialization.py
+"""
+
+import json
+import timeit
+from dataclasses import asdict
+
+from carton_caps.database import Referral, ReferralUser
+from carton_caps.serialization import dumps, orjson, referral_to_dict
+
+SIZES = [10, 1_000, 100_000]
+
+
+def make_referrals(count: int) -> list[Referral]:
+    return [
+        Referral(
+            id=i,
+            user=ReferralUser(id=i + 1, name=f"Referred User {i}", avatar_url="https://place-hold.it/64x64"),
+            status="pending" if i % 3 else "confirmed",
+            created_at="2025-08-10T20:03:00.123456+00:00",
+        )
+        for i in range(count)
+    ]
+
+
+def asdict_path(referrals: list[Referral]) -> bytes:
+    return json.dumps([asdict(referral) for referral in referrals]).encode()
+
+
+def fast_path(referrals: list[Referral]) -> bytes:
+    return dumps([referral_to_dict(referral) for referral in referrals])
+
+
+def per_row_cost(fn, referrals: list[Referral]) -> float:
+    """Returns the best observed cost per row, in microseconds."""
+    number = max(1, 100_000 // len(referrals))
+    best = min(timeit.repeat(lambda: fn(referrals), number=number, repeat=5))
+    return best / number / len(referrals) * 1e6
+
+
+def main() -> None:
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'rows':>8} | {'asdict (us/row)':>15} | {'fast (us/row)':>13} | speedup")
+    for size in SIZES:
+        referrals = make_referrals(size)
+        assert json.loads(asdict_path(referrals)) == json.loads(fast_path(referrals))
+        before = per_row_cost(asdict_path, referrals)
+        after = per_row_cost(fast_path, referrals)
+        print(f"{size:>8} | {before:>15.3f} | {after:>13.3f} | {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Measures how long checking a signup's signals against the referrer's tree
+takes, on a database holding millions of signal rows.
+
+Every generated user signed up with a device id, an email address and an IP
+address. Most IP addresses come from small networks, but a fifth come from a
+handful of carrier networks shared by tens of thousands of users, which is
+the worst case for the check. Each check is made for a random referrer with
+a new device and email address, from either kind of network.
+
+Run with: python benchmarks/signals.py --users 1000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from carton_caps.connection import apply_pragmas
+from carton_caps.database import REFERRAL_STATUSES, _match_signals
+from carton_caps.generate import generate_referrals
+from carton_caps.migrations import migrate
+from carton_caps.signals import SignupSignals
+from carton_caps.timestamps import now_microseconds
+
+CARRIER_NETWORKS = 10
+CHECKS = 2000
+
+
+def ip_address(rng: random.Random, user_count: int) -> str:
+    """An address on one of a few busy carrier networks, or on one of many small ones."""
+    if rng.random() < 0.2:
+        return f"100.64.{rng.randrange(CARRIER_NETWORKS)}.{rng.randrange(256)}"
+    network = rng.randrange(max(1, user_count // 20))
+    return f"10.{network >> 8 & 255}.{network & 255}.{rng.randrange(256)}"
+
+
+def build(path: str, user_count: int) -> float:
+    """Creates a database of users, their referrals and their signals, and returns how long it took."""
+    started = time.perf_counter()
+    rng = random.Random(0)
+    conn = sqlite3.connect(path, isolation_level=None)
+    apply_pragmas(conn)
+    migrate(conn)
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO users (id, name, referral_code) VALUES (?, ?, ?)",
+            ((i, f"User {i}", f"CODE{i}") for i in range(1, user_count + 1)),
+        )
+        created_at = now_microseconds()
+        pending = REFERRAL_STATUSES.index("pending")
+        conn.executemany(
+            "INSERT INTO referrals (source_user_id, target_user_id, created_at, status) VALUES (?, ?, ?, ?)",
+            ((r.source_user_id, r.target_user_id, created_at, pending) for r in generate_referrals(user_count)),
+        )
+        conn.executemany(
+            "INSERT INTO signup_signals (kind, value, user_id) VALUES (?, ?, ?)",
+            (
+                (kind, value, user_id)
+                for user_id in range(1, user_count + 1)
+                for kind, value in SignupSignals(
+                    device_id=f"device-{user_id}",
+                    ip_address=ip_address(rng, user_count),
+                    email=f"user{user_id}@example.com",
+                ).hashed()
+            ),
+        )
+    conn.close()
+    return time.perf_counter() - started
+
+
+def measure(conn: sqlite3.Connection, user_count: int, carrier: bool) -> list[float]:
+    """Returns how long each check took, in milliseconds."""
+    rng = random.Random(1)
+    timings = []
+    for check in range(CHECKS):
+        address = f"100.64.0.{check % 256}" if carrier else ip_address(random.Random(check), user_count)
+        signals = SignupSignals(device_id=f"new-device-{check}", ip_address=address, email=f"new{check}@example.com")
+        referrer_id = rng.randint(1, user_count)
+        started = time.perf_counter()
+        _match_signals(conn, referrer_id, signals.hashed())
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500_000, help="How many users to generate, each with 3 signals.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "signals.sqlite")
+        build_seconds = build(path, args.users)
+
+        conn = sqlite3.connect(path)
+        apply_pragmas(conn)
+        signals = conn.execute("SELECT COUNT(*) FROM signup_signals").fetchone()[0]
+        print(f"Built {args.users} users and {signals} signals in {build_seconds:.1f}s")
+
+        print(f"{'network':<8} | {'p50 ms':>7} | {'p99 ms':>7} | {'max ms':>7}")
+        for name, carrier in (("small", False), ("carrier", True)):
+            timings = measure(conn, args.users, carrier)
+            quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+            print(f"{name:<8} | {quantiles[49]:>7.3f} | {quantiles[98]:>7.3f} | {max(timings):>7.3f}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
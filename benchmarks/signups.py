@@ -0,0 +1,85 @@
+"""
+Load tests concurrent signups that were all referred by the same user.
+
+Every signup writes a referral from the one referrer, so they all contend for
+that referrer's rows. For each concurrency level this reports latency,
+throughput and how many signups the writer committed per transaction, and
+checks that every signup was attributed to the referrer exactly once.
+
+Run with: python benchmarks/signups.py --signups 2000
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from carton_caps.app import create_app, get_db
+
+CONCURRENCY = [1, 8, 64, 256]
+
+
+async def run(concurrency: int, signups: int) -> None:
+    with tempfile.TemporaryDirectory() as instance_path:
+        app = create_app(
+            test_config={
+                "DATABASE": os.path.join(instance_path, "benchmark.sqlite"),
+                "SLOW_QUERY_THRESHOLD": None,
+                "RATE_LIMITS": None,
+            },
+            instance_path=instance_path,
+        )
+        app.logger.setLevel(logging.CRITICAL)
+
+        async with app.app_context():
+            db = get_db()
+            await db.init_db()
+            referrer = await db.create_user("Fox Mulder", "TRUSTNO1")
+
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            names = (f"User {i}" for i in itertools.count())
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies: list[float] = []
+
+            async def signup():
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post("/users", json={"name": next(names), "referral_code": "TRUSTNO1"})
+                    latencies.append(time.perf_counter() - started)
+                    if response.status_code != 201:
+                        raise RuntimeError(f"unexpected status {response.status_code}")
+
+            started = time.perf_counter()
+            await asyncio.gather(*(signup() for _ in range(signups)))
+            elapsed = time.perf_counter() - started
+
+            writer = app.extensions["db_writer"].stats()
+            stats = await (await client.get(f"/users/{referrer.id}/referrals/stats")).get_json()
+
+        if stats["total"] != signups:
+            raise RuntimeError(f"{signups} signups, but {stats['total']} referrals were attributed")
+
+        quantiles = statistics.quantiles([latency * 1000 for latency in latencies], n=100, method="inclusive")
+        print(
+            f"{concurrency:>11} | {quantiles[49]:>8.2f} | {quantiles[98]:>8.2f} | {signups / elapsed:>9.0f}"
+            f" | {writer.jobs / writer.batches:>13.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=2000, help="Signups to send at each concurrency level.")
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>11} | {'p50 ms':>8} | {'p99 ms':>8} | {'signups/s':>9} | {'signups/batch':>13}")
+    for concurrency in CONCURRENCY:
+        asyncio.run(run(concurrency, args.signups))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,5 +3,7 @@ set -e
 
 source .venv/bin/activate
 
-quart init-db
-exec quart run --host=0.0.0.0 --port=5000
+# Quick when the database is already current. A new database is restored from
+# $SNAPSHOT if it is set, or else seeded.
+quart init-db ${SNAPSHOT:+--snapshot "$SNAPSHOT"}
+exec quart serve --host=0.0.0.0 --port=5000 --workers="${WORKERS:-2}"
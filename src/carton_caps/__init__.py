@@ -0,0 +1,5 @@
+import time
+
+# When the package was first imported: the start of a server's startup, as
+# reported in its startup timings.
+import_started = time.perf_counter()
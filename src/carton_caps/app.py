@@ -1,13 +1,48 @@
+import asyncio
+import logging
 import os
-from dataclasses import asdict
+import sys
+import time
+from contextlib import aclosing
+from datetime import datetime
+from typing import Any, AsyncGenerator
 
 import click
-from quart import Quart, jsonify, abort, g, current_app
+from quart import Quart, Response, jsonify, abort, g, current_app, request, url_for
+from quart.wrappers.response import DataBody
 from werkzeug.exceptions import HTTPException
 
-from carton_caps.database import Database
+from carton_caps.cache import Cache
+from carton_caps.codes import ReferralCodeIndex
+from carton_caps.compression import COMPRESSIBLE_MIMETYPES, ENCODINGS, choose_encoding, compress, compress_stream
+from carton_caps.database import (
+    REFERRAL_STATUSES,
+    ConflictError,
+    Database,
+    InvalidReferralCodeError,
+    Referral,
+    ReferralFilter,
+)
+from carton_caps.events import EventBus, ReferralEvent, Subscription, sse_message
+from carton_caps.export import MIMETYPES, encode_export, export_file, infer_compression
+from carton_caps.generate import generate_referrals, generate_users
+from carton_caps.importer import FORMATS, KINDS, import_file, infer_format
+from carton_caps import import_started
+from carton_caps.metrics import Metrics, StartupStats
+from carton_caps.migrations import SCHEMA_VERSION
+from carton_caps.pool import ConnectionPool, PoolTimeoutError
+from carton_caps.purchases import confirm_purchases
+from carton_caps.ratelimit import RateLimiter, retry_after_header
+from carton_caps.server import serve, server_config
+from carton_caps.serialization import REPRESENTATIONS, dumps, referral_to_dict, relative_to_dict
+from carton_caps.signals import SignupSignals
+from carton_caps.snapshot import create_snapshot, restore_snapshot
+from carton_caps.writer import Writer
 from carton_caps.utils import make_sync
 
+# How long importing the app and its dependencies took, for the startup timings.
+import_seconds = time.perf_counter() - import_started
+
 
 def get_db() -> Database:
     """
@@ -17,13 +52,36 @@ def get_db() -> Database:
     in the 'g' object, which provides request-local storage. This allows each
     request to get its own database connection while allowing reuse within
     the same request context.
+
+    While the app is serving, the connection is leased from the app-wide
+    connection pool and writes go through the app-wide writer. Outside of
+    serving (CLI commands, bare app contexts in tests) there is neither, and
+    a dedicated connection is opened instead.
     """
     if "db" not in g:
         # Create a new database connection using the app's configured path
-        g.db = Database(current_app.config["DATABASE"])
+        g.db = open_db()
     return g.db
 
 
+def open_db() -> Database:
+    """
+    Returns a new database connection that isn't tied to the current context.
+
+    The caller is responsible for closing it. This is for work that outlives
+    the request context, such as streaming a response body.
+    """
+    return Database(
+        current_app.config["DATABASE"],
+        pool=current_app.extensions.get("db_pool"),
+        writer=current_app.extensions.get("db_writer"),
+        cache=current_app.extensions.get("referral_cache"),
+        codes=current_app.extensions.get("referral_codes"),
+        metrics=current_app.extensions.get("metrics"),
+        events=current_app.extensions.get("events"),
+    )
+
+
 async def close_db(_e=None):
     """
     Closes the database connection in the current context, if it exists.
@@ -38,25 +96,649 @@ async def close_db(_e=None):
         await db.close()
 
 
+async def open_database():
+    """
+    Opens the app-wide connection pool, starts the writer and loads the
+    referral code index.
+
+    This is registered as a before_serving handler, so all three live for as
+    long as the server does and are shared by every request. Reads lease
+    connections from the pool, while all writes are funneled through the
+    single writer task.
+
+    The database has to be at the current schema version already. Migrating
+    is left to `init-db`, which runs once, rather than to each of the
+    server's workers at the same time.
+    """
+    startup: StartupStats = current_app.extensions["startup"]
+
+    started = time.perf_counter()
+    db = Database(current_app.config["DATABASE"])
+    try:
+        version = await db.get_schema_version()
+    finally:
+        await db.close()
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            f"The database is at schema version {version}, but the app needs version {SCHEMA_VERSION}. "
+            "Run quart init-db first."
+        )
+    startup.schema_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    writer = Writer(
+        current_app.config["DATABASE"],
+        max_batch_size=current_app.config["WRITER_MAX_BATCH_SIZE"],
+        max_latency=current_app.config["WRITER_MAX_LATENCY"],
+    )
+    await writer.start()
+    current_app.extensions["db_writer"] = writer
+
+    pool = ConnectionPool(
+        current_app.config["DATABASE"],
+        min_size=current_app.config["DB_POOL_MIN_SIZE"],
+        max_size=current_app.config["DB_POOL_MAX_SIZE"],
+        acquire_timeout=current_app.config["DB_POOL_ACQUIRE_TIMEOUT"],
+        health_check_interval=current_app.config["DB_POOL_HEALTH_CHECK_INTERVAL"],
+    )
+    await pool.open()
+    current_app.extensions["db_pool"] = pool
+
+    codes = ReferralCodeIndex(
+        current_app.config["DATABASE"],
+        refresh_interval=current_app.config["REFERRAL_CODE_REFRESH_INTERVAL"],
+        error_rate=current_app.config["REFERRAL_CODE_ERROR_RATE"],
+    )
+    # Loaded while warming up, since that reads every referral code
+    await codes.open(load=False)
+    current_app.extensions["referral_codes"] = codes
+
+    startup.open_seconds = time.perf_counter() - started
+
+    # Serve straight away, but only report ready once the database is warm.
+    current_app.extensions["ready"] = False
+    if current_app.config["WARM_UP"]:
+        current_app.add_background_task(warm_up)
+    else:
+        await codes.load()
+        current_app.extensions["ready"] = True
+        current_app.logger.info(startup.describe())
+
+
+async def warm_up():
+    """
+    Reads the database's hot pages into memory and loads the referral code
+    index, then marks the server ready.
+
+    This runs as a background task once serving has started, so that the
+    server can answer liveness checks while it warms up.
+    """
+    started = time.perf_counter()
+    # A connection of its own, so as not to hold one of the pool's while requests are served.
+    db = Database(current_app.config["DATABASE"])
+    try:
+        await db.warm_up()
+    finally:
+        await db.close()
+    await current_app.extensions["referral_codes"].load()
+    startup: StartupStats = current_app.extensions["startup"]
+    startup.warm_up_seconds = time.perf_counter() - started
+    current_app.extensions["ready"] = True
+    current_app.logger.info(startup.describe())
+
+
+async def close_database():
+    """
+    Ends any open event streams, closes the referral code index, drains and
+    closes the app-wide connection pool, and stops the writer once any queued
+    writes have been committed.
+
+    This is registered as an after_serving handler.
+    """
+    current_app.extensions["ready"] = False
+
+    current_app.extensions["events"].close()
+
+    codes = current_app.extensions.pop("referral_codes", None)
+    if codes is not None:
+        await codes.close()
+
+    pool = current_app.extensions.pop("db_pool", None)
+    if pool is not None:
+        await pool.close()
+
+    writer = current_app.extensions.pop("db_writer", None)
+    if writer is not None:
+        await writer.stop()
+
+
+async def hold_stream_slot(slots: asyncio.Semaphore, body: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """
+    Streams `body` while holding one of `slots`, released once it is complete or the client goes away.
+
+    The slot is taken when the body starts, before it opens its connection, so
+    a response that is never sent doesn't hold one.
+    """
+    async with slots:
+        async with aclosing(body):
+            async for chunk in body:
+                yield chunk
+
+
+async def stream_json_array(
+    db: Database, items: AsyncGenerator[Referral, None], chunk_size: int = 64
+) -> AsyncGenerator[bytes, None]:
+    """
+    Encodes referrals as a JSON array, a chunk at a time, as they are read.
+
+    The database connection is closed once the array is complete or the
+    client goes away, after `items` is closed, so that its cursor is never
+    left open on a connection that has been handed back.
+    """
+    try:
+        async with aclosing(items):
+            yield b"["
+            chunk = []
+            first = True
+            async for item in items:
+                chunk.append(referral_to_dict(item))
+                if len(chunk) == chunk_size:
+                    # Encode the chunk as an array, and strip the brackets to splice it into ours
+                    yield (b"" if first else b",") + dumps(chunk)[1:-1]
+                    first = False
+                    chunk = []
+            if chunk:
+                yield (b"" if first else b",") + dumps(chunk)[1:-1]
+            yield b"]"
+    finally:
+        await db.close()
+
+
+async def stream_export(
+    db: Database, kind: str, file_format: str, after_id: int, through_id: int, since: datetime | None
+) -> AsyncGenerator[bytes, None]:
+    """
+    Encodes an export as NDJSON or CSV, a batch at a time, as it is read.
+
+    The database connection is closed once the export is complete or the
+    client goes away.
+    """
+    try:
+        async with aclosing(
+            encode_export(db.iter_export(kind, after_id, through_id, since), kind, file_format)
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        await db.close()
+
+
+def _referral_event_message(event: ReferralEvent) -> bytes:
+    return sse_message(event.type, dumps(referral_to_dict(event.referral)), id=event.version)
+
+
+def _resync_message(version: int) -> bytes:
+    return sse_message("resync", dumps({"version": version}), id=version)
+
+
+async def stream_referral_events(
+    db: Database, subscription: Subscription, version: int, backlog: list[bytes], heartbeat_interval: float
+) -> AsyncGenerator[bytes, None]:
+    """
+    Sends a user's referral events as server-sent events, as they are published.
+
+    `backlog` is sent first, after which the client is up to date with the
+    referral `version`. When an event doesn't follow on from the last one
+    sent, a change was made elsewhere in between, so the client is told to
+    resync instead. Each heartbeat checks the version in the database for the
+    same reason, leasing a connection only for as long as that takes.
+
+    The stream ends, and the subscription is closed, when the client goes
+    away, the server shuts down or the client falls too far behind.
+    """
+    try:
+        for message in backlog:
+            yield message
+        while not subscription.closed:
+            events = await subscription.get(heartbeat_interval)
+            if subscription.dropped:
+                # The client reconnects, and resumes from the last event it got.
+                break
+            for event in events:
+                if event.version <= version:
+                    # Already covered by a resync.
+                    continue
+                if event.version == version + 1:
+                    yield _referral_event_message(event)
+                else:
+                    subscription.record_resync()
+                    yield _resync_message(event.version)
+                version = event.version
+            if events or subscription.closed:
+                continue
+
+            try:
+                current = await db.get_referral_version(subscription.user_id)
+            except PoolTimeoutError:
+                current = version
+            finally:
+                await db.close()
+            if current is None:
+                break
+            if current > version:
+                subscription.record_resync()
+                yield _resync_message(current)
+                version = current
+            else:
+                yield b": heartbeat\n\n"
+    finally:
+        subscription.close()
+        await db.close()
+
+
+# Routes that read referral data, which are limited per client under the "lookup" rule.
+_LOOKUP_ENDPOINTS = {
+    "get_user_referrals",
+    "get_user_referral_stats",
+    "get_user_referral_events",
+    "get_user_downline",
+    "get_user_downline_size",
+    "get_user_upline",
+    "get_referrals_batch",
+    "post_referrals_batch",
+    "resolve_referral_code",
+}
+
+
+async def rate_limit_keys() -> list[tuple[str, str]]:
+    """
+    Returns the rate limit rules that apply to the current request, with the key each is counted under.
+
+    A signup is counted against the client and against the referral code it
+    was made with, which stands in for the referrer, since each user has
+    exactly one code. Resolving a code is counted against the client and the
+    code, so that neither a bot guessing codes nor many clients hammering one
+    code get far.
+    """
+    client = request.remote_addr or "unknown"
+    if request.endpoint == "create_user":
+        keys = [("signup", client)]
+        body = await request.get_json(silent=True)
+        if isinstance(body, dict) and isinstance(body.get("referral_code"), str):
+            keys.append(("referrer", body["referral_code"]))
+        return keys
+    if request.endpoint in _LOOKUP_ENDPOINTS:
+        keys = [("lookup", client)]
+        if request.endpoint == "resolve_referral_code" and request.view_args:
+            keys.append(("code", request.view_args["code"]))
+        return keys
+    return []
+
+
+def data_response(obj: Any, status: int = 200) -> Response:
+    """
+    Encodes an object in the representation the client asks for in its Accept header.
+
+    That is JSON, unless the client prefers MessagePack and msgpack is
+    installed.
+    """
+    mimetype = request.accept_mimetypes.best_match(list(REPRESENTATIONS)) or "application/json"
+    response = Response(REPRESENTATIONS[mimetype](obj), status=status, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
+def _set_validators(response: Response, etag: str) -> None:
+    """
+    Marks a response as cacheable by the client, provided it revalidates with the ETag every time.
+
+    The ETag is weak: it is derived from the data, not the bytes, so it is
+    the same whichever representation and encoding the body was sent in.
+    """
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.update(("Accept", "Accept-Encoding"))
+
+
+def remove_database(path: str) -> None:
+    """Deletes a database file along with its WAL and shared memory files."""
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
 @click.command("init-db")
+@click.option("--reset", is_flag=True, help="Delete the existing database first.")
+@click.option(
+    "--snapshot",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Start a new database from this snapshot, rather than seed data.",
+)
 @make_sync
-async def init_db_command():
+async def init_db_command(reset: bool, snapshot: str | None):
     """
     Initializes the database with seed data.
 
     This is a CLI command that can be run with: quart init-db
     The @make_sync decorator handles the async/sync bridge for Click.
+
+    It is safe to run on every start: an existing database keeps its data,
+    and one at the current schema version is left as it is. A new database is
+    restored from `--snapshot` if one is given, or else seeded.
     """
+    started = time.perf_counter()
     # Create an application instance to get access to configuration
     app = create_app()
+    path = app.config["DATABASE"]
+
+    if reset:
+        remove_database(path)
+
+    if snapshot is not None:
+        if os.path.exists(path):
+            click.echo("Database already exists, skipping snapshot. Pass --reset to replace it.")
+        else:
+            restore_started = time.perf_counter()
+            restore_snapshot(snapshot, path)
+            click.echo(f"Restored {snapshot} in {time.perf_counter() - restore_started:.2f}s")
 
     # Use app_context() to simulate being inside a request for database access
     async with app.app_context():
         db = get_db()
-        # Initialize the database
+        # Create the schema, or bring an existing one up to date
+        applied = await db.init_db()
+        if applied:
+            click.echo(f"Applied schema migrations: {', '.join(map(str, applied))}")
+        # Create realistic seed data for testing, unless there's data already.
+        if not await db.has_users():
+            await db.seed_db()
+        else:
+            click.echo("Database already contains data, skipping seed data.")
+
+    click.echo(f"Database is ready at schema version {SCHEMA_VERSION} ({time.perf_counter() - started:.2f}s)")
+
+
+@click.command("snapshot")
+@click.argument("path", type=click.Path(dir_okay=False))
+@make_sync
+async def snapshot_command(path: str):
+    """
+    Writes a snapshot of the database, to bootstrap other databases from.
+
+    This is a CLI command that can be run with: quart snapshot PATH
+    It is safe to run while the server is running. Start a new database from
+    the snapshot with: quart init-db --snapshot PATH
+    """
+    app = create_app()
+
+    started = time.perf_counter()
+    create_snapshot(app.config["DATABASE"], path)
+    click.echo(f"Wrote {path} ({os.path.getsize(path) / 2**20:.1f} MiB) in {time.perf_counter() - started:.2f}s")
+
+
+@click.command("import-data")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--kind", type=click.Choice(KINDS), required=True, help="What the file holds.")
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="Inferred from the extension if omitted.")
+@click.option("--chunk-size", default=10_000, show_default=True, help="Rows per transaction.")
+@click.option("--restart", is_flag=True, help="Ignore progress from an earlier, interrupted import.")
+@make_sync
+async def import_data_command(path: str, kind: str, file_format: str | None, chunk_size: int, restart: bool):
+    """
+    Bulk imports users or referrals from an NDJSON or CSV file.
+
+    This is a CLI command that can be run with: quart import-data PATH --kind users
+    If the import fails part way through, running it again resumes after the
+    last chunk that was committed.
+    """
+    app = create_app()
+
+    async with app.app_context():
+        db = get_db()
+        await db.init_db()
+        try:
+            result = await import_file(db, path, kind, file_format, chunk_size, restart, report=click.echo)
+        except Exception as e:
+            raise click.ClickException(f"Import failed: {e}. Run the command again to resume.") from e
+
+    click.echo(
+        f"Imported {result.imported} {kind} in {result.seconds:.1f}s ({result.rows_per_second:.0f} rows/s)"
+        + (f", skipped {result.skipped} imported previously" if result.skipped else "")
+    )
+
+
+@click.command("export-data")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True), default="-")
+@click.option("--kind", type=click.Choice(KINDS), required=True, help="What to export.")
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(FORMATS),
+    help="Inferred from the extension if omitted, or ndjson when writing to stdout.",
+)
+@click.option(
+    "--compress",
+    "encoding",
+    type=click.Choice(list(ENCODINGS)),
+    help="Inferred from the extension (.gz, .zst or .br) if omitted.",
+)
+@click.option("--after-id", default=0, show_default=True, help="Only export rows with a higher id.")
+@click.option("--since", help="Only export referrals created at or after this ISO 8601 time.")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows read from the database at a time.")
+@make_sync
+async def export_data_command(
+    path: str,
+    kind: str,
+    file_format: str | None,
+    encoding: str | None,
+    after_id: int,
+    since: str | None,
+    batch_size: int,
+):
+    """
+    Exports every user or referral, with the users they join to, as NDJSON or CSV.
+
+    This is a CLI command that can be run with: quart export-data PATH --kind referrals
+    The export is written to PATH, or to stdout if it is omitted. It covers
+    rows up to the highest id when it starts, and reports that id when it
+    finishes: pass it as --after-id next time to export only newer rows.
+    """
+    try:
+        if path == "-":
+            file_format = file_format or "ndjson"
+        else:
+            inferred_encoding, uncompressed_path = infer_compression(path)
+            encoding = encoding or inferred_encoding
+            file_format = file_format or infer_format(uncompressed_path)
+        since_time = None
+        if since is not None:
+            if kind != "referrals":
+                raise ValueError("only referrals can be exported --since a time")
+            since_time = datetime.fromisoformat(since)
+    except ValueError as e:
+        raise click.UsageError(str(e)) from e
+
+    app = create_app()
+
+    def report(message: str) -> None:
+        # The export itself may be going to stdout.
+        click.echo(message, err=True)
+
+    async with app.app_context():
+        db = get_db()
+        await db.init_db()
+        try:
+            if path == "-":
+                result = await export_file(
+                    db, sys.stdout.buffer, kind, file_format, encoding, after_id, since_time, batch_size, report
+                )
+            else:
+                # Written next to its destination and renamed into place once
+                # complete, so a failed export never looks like a finished one.
+                partial_path = path + ".partial"
+                with open(partial_path, "wb") as f:
+                    result = await export_file(
+                        db, f, kind, file_format, encoding, after_id, since_time, batch_size, report
+                    )
+                os.replace(partial_path, path)
+        except ValueError as e:
+            raise click.ClickException(f"Export failed: {e}") from e
+
+    report(
+        f"Exported {result.exported} {kind} in {result.seconds:.1f}s ({result.rows_per_second:.0f} rows/s), "
+        f"through id {result.through_id}. Pass --after-id {result.through_id} to export only newer {kind}."
+    )
+
+
+@click.command("confirm-referrals")
+@click.argument("events", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--chunk-size", default=5_000, show_default=True, help="Events per transaction, at most.")
+@click.option(
+    "--max-latency",
+    default=1.0,
+    show_default=True,
+    help="Seconds to wait for a chunk to fill before applying what has arrived.",
+)
+@click.option("--dedup-window", default=100_000, show_default=True, help="Recent event ids remembered.")
+@make_sync
+async def confirm_referrals_command(events, chunk_size: int, max_latency: float, dedup_window: int):
+    """
+    Confirms pending referrals from a stream of NDJSON purchase events.
+
+    This is a CLI command that can be run with: quart confirm-referrals EVENTS
+    Events are read from the file, or from stdin if it is omitted, as they
+    arrive. Each line is an event like {"event_id": "...", "user_id": 42,
+    "occurred_at": "2025-08-10T20:03:00+00:00"}, and confirms the referral
+    that brought that user in, if it is pending. Replaying events is harmless.
+    """
+    app = create_app()
+
+    async with app.app_context():
+        db = get_db()
+        await db.init_db()
+        result = await confirm_purchases(db, events, chunk_size, max_latency, dedup_window, report=click.echo)
+
+    click.echo(
+        f"Confirmed {result.confirmed} referrals from {result.read} events in {result.seconds:.1f}s "
+        f"({result.events_per_second:.0f} events/s, {result.duplicates} duplicates, {result.invalid} invalid"
+        + (f", max lag {result.max_lag:.1f}s" if result.max_lag is not None else "")
+        + ")"
+    )
+
+
+@click.command("generate-data")
+@click.option("--users", "user_count", default=10_000, show_default=True, help="How many users to generate.")
+@click.option("--referred-fraction", default=0.8, show_default=True, help="The fraction of users who were referred.")
+@click.option("--skew", default=2.0, show_default=True, help="How heavily referrals favor early users (1 is uniform).")
+@click.option("--seed", default=0, show_default=True, help="The random seed. The same seed gives the same data.")
+@click.option("--reset", is_flag=True, help="Delete the existing database first.")
+@make_sync
+async def generate_data_command(user_count: int, referred_fraction: float, skew: float, seed: int, reset: bool):
+    """
+    Fills an empty database with a synthetic dataset, for benchmarking.
+
+    This is a CLI command that can be run with: quart generate-data --users 100000
+    """
+    app = create_app()
+
+    if reset:
+        remove_database(app.config["DATABASE"])
+
+    async with app.app_context():
+        db = get_db()
+        await db.init_db()
+        if await db.has_users():
+            raise click.ClickException("The database isn't empty. Pass --reset to replace it.")
+
+        started = time.monotonic()
+        users = await db.bulk_create_users(generate_users(user_count))
+        referrals = await db.bulk_create_referrals(
+            generate_referrals(user_count, referred_fraction=referred_fraction, skew=skew, seed=seed)
+        )
+
+    click.echo(f"Generated {users} users and {referrals} referrals in {time.monotonic() - started:.1f}s")
+
+
+@click.command("reconcile-stats")
+@click.option("--dry-run", is_flag=True, help="Only report drift, without fixing it.")
+@make_sync
+async def reconcile_stats_command(dry_run: bool):
+    """
+    Rebuilds the referral counts from the referrals, reporting any that had drifted.
+
+    This is a CLI command that can be run with: quart reconcile-stats
+    """
+    app = create_app()
+
+    async with app.app_context():
+        db = get_db()
         await db.init_db()
-        # Create realistic seed data for testing.
-        await db.seed_db()
+        drift = await db.reconcile_referral_counts(fix=not dry_run)
+
+    for count in drift:
+        click.echo(f"user {count.user_id}, {count.status}: stored {count.stored}, actual {count.actual}")
+    if not drift:
+        click.echo("Referral counts are correct.")
+    elif dry_run:
+        click.echo(f"{len(drift)} referral counts have drifted. Run again without --dry-run to fix them.")
+    else:
+        click.echo(f"Fixed {len(drift)} referral counts.")
+
+
+@click.command("serve")
+@click.option("--host", default="0.0.0.0", show_default=True, help="The address to listen on.")
+@click.option("--port", default=5000, show_default=True, help="The port to listen on.")
+@click.option("--workers", default=1, show_default=True, help="How many server processes to run.")
+@click.option("--keep-alive", default=5.0, show_default=True, help="Seconds to keep idle connections open.")
+@click.option(
+    "--graceful-timeout", default=30.0, show_default=True, help="Seconds in-flight requests get to finish on shutdown."
+)
+@click.option(
+    "--h2-max-concurrent-streams", default=100, show_default=True, help="Concurrent requests per HTTP/2 connection."
+)
+@click.option("--certfile", type=click.Path(exists=True, dir_okay=False), help="TLS certificate, enabling HTTP/2.")
+@click.option("--keyfile", type=click.Path(exists=True, dir_okay=False), help="TLS private key.")
+@click.option("--access-log", is_flag=True, help="Log every request to stdout.")
+@click.option("--no-uvloop", is_flag=True, help="Use the standard asyncio event loop even if uvloop is installed.")
+def serve_command(
+    host: str,
+    port: int,
+    workers: int,
+    keep_alive: float,
+    graceful_timeout: float,
+    h2_max_concurrent_streams: int,
+    certfile: str | None,
+    keyfile: str | None,
+    access_log: bool,
+    no_uvloop: bool,
+):
+    """
+    Serves the app with Hypercorn, the production server.
+
+    This is a CLI command that can be run with: quart serve --workers 4
+    Unlike `quart run`, it runs several worker processes, uses uvloop when it
+    is installed, and drains in-flight requests on shutdown.
+    """
+    config = server_config(
+        # Workers import this module under the same name as the CLI did, so
+        # that they find the same instance folder, and with it the same
+        # configuration and database.
+        f"{__name__}:create_app()",
+        host=host,
+        port=port,
+        workers=workers,
+        keep_alive=keep_alive,
+        graceful_timeout=graceful_timeout,
+        h2_max_concurrent_streams=h2_max_concurrent_streams,
+        certfile=certfile,
+        keyfile=keyfile,
+        access_log=access_log,
+        use_uvloop=not no_uvloop,
+    )
+    click.echo(f"Serving on {host}:{port} with {workers} {config.worker_class} worker(s)")
+    raise SystemExit(serve(config))
 
 
 def create_app(test_config=None, **kwargs):
@@ -65,13 +747,72 @@ def create_app(test_config=None, **kwargs):
 
     This is the standard Flask/Quart application factory pattern.
     """
+    started = time.perf_counter()
+
     # Create the Quart application instance
     app = Quart(__name__, **kwargs)
+    # Startup timings and other notes are logged at INFO
+    app.logger.setLevel(logging.INFO)
 
     # Set default configuration values
     # instance_path is a Flask/Quart convention for app-specific data
     app.config.from_mapping(
         DATABASE=os.path.join(app.instance_path, "app.sqlite"),
+        # Connection pool settings, used while the app is serving
+        DB_POOL_MIN_SIZE=1,
+        DB_POOL_MAX_SIZE=10,
+        DB_POOL_ACQUIRE_TIMEOUT=5.0,
+        DB_POOL_HEALTH_CHECK_INTERVAL=30.0,
+        # Read-through cache for users and referral lists. Set REFERRAL_CACHE_TTL
+        # to 0 to disable it.
+        REFERRAL_CACHE_TTL=30.0,
+        REFERRAL_CACHE_MAX_ENTRIES=10_000,
+        REFERRAL_CACHE_MAX_SIZE=64 * 1024 * 1024,
+        # The largest page size a client may request from a paginated listing
+        MAX_PAGE_SIZE=1000,
+        # The most users whose referrals can be fetched in one batch request
+        MAX_BATCH_SIZE=500,
+        # The referral code index, used while the app is serving. Codes of users
+        # created by other processes are picked up within the refresh interval.
+        REFERRAL_CODE_REFRESH_INTERVAL=5.0,
+        REFERRAL_CODE_ERROR_RATE=0.01,
+        # Queries taking at least this many seconds are logged, with their
+        # query plan, to the carton_caps.slow_queries logger. None disables it.
+        SLOW_QUERY_THRESHOLD=0.1,
+        # Rate limits, as the number of requests allowed per number of seconds
+        # for each key. "signup" and "lookup" are per client IP, "referrer" is
+        # signups per referral code and "code" is lookups of a referral code.
+        # Set RATE_LIMITS to None to disable rate limiting.
+        RATE_LIMITS={
+            "signup": (20, 60.0),
+            "referrer": (100, 3600.0),
+            "lookup": (600, 60.0),
+            "code": (60, 60.0),
+        },
+        RATE_LIMIT_MAX_KEYS=100_000,
+        # Responses of at least this many bytes are compressed, if the client
+        # accepts an encoding we offer. Smaller ones gain too little to be
+        # worth the CPU. None disables compression.
+        COMPRESSION_MIN_SIZE=1024,
+        # Referral event streams. Each subscriber may fall EVENTS_QUEUE_SIZE
+        # events behind before it is dropped, and the last EVENTS_REPLAY_SIZE
+        # events of EVENTS_REPLAY_USERS users are kept for clients resuming a
+        # stream. Streams send a heartbeat when idle for
+        # EVENTS_HEARTBEAT_INTERVAL seconds.
+        EVENTS_QUEUE_SIZE=100,
+        EVENTS_REPLAY_SIZE=32,
+        EVENTS_REPLAY_USERS=10_000,
+        EVENTS_HEARTBEAT_INTERVAL=15.0,
+        # Streamed listings and exports each read from a connection of their
+        # own, outside the pool, for as long as the client takes to read them.
+        # At most this many are open at once; requests for more get a 503.
+        MAX_STREAMS=8,
+        # Group commit settings for the writer, used while the app is serving
+        WRITER_MAX_BATCH_SIZE=64,
+        WRITER_MAX_LATENCY=0.001,
+        # Read the database's hot pages into memory when the server starts.
+        # /health/ready reports the server ready once this has finished.
+        WARM_UP=True,
     )
 
     if test_config is None:
@@ -93,8 +834,113 @@ def create_app(test_config=None, **kwargs):
     # This is the standard pattern for resource cleanup in Flask/Quart
     app.teardown_appcontext(close_db)
 
-    # Add a custom CLI command to the application
+    # The cache is in-process, so unlike the pool it exists outside of serving too
+    if app.config["REFERRAL_CACHE_TTL"] > 0:
+        app.extensions["referral_cache"] = Cache(
+            max_entries=app.config["REFERRAL_CACHE_MAX_ENTRIES"],
+            max_size=app.config["REFERRAL_CACHE_MAX_SIZE"],
+            ttl=app.config["REFERRAL_CACHE_TTL"],
+        )
+
+    # Query and request metrics, served at /metrics
+    app.extensions["metrics"] = Metrics(slow_query_threshold=app.config["SLOW_QUERY_THRESHOLD"])
+
+    # Writes publish referral events to this process's subscribers
+    app.extensions["events"] = EventBus(
+        max_queued=app.config["EVENTS_QUEUE_SIZE"],
+        replay_size=app.config["EVENTS_REPLAY_SIZE"],
+        replay_users=app.config["EVENTS_REPLAY_USERS"],
+    )
+
+    # Bounds the connections held open by streamed bodies, in each server worker
+    app.extensions["stream_slots"] = asyncio.Semaphore(app.config["MAX_STREAMS"])
+
+    # Rate limits are in-process too, so each server worker enforces its own
+    if app.config["RATE_LIMITS"]:
+        app.extensions["rate_limiter"] = RateLimiter(
+            app.config["RATE_LIMITS"], max_keys=app.config["RATE_LIMIT_MAX_KEYS"]
+        )
+
+    # Share a pool of connections and a single writer between requests while serving
+    app.before_serving(open_database)
+    app.after_serving(close_database)
+
+    # Add custom CLI commands to the application
     app.cli.add_command(init_db_command)
+    app.cli.add_command(import_data_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(generate_data_command)
+    app.cli.add_command(reconcile_stats_command)
+    app.cli.add_command(confirm_referrals_command)
+    app.cli.add_command(serve_command)
+    app.cli.add_command(snapshot_command)
+
+    @app.before_request
+    async def start_request_timer():
+        """Notes when the request started, so its duration can be recorded."""
+        g.request_started = time.perf_counter()
+
+    @app.before_request
+    async def enforce_rate_limits():
+        """
+        Turns away requests over a rate limit with a 429, before the view runs.
+
+        A rejected request never reaches the database, not even to lease a
+        connection. The response is returned rather than raised, so that a
+        flood of rejections isn't logged as errors.
+        """
+        limiter: RateLimiter | None = app.extensions.get("rate_limiter")
+        if limiter is None:
+            return None
+        for rule, key in await rate_limit_keys():
+            retry_after = limiter.acquire(rule, key)
+            if retry_after:
+                response = jsonify({"error": "Too many requests"})
+                response.status_code = 429
+                response.headers["Retry-After"] = retry_after_header(retry_after)
+                return response
+        return None
+
+    @app.after_request
+    async def record_request(response: Response) -> Response:
+        """
+        Records how long the request took in the metrics.
+
+        Requests are labelled with the route that matched rather than the
+        path, so that each user's requests don't become a metric of their own.
+        """
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            app.extensions["metrics"].observe_request(
+                request.method, route, response.status_code, time.perf_counter() - started
+            )
+        return response
+
+    @app.after_request
+    async def compress_response(response: Response) -> Response:
+        """
+        Compresses the body with the best encoding the client accepts.
+
+        This runs before the request is recorded, so the time spent
+        compressing counts towards the request's duration. Streamed bodies
+        are compressed by their view instead, since their size isn't known.
+        """
+        min_size = app.config["COMPRESSION_MIN_SIZE"]
+        if min_size is None or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add("Accept-Encoding")
+        if (
+            response.content_encoding is not None
+            or not isinstance(response.response, DataBody)
+            or (response.content_length or 0) < min_size
+        ):
+            return response
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is not None:
+            response.set_data(compress(await response.get_data(as_text=False), encoding))
+            response.content_encoding = encoding
+        return response
 
     @app.errorhandler(Exception)
     async def handle_errors(e):
@@ -109,6 +955,10 @@ def create_app(test_config=None, **kwargs):
             code = e.code or 500
             return jsonify({"error": e.description}), code
 
+        # The database is saturated, so ask the client to try again later
+        if isinstance(e, PoolTimeoutError):
+            return jsonify({"error": "Service temporarily unavailable"}), 503
+
         # For all other exceptions, return a generic 500 error
         # This prevents sensitive error details from leaking to clients
         return jsonify({"error": "Internal server error"}), 500
@@ -117,23 +967,528 @@ def create_app(test_config=None, **kwargs):
     async def get_user_referrals(user_id: int):
         """
         Returns a list of referrals for a given user ID.
+
+        Results are ordered by referral id, or newest first with `order=desc`.
+        `status` narrows them to one status, and `since` and `until` to those
+        created in that range of ISO 8601 times; filtered results are ordered
+        by creation time, then id. Clients may page through them
+        with the `limit` and `after` query parameters; when there is another
+        page, its URL is returned in a `Link` header. Passing `stream=true`
+        streams the body as it is read from the database, so large lists don't
+        have to be held in memory.
+
+        Responses carry an ETag derived from the user's referral version, and a
+        request with a matching `If-None-Match` gets a 304 without the
+        referrals being read at all.
         """
+        limit = _get_int_arg("limit")
+        after = _get_int_arg("after")
+        stream = request.args.get("stream", "false").lower() in ("1", "true")
+        status = request.args.get("status")
+        since = _get_time_arg("since")
+        until = _get_time_arg("until")
+        order = request.args.get("order", "asc")
+
+        if limit is not None and not 1 <= limit <= app.config["MAX_PAGE_SIZE"]:
+            abort(400, description=f"limit must be between 1 and {app.config['MAX_PAGE_SIZE']}")
+        if status is not None and status not in REFERRAL_STATUSES:
+            abort(400, description=f"status must be one of {', '.join(REFERRAL_STATUSES)}")
+        if order not in ("asc", "desc"):
+            abort(400, description="order must be asc or desc")
+        descending = order == "desc"
+        filter = (
+            ReferralFilter(status=status, since=since, until=until)
+            if status is not None or since is not None or until is not None
+            else None
+        )
+
         db = get_db()
+        page_limit = limit + 1 if limit is not None else None
 
-        # First, check if the user exists in the database.
-        user = await db.get_user_by_id(user_id)
+        # First, check if the user exists in the database. Their referral
+        # version doubles as the existence check. A plain request reads the
+        # referrals along with it, in one trip to the database, and fetches
+        # one extra row to find out whether there is another page. A
+        # conditional request may not need them at all, and a stream reads
+        # them as it goes, so those read the version alone.
+        referrals = None
+        if stream or request.if_none_match:
+            version = await db.get_referral_version(user_id)
+        else:
+            page = await db.get_referral_page(
+                user_id, after=after, limit=page_limit, filter=filter, descending=descending
+            )
+            version, referrals = page if page is not None else (None, None)
 
         # If not, abort with a 404 error.
-        if not user:
+        if version is None:
             abort(404, description=f"User with ID {user_id} not found")
 
         # If we were implementing authorization, we'd do that here.
 
-        # The user exists, so get their referrals.
-        referrals = await db.get_referrals_by_source_id(user_id)
+        # If the client's copy is current, there's nothing to read or send.
+        etag = f"{user_id}-{version}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            _set_validators(response, etag)
+            return response
+
+        if stream:
+            stream_slots: asyncio.Semaphore = app.extensions["stream_slots"]
+            if stream_slots.locked():
+                abort(503, description="Too many streams are open, try again later")
+
+            # Work out the next page up front, since headers go out before the body.
+            next_cursor = (
+                await db.get_next_referral_cursor(user_id, after, limit, filter, descending)
+                if limit is not None
+                else None
+            )
+
+            # The body is produced after this request context has been torn
+            # down, and a slow client can take as long as it likes to read it,
+            # so it gets a connection of its own rather than holding one of
+            # the pool's. The number of those is bounded by the stream slots.
+            stream_db = Database(app.config["DATABASE"], metrics=app.extensions.get("metrics"))
+            referrals = stream_db.iter_referrals_by_source_id(
+                user_id, after=after, limit=limit, filter=filter, descending=descending
+            )
+            body = hold_stream_slot(stream_slots, stream_json_array(stream_db, referrals))
+            # A stream's size isn't known up front, so it is compressed
+            # whenever the client accepts it, a chunk at a time.
+            encoding = (
+                choose_encoding(request.accept_encodings) if app.config["COMPRESSION_MIN_SIZE"] is not None else None
+            )
+            if encoding is not None:
+                body = compress_stream(body, encoding)
+            response = Response(body, mimetype="application/json")
+            if encoding is not None:
+                response.content_encoding = encoding
+        else:
+            if referrals is None:
+                # The user exists, and the client's copy is out of date, so get their referrals.
+                referrals = await db.get_referrals_by_source_id(
+                    user_id,
+                    after=after,
+                    limit=page_limit,
+                    min_version=version,
+                    filter=filter,
+                    descending=descending,
+                )
+            next_cursor = None
+            if limit is not None and len(referrals) > limit:
+                referrals = referrals[:limit]
+                next_cursor = referrals[-1].id
+
+            # Convert dataclass objects to dictionaries and encode them as the client asked
+            response = data_response([referral_to_dict(row) for row in referrals])
+
+        if next_cursor is not None:
+            next_url = url_for(
+                "get_user_referrals",
+                user_id=user_id,
+                limit=limit,
+                after=next_cursor,
+                stream=request.args.get("stream"),
+                status=status,
+                since=request.args.get("since"),
+                until=request.args.get("until"),
+                order=request.args.get("order"),
+            )
+            response.headers["Link"] = f'<{next_url}>; rel="next"'
+
+        _set_validators(response, etag)
+        return response
+
+    @app.route("/health/live")
+    async def get_liveness():
+        """Reports that the server is up and handling requests."""
+        return jsonify({"status": "live"})
+
+    @app.route("/health/ready")
+    async def get_readiness():
+        """
+        Reports whether the server is ready for traffic: serving, with its
+        database open and warmed up, and not shutting down.
+        """
+        if not app.extensions.get("ready"):
+            return jsonify({"status": "not ready"}), 503
+        return jsonify({"status": "ready"})
+
+    @app.route("/metrics")
+    async def get_metrics():
+        """
+        Returns query, write and request metrics, along with the pool, writer,
+        cache and code index statistics, in the Prometheus text format.
+        """
+        # If we were implementing authorization, we'd restrict this to the metrics scraper here.
+
+        stats = {
+            name: component.stats()
+            for name, component in (
+                ("pool", app.extensions.get("db_pool")),
+                ("writer", app.extensions.get("db_writer")),
+                ("cache", app.extensions.get("referral_cache")),
+                ("codes", app.extensions.get("referral_codes")),
+                ("ratelimit", app.extensions.get("rate_limiter")),
+                ("events", app.extensions.get("events")),
+            )
+            if component is not None
+        }
+        stats["startup"] = app.extensions["startup"]
+        return Response(app.extensions["metrics"].render(stats), content_type="text/plain; version=0.0.4")
+
+    @app.route("/users", methods=["POST"])
+    async def create_user():
+        """
+        Signs up a new user, who gets a referral code of their own.
+
+        The body holds the user's `name` and, if they were invited, the
+        `referral_code` they were invited with. The user and their pending
+        referral are created together, in one transaction.
+
+        The optional `device_id` and `email`, along with the client's IP
+        address, are recorded as signals. A referral whose signals have been
+        seen in the referrer's tree before is held rather than pending.
+        """
+        body = await request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400, description="The body must be a JSON object")
+
+        name = body.get("name")
+        referral_code = body.get("referral_code")
+        if not isinstance(name, str) or not 1 <= len(name.strip()) <= 256:
+            abort(400, description="name must be a string of between 1 and 256 characters")
+        for field in ("referral_code", "device_id", "email"):
+            if body.get(field) is not None and not isinstance(body[field], str):
+                abort(400, description=f"{field} must be a string")
+
+        signals = SignupSignals(
+            device_id=body.get("device_id"), ip_address=request.remote_addr, email=body.get("email")
+        )
+
+        db = get_db()
+        try:
+            signup = await db.signup(name.strip(), referred_by_code=referral_code, signals=signals)
+        except InvalidReferralCodeError as e:
+            abort(400, description=str(e))
+        except ConflictError as e:
+            abort(409, description=str(e))
+
+        user = signup.user
+        return data_response(
+            {
+                "user": {
+                    "id": user.id,
+                    "name": user.name,
+                    "avatar_url": user.avatar_url,
+                    "referral_code": user.referral_code,
+                },
+                "referred_by": signup.referred_by,
+                "referral": referral_to_dict(signup.referral) if signup.referral is not None else None,
+            },
+            status=201,
+        )
+
+    @app.route("/referral-codes/<code>")
+    async def resolve_referral_code(code: str):
+        """
+        Returns the user a referral code belongs to, for the signup page to validate a code.
+
+        Most invalid codes are turned away by the in-memory code index without
+        touching the database, since this route sees bot traffic.
+        """
+        db = get_db()
+        user = await db.resolve_referral_code(code)
+        if user is None:
+            # Returned rather than raised, so that a flood of invalid codes isn't logged as errors.
+            return jsonify({"error": "Referral code not found"}), 404
+
+        return data_response(
+            {
+                "referral_code": user.referral_code,
+                "user": {"id": user.id, "name": user.name, "avatar_url": user.avatar_url},
+            }
+        )
+
+    @app.route("/users/<int:user_id>/referrals/stats")
+    async def get_user_referral_stats(user_id: int):
+        """
+        Returns how many referrals a user has made, in total and in each status.
+
+        The counts are read from the user's counter rows, without touching
+        their referrals. Like the listing, responses carry an ETag derived from
+        the user's referral version.
+        """
+        db = get_db()
+        stats = await db.get_referral_stats(user_id)
+        if stats is None:
+            abort(404, description=f"User with ID {user_id} not found")
+
+        etag = f"{user_id}-{stats.version}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = data_response({"user_id": user_id, "total": stats.total, "by_status": stats.counts})
+        _set_validators(response, etag)
+        return response
+
+    @app.route("/users/<int:user_id>/referrals/events")
+    async def get_user_referral_events(user_id: int):
+        """
+        Streams changes to a user's referrals as server-sent events, so clients needn't poll.
+
+        Each event's id is the user's referral version once the change was
+        made. A client reconnecting with a `Last-Event-ID` header (or a
+        `last_event_id` query parameter, such as the version in a listing's
+        ETag) is first sent the events it missed. If they are no longer kept,
+        or it sends neither, it is sent a `resync` event telling it to fetch
+        the referrals afresh.
+        """
+        last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        try:
+            after = int(last_event_id) if last_event_id else None
+        except ValueError:
+            abort(400, description="Last-Event-ID must be an event id from a previous stream")
+
+        # Subscribe before reading the version, so that no change falls between the two.
+        events: EventBus = app.extensions["events"]
+        subscription = events.subscribe(user_id)
+        try:
+            version = await get_db().get_referral_version(user_id)
+        except BaseException:
+            subscription.close()
+            raise
+        if version is None:
+            subscription.close()
+            abort(404, description=f"User with ID {user_id} not found")
+
+        missed = events.replay(user_id, after, version) if after is not None and after <= version else None
+        if missed is None:
+            backlog = [_resync_message(version)]
+        else:
+            backlog = [_referral_event_message(event) for event in missed]
+
+        # The stream outlives this request context, so it needs a connection of its own for heartbeats.
+        body = stream_referral_events(
+            open_db(), subscription, version, backlog, app.config["EVENTS_HEARTBEAT_INTERVAL"]
+        )
+        response = Response(body, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # Streams stay open for as long as the client is connected.
+        response.timeout = None
+        return response
+
+    def _get_int_arg(name: str) -> int | None:
+        """Reads and validates a query parameter holding an integer."""
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            abort(400, description=f"{name} must be an integer")
+
+    def _get_time_arg(name: str) -> datetime | None:
+        """Reads and validates a query parameter holding an ISO 8601 time. Times without a timezone are UTC."""
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            abort(400, description=f"{name} must be an ISO 8601 time")
+
+    def _get_max_depth() -> int | None:
+        """Reads and validates the `max_depth` query parameter shared by the referral tree routes."""
+        max_depth = _get_int_arg("max_depth")
+        if max_depth is not None and max_depth < 1:
+            abort(400, description="max_depth must be at least 1")
+        return max_depth
+
+    async def _require_user(db: Database, user_id: int) -> None:
+        """Aborts with a 404 if the user doesn't exist."""
+        if await db.get_user_by_id(user_id) is None:
+            abort(404, description=f"User with ID {user_id} not found")
+
+    @app.route("/users/<int:user_id>/downline")
+    async def get_user_downline(user_id: int):
+        """
+        Returns the users a user referred, directly or indirectly.
+
+        Results are ordered by depth, then user id, and may be limited to
+        `max_depth` referrals away. Clients page through them with `limit` and
+        `after`, as with the referrals listing, except that the cursor is an
+        opaque string taken from the `Link` header.
+        """
+        max_depth = _get_max_depth()
+        limit = _get_int_arg("limit")
+        if limit is not None and not 1 <= limit <= app.config["MAX_PAGE_SIZE"]:
+            abort(400, description=f"limit must be between 1 and {app.config['MAX_PAGE_SIZE']}")
+
+        after = None
+        if "after" in request.args:
+            try:
+                depth, _, last_id = request.args["after"].partition(".")
+                after = (int(depth), int(last_id))
+            except ValueError:
+                abort(400, description="after must be a cursor from a previous page")
+
+        db = get_db()
+        await _require_user(db, user_id)
+
+        # Fetch one extra row to find out whether there is another page.
+        downline = await db.get_downline(
+            user_id, max_depth=max_depth, after=after, limit=limit + 1 if limit is not None else None
+        )
+
+        next_cursor = None
+        if limit is not None and len(downline) > limit:
+            downline = downline[:limit]
+            next_cursor = f"{downline[-1].depth}.{downline[-1].user.id}"
+
+        response = data_response([relative_to_dict(relative) for relative in downline])
+        if next_cursor is not None:
+            next_url = url_for(
+                "get_user_downline", user_id=user_id, max_depth=max_depth, limit=limit, after=next_cursor
+            )
+            response.headers["Link"] = f'<{next_url}>; rel="next"'
+        return response
+
+    @app.route("/users/<int:user_id>/downline/size")
+    async def get_user_downline_size(user_id: int):
+        """Returns how many users are in a user's downline, in total and at each depth."""
+        max_depth = _get_max_depth()
+
+        db = get_db()
+        await _require_user(db, user_id)
+
+        levels = await db.get_downline_size(user_id, max_depth=max_depth)
+        return data_response(
+            {
+                "user_id": user_id,
+                "size": sum(levels.values()),
+                "levels": [{"depth": depth, "count": count} for depth, count in levels.items()],
+            }
+        )
+
+    @app.route("/users/<int:user_id>/upline")
+    async def get_user_upline(user_id: int):
+        """
+        Returns the chain of users who led to a user joining, nearest first.
+
+        The chain may be cut short at `max_depth` referrals away.
+        """
+        max_depth = _get_max_depth()
+
+        db = get_db()
+        await _require_user(db, user_id)
+
+        upline = await db.get_upline(user_id, max_depth=max_depth)
+        return data_response([relative_to_dict(relative) for relative in upline])
+
+    @app.route("/referrals")
+    async def get_referrals_batch():
+        """
+        Returns the referrals of many users at once.
+
+        User ids are passed as a comma separated `user_ids` query parameter.
+        """
+        try:
+            user_ids = [int(user_id) for user_id in request.args.get("user_ids", "").split(",") if user_id]
+        except ValueError:
+            abort(400, description="user_ids must be a comma separated list of integers")
+        return await _batch_referrals_response(user_ids)
+
+    @app.route("/referrals/batch", methods=["POST"])
+    async def post_referrals_batch():
+        """
+        Returns the referrals of many users at once.
+
+        User ids are passed as a `user_ids` array in a JSON body, for lists
+        too long to fit comfortably in a URL.
+        """
+        body = await request.get_json(silent=True)
+        user_ids = body.get("user_ids") if isinstance(body, dict) else None
+        if not isinstance(user_ids, list) or not all(type(user_id) is int for user_id in user_ids):
+            abort(400, description="user_ids must be an array of integers")
+        return await _batch_referrals_response(user_ids)
+
+    async def _batch_referrals_response(user_ids: list[int]) -> Response:
+        """
+        Builds the response for a batch request.
+
+        A user who doesn't exist gets an error entry of their own, rather than
+        failing the whole request.
+        """
+        if not user_ids:
+            abort(400, description="user_ids is required")
+        if len(user_ids) > app.config["MAX_BATCH_SIZE"]:
+            abort(400, description=f"At most {app.config['MAX_BATCH_SIZE']} user_ids may be requested at once")
+
+        # If we were implementing authorization, we'd restrict this to admins here.
+
+        db = get_db()
+        referrals_by_user = await db.get_referrals_by_source_ids(user_ids)
+
+        results = []
+        for user_id, referrals in referrals_by_user.items():
+            if referrals is None:
+                results.append({"user_id": user_id, "error": f"User with ID {user_id} not found"})
+            else:
+                results.append({"user_id": user_id, "referrals": [referral_to_dict(row) for row in referrals]})
+
+        return data_response({"results": results})
+
+    @app.route("/admin/exports/<kind>")
+    async def get_export(kind: str):
+        """
+        Streams every user or referral, with the users they join to, as NDJSON or CSV.
+
+        `format` is ndjson (the default) or csv. `after_id` and, for
+        referrals, `since` (an ISO 8601 time) limit the export to newer rows.
+        The export covers rows up to the highest id when it starts, which is
+        sent up front in an `Export-Through-Id` header: pass it as `after_id`
+        next time to export only the rows added since. The body is compressed
+        a chunk at a time whenever the client accepts it.
+        """
+        if kind not in KINDS:
+            abort(404, description=f"Unknown export: {kind}")
+        file_format = request.args.get("format", "ndjson")
+        if file_format not in FORMATS:
+            abort(400, description=f"format must be one of {', '.join(FORMATS)}")
+        after_id = _get_int_arg("after_id") or 0
+        since = _get_time_arg("since")
+        if since is not None and kind != "referrals":
+            abort(400, description="Only referrals can be exported since a time")
+
+        # If we were implementing authorization, we'd restrict this to admins here.
+
+        stream_slots: asyncio.Semaphore = app.extensions["stream_slots"]
+        if stream_slots.locked():
+            abort(503, description="Too many streams are open, try again later")
+        through_id = await get_db().get_export_watermark(kind)
+
+        # The body is produced after this request context has been torn down,
+        # and an export can take minutes, so it gets a connection of its own
+        # rather than holding one of the pool's. Exports share the stream
+        # slots with streamed listings.
+        export_db = Database(app.config["DATABASE"], metrics=app.extensions.get("metrics"))
+        body = hold_stream_slot(stream_slots, stream_export(export_db, kind, file_format, after_id, through_id, since))
+        encoding = choose_encoding(request.accept_encodings) if app.config["COMPRESSION_MIN_SIZE"] is not None else None
+        if encoding is not None:
+            body = compress_stream(body, encoding)
+        response = Response(body, mimetype=MIMETYPES[file_format])
+        if encoding is not None:
+            response.content_encoding = encoding
+        response.headers["Content-Disposition"] = f'attachment; filename="{kind}.{file_format}"'
+        response.headers["Export-Through-Id"] = str(through_id)
+        # Large exports take longer than the default response timeout to send.
+        response.timeout = None
+        return response
 
-        # Convert dataclass objects to dictionaries and return as JSON
-        return jsonify([asdict(row) for row in referrals])
+    # Each phase of startup is timed as it happens; this is the first two.
+    app.extensions["startup"] = StartupStats(import_seconds=import_seconds, app_seconds=time.perf_counter() - started)
 
     # Return the configured application instance
     return app
@@ -0,0 +1,180 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+# Rough estimates of the memory held by a cached value, used to enforce the
+# memory cap. Measuring values exactly would cost more than it saves.
+_ENTRY_SIZE = 256
+_ITEM_SIZE = 512
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Estimates how many bytes a cached value holds.
+
+    Lists are costed by their length, including lists held in a tuple, such
+    as a versioned referral listing.
+    """
+    if isinstance(value, list):
+        return _ENTRY_SIZE + len(value) * _ITEM_SIZE
+    if isinstance(value, tuple):
+        return _ENTRY_SIZE + sum(len(item) * _ITEM_SIZE for item in value if isinstance(item, list))
+    return _ENTRY_SIZE
+
+
+@dataclass
+class CacheStats:
+    """A point-in-time snapshot of cache usage."""
+
+    hits: int
+    misses: int
+    coalesced: int
+    evictions: int
+    invalidations: int
+    entries: int
+    size: int
+
+
+@dataclass
+class _Entry:
+    value: Any
+    size: int
+    expires_at: float
+
+
+class _Flight:
+    """A load in progress, which concurrent misses for the same key wait on."""
+
+    def __init__(self):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Set when the key is invalidated mid-load, so the result isn't cached.
+        self.stale = False
+
+
+class Cache:
+    """
+    An in-process read-through cache with LRU and TTL eviction.
+
+    Entries expire `ttl` seconds after they are loaded, and the least recently
+    used entries are evicted once there are more than `max_entries` of them or
+    they hold more than `max_size` bytes (estimated). Concurrent misses for the
+    same key are coalesced into a single load.
+    """
+
+    def __init__(self, max_entries: int = 10_000, max_size: int = 64 * 1024 * 1024, ttl: float = 30.0):
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._flights: dict[Hashable, _Flight] = {}
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value for a key, or `default` if it isn't cached."""
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self._misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry.value
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[T]]) -> T:
+        """
+        Returns the cached value for a key, calling `loader` to load it on a miss.
+
+        If a load for the key is already in progress, waits for it instead of
+        starting another.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._coalesced += 1
+            return await asyncio.shield(flight.future)
+
+        flight = self._flights[key] = _Flight()
+        try:
+            value = await loader()
+        except BaseException as e:
+            flight.future.set_exception(e)
+            # Don't warn about an unretrieved exception when nobody was waiting.
+            flight.future.exception()
+            raise
+        else:
+            flight.future.set_result(value)
+            if not flight.stale:
+                self._put(key, value)
+            return value
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def invalidate(self, key: Hashable) -> None:
+        """Removes a key from the cache, along with the result of any load of it that is in progress."""
+        self._invalidations += 1
+        if key in self._entries:
+            self._remove(key)
+
+        # A load that started before the write may have read the old data. Its
+        # callers still get that result, but it isn't cached, and later misses
+        # start a fresh load rather than joining it.
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.stale = True
+
+    def clear(self) -> None:
+        """Removes every entry from the cache."""
+        self._entries.clear()
+        self._size = 0
+        for flight in self._flights.values():
+            flight.stale = True
+        self._flights.clear()
+
+    def stats(self) -> CacheStats:
+        """Returns a snapshot of the hit, miss and eviction counters."""
+        return CacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            coalesced=self._coalesced,
+            evictions=self._evictions,
+            invalidations=self._invalidations,
+            entries=len(self._entries),
+            size=self._size,
+        )
+
+    def _put(self, key: Hashable, value: Any) -> None:
+        size = estimate_size(value)
+        # An entry that would take up most of the cache on its own isn't worth keeping.
+        if size > self._max_size // 4:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, size, time.monotonic() + self._ttl)
+        self._size += size
+
+        while len(self._entries) > self._max_entries or self._size > self._max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
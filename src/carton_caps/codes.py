@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import math
+import secrets
+import sqlite3
+import time
+from dataclasses import dataclass
+
+import aiosqlite
+
+from carton_caps.connection import connect, run_sync
+
+# Referral codes are typed in by hand, so letters and digits that are easily
+# confused (I and 1, O and 0) are left out.
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+CODE_LENGTH = 8
+
+
+def new_referral_code() -> str:
+    """Returns a random referral code. There are 32⁸ of them, so collisions are rare but possible."""
+    return "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+class BloomFilter:
+    """
+    A fixed size set of strings that may report false positives, but never false negatives.
+
+    Sized for `capacity` items at a false positive rate of `error_rate`. Adding
+    more items than that keeps working, with a rising false positive rate.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self._bit_count = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hash_count = max(1, round(self._bit_count / capacity * math.log(2)))
+        self._bits = bytearray((self._bit_count + 7) // 8)
+        self._count = 0
+
+    def _positions(self, item: str) -> list[int]:
+        # Two independent hashes combined give as many as needed (Kirsch and Mitzenmacher).
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8])
+        h2 = int.from_bytes(digest[8:]) | 1
+        return [(h1 + i * h2) % self._bit_count for i in range(self._hash_count)]
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def size(self) -> int:
+        """The number of bytes the filter's bits occupy."""
+        return len(self._bits)
+
+
+@dataclass
+class CodeIndexStats:
+    """A point-in-time snapshot of code index usage."""
+
+    codes: int
+    capacity: int
+    size: int
+    lookups: int
+    rejected: int
+    refreshes: int
+    reloads: int
+
+
+def _build_filter(conn: sqlite3.Connection, min_capacity: int, error_rate: float) -> tuple[BloomFilter, int]:
+    """
+    Builds a filter holding every referral code, with room for as many again.
+
+    Returns the filter and the highest user id it covers. The codes are read
+    in one transaction so that the two agree.
+    """
+    conn.execute("BEGIN")
+    try:
+        count, last_id = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM users").fetchone()
+        bloom = BloomFilter(max(min_capacity, count * 2), error_rate)
+        for (code,) in conn.execute("SELECT referral_code FROM users"):
+            bloom.add(code)
+    finally:
+        conn.execute("COMMIT")
+    return bloom, last_id
+
+
+def _select_codes_after(conn: sqlite3.Connection, after_id: int) -> list[tuple[int, str]]:
+    """Selects the id and referral code of every user created after the given id."""
+    return conn.execute("SELECT id, referral_code FROM users WHERE id > ? ORDER BY id", (after_id,)).fetchall()
+
+
+class ReferralCodeIndex:
+    """
+    An in-memory Bloom filter over every referral code, used to turn away invalid codes without a query.
+
+    A code the filter doesn't contain is certainly invalid. One it does contain
+    is probably valid, and still has to be looked up. The filter is loaded by
+    `load()`, and codes are added to it as users are created. Until it is
+    loaded, every code may be valid.
+
+    Users created by another process (a CLI import, another server worker)
+    aren't added, so when a code is missing from a filter that hasn't been
+    refreshed in `refresh_interval` seconds, the codes of users created since
+    the last refresh are read before the code is turned away. This costs at
+    most one query per interval, however many invalid codes arrive.
+    """
+
+    def __init__(self, path: str, refresh_interval: float = 5.0, error_rate: float = 0.01, min_capacity: int = 1024):
+        self._path = path
+        self._refresh_interval = refresh_interval
+        self._error_rate = error_rate
+        self._min_capacity = min_capacity
+        self._conn: aiosqlite.Connection | None = None
+        self._bloom = BloomFilter(min_capacity, error_rate)
+        self._last_id = 0
+        self._refreshed_at = 0.0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        # Codes added while a reload is reading the database, to be added to the new filter too.
+        self._added_during_reload: list[str] | None = None
+
+        self._lookups = 0
+        self._rejected = 0
+        self._refreshes = 0
+        self._reloads = 0
+
+    async def open(self, load: bool = True) -> None:
+        """
+        Opens the index's connection and, unless `load` is False, loads every referral code.
+
+        Loading takes a while on a large database, so a server opens the index
+        without loading it, and loads it once it is serving.
+        """
+        self._conn = await connect(self._path)
+        if load:
+            await self.load()
+
+    async def load(self) -> None:
+        """Loads every referral code."""
+        await self._reload()
+        self._loaded = True
+
+    async def close(self) -> None:
+        """Closes the index's connection."""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    def add(self, code: str) -> None:
+        """Adds a code to the index. Adding a code that doesn't end up being created is harmless."""
+        self._bloom.add(code)
+        if self._added_during_reload is not None:
+            self._added_during_reload.append(code)
+
+    async def might_contain(self, code: str) -> bool:
+        """Returns False if the code is certainly not a referral code, or True if it may be one."""
+        self._lookups += 1
+        if not self._loaded or code in self._bloom:
+            return True
+        if time.monotonic() - self._refreshed_at >= self._refresh_interval:
+            await self.refresh()
+            if code in self._bloom:
+                return True
+        self._rejected += 1
+        return False
+
+    async def refresh(self) -> None:
+        """
+        Adds the codes of users created since the last refresh.
+
+        Once the filter holds more codes than it was sized for, and so gives
+        more false positives, it is rebuilt from scratch with room to grow.
+        """
+        async with self._lock:
+            if time.monotonic() - self._refreshed_at < self._refresh_interval:
+                # Someone else refreshed while we waited for the lock.
+                return
+            if len(self._bloom) > self._bloom.capacity:
+                await self._reload()
+                return
+            assert self._conn is not None
+            rows = await run_sync(self._conn, _select_codes_after, self._last_id)
+            for user_id, code in rows:
+                self._bloom.add(code)
+                self._last_id = user_id
+            self._refreshed_at = time.monotonic()
+            self._refreshes += 1
+
+    async def _reload(self) -> None:
+        assert self._conn is not None
+        self._added_during_reload = []
+        try:
+            # Built on the connection's thread, so a large load doesn't stall the event loop.
+            bloom, last_id = await run_sync(self._conn, _build_filter, self._min_capacity, self._error_rate)
+            for code in self._added_during_reload:
+                bloom.add(code)
+        finally:
+            self._added_during_reload = None
+        self._bloom, self._last_id = bloom, last_id
+        self._refreshed_at = time.monotonic()
+        self._reloads += 1
+
+    def stats(self) -> CodeIndexStats:
+        """Returns a snapshot of the index's size and how many lookups it has turned away."""
+        return CodeIndexStats(
+            codes=len(self._bloom),
+            capacity=self._bloom.capacity,
+            size=self._bloom.size,
+            lookups=self._lookups,
+            rejected=self._rejected,
+            refreshes=self._refreshes,
+            reloads=self._reloads,
+        )
@@ -0,0 +1,98 @@
+import zlib
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Protocol
+
+from werkzeug.datastructures import Accept
+
+try:
+    # brotli and zstandard are optional dependencies (pip install
+    # carton-caps[compression]). Without them, only gzip is offered.
+    import brotli  # pyright: ignore[reportMissingImports]
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # pyright: ignore[reportMissingImports]
+except ImportError:
+    zstandard = None
+
+# Responses are compressed as they are served, so each encoding runs at a
+# level that favours speed over the last few percent of size. See
+# benchmarks/compression.py.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+# Content types worth compressing. Everything the app serves is one of these.
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/msgpack",
+    "application/x-msgpack",
+    "application/x-ndjson",
+    "text/csv",
+    "text/plain",
+}
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class _BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)  # pyright: ignore[reportOptionalMemberAccess]
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def _gzip_compressor() -> Compressor:
+    # wbits=31 writes a gzip header and trailer, with no timestamp, so the
+    # same body always compresses to the same bytes.
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _zstd_compressor() -> Compressor:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()  # pyright: ignore[reportOptionalMemberAccess]
+
+
+# The encodings on offer, in order of preference when a client accepts more
+# than one equally: zstd and brotli are both faster and smaller than gzip.
+ENCODINGS: dict[str, Callable[[], Compressor]] = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = _zstd_compressor
+if brotli is not None:
+    ENCODINGS["br"] = _BrotliCompressor
+ENCODINGS["gzip"] = _gzip_compressor
+
+
+def choose_encoding(accept_encodings: Accept) -> str | None:
+    """Returns the encoding to compress a response with, given the client's Accept-Encoding, or None for none."""
+    return accept_encodings.best_match(list(ENCODINGS))
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compresses a complete body with one of the available encodings."""
+    compressor = ENCODINGS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+async def compress_stream(chunks: AsyncGenerator[bytes, None], encoding: str) -> AsyncGenerator[bytes, None]:
+    """
+    Compresses a body as it is produced, a chunk at a time.
+
+    Compressed output is passed on as soon as the compressor emits it, so the
+    body is never held in memory. `chunks` is closed when the compressed
+    stream is, so that it can clean up even if the client goes away.
+    """
+    compressor = ENCODINGS[encoding]()
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            if compressed := compressor.compress(chunk):
+                yield compressed
+    yield compressor.flush()
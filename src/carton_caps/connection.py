@@ -0,0 +1,67 @@
+import sqlite3
+from typing import Any, Callable, TypeVar
+
+import aiosqlite
+
+T = TypeVar("T")
+
+# Applied to every connection as it is opened.
+PRAGMAS = {
+    # Readers don't block the writer, and the writer doesn't block readers.
+    "journal_mode": "WAL",
+    # In WAL mode this is still safe against corruption, and only syncs at checkpoints.
+    "synchronous": "NORMAL",
+    # Wait for locks rather than failing immediately with SQLITE_BUSY.
+    "busy_timeout": 5000,
+    # A 64 MiB page cache (negative values are in KiB).
+    "cache_size": -65536,
+    # Read through a 256 MiB memory map rather than read() calls.
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+
+# Each connection keeps this many compiled statements, keyed by their SQL, so
+# a statement it has run before skips parsing and planning. The app runs about
+# 60 fixed statements, and up to 60 more for the variants of the filtered and
+# descending referral listings, so Python's default of 128 would start
+# evicting statements it is about to run again.
+STATEMENT_CACHE_SIZE = 256
+
+
+def apply_pragmas(conn: sqlite3.Connection) -> None:
+    """Applies PRAGMAS to a connection."""
+    for name, value in PRAGMAS.items():
+        # Some pragmas return a row, which has to be read for the statement to finish.
+        conn.execute(f"PRAGMA {name} = {value}").fetchall()
+
+
+async def connect(path: str, **kwargs) -> aiosqlite.Connection:
+    """Opens a new aiosqlite connection configured the way the rest of the app expects."""
+    conn = await aiosqlite.connect(path, cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    conn.row_factory = aiosqlite.Row
+    await run_sync(conn, apply_pragmas)
+    return conn
+
+
+async def run_sync(conn: aiosqlite.Connection, fn: Callable[..., T], *args: Any) -> T:
+    """
+    Runs `fn(sqlite3_conn, *args)` on the connection's worker thread.
+
+    Every awaited aiosqlite call is a round trip to the worker thread. Running
+    a plain function there instead lets several statements execute in a
+    single hop.
+    """
+    return await conn._execute(fn, conn._conn, *args)
+
+
+def run_in_transaction(conn: sqlite3.Connection, fn: Callable[[sqlite3.Connection], T]) -> T:
+    """Runs `fn` inside its own write transaction, committing on success and rolling back on failure."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
@@ -1,10 +1,51 @@
+import asyncio
+import json
+import sqlite3
+import time
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
-from datetime import datetime, UTC
+from datetime import datetime
+from itertools import batched, groupby
+from typing import Any, AsyncGenerator, Callable, Iterable, Iterator, TypeVar
 
 import aiosqlite
 
+from carton_caps.cache import Cache
+from carton_caps.codes import ReferralCodeIndex, new_referral_code
+from carton_caps.connection import connect, run_in_transaction, run_sync
+from carton_caps.events import EventBus, ReferralEvent
+from carton_caps.metrics import Metrics, run_query
+from carton_caps.migrations import get_schema_version, migrate
+from carton_caps.pool import ConnectionPool
+from carton_caps.signals import HOLD_SCORE, SIGNAL_WEIGHTS, SignupSignals
+from carton_caps.timestamps import iso_sql, now_microseconds, to_iso, to_microseconds
+from carton_caps.writer import Writer
 
-@dataclass
+T = TypeVar("T")
+
+# The statuses a referral can be in. Each is stored as its position here,
+# which the referral_statuses table records too.
+REFERRAL_STATUSES = ("pending", "confirmed", "held")
+_STATUS_CODES = {status: code for code, status in enumerate(REFERRAL_STATUSES)}
+
+
+def _status_code(status: str) -> int:
+    """Returns the code a status is stored as. Raises ValueError if it isn't a referral status."""
+    try:
+        return _STATUS_CODES[status]
+    except KeyError:
+        raise ValueError(f"Unknown referral status: {status}") from None
+
+
+class ConflictError(Exception):
+    """Raised when a write would duplicate something that must be unique, such as a user's name."""
+
+
+class InvalidReferralCodeError(Exception):
+    """Raised when a user signs up with a referral code that doesn't belong to anyone."""
+
+
+@dataclass(slots=True, frozen=True)
 class User:
     """Represents a user in the system."""
 
@@ -14,7 +55,7 @@ class User:
     referral_code: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ReferralUser:
     """Represents a simplified user for the context of a referral."""
 
@@ -23,7 +64,7 @@ class ReferralUser:
     avatar_url: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Referral:
     """Represents a referral relationship between two users."""
 
@@ -33,6 +74,75 @@ class Referral:
     created_at: str
 
 
+@dataclass(slots=True, frozen=True)
+class Relative:
+    """A user in another user's upline or downline, `depth` referrals away from them."""
+
+    user: ReferralUser
+    depth: int
+    referred_by: int | None
+
+
+@dataclass(slots=True, frozen=True)
+class Signup:
+    """A newly signed up user, and the referral that brought them in, if there was one."""
+
+    user: User
+    referral: Referral | None
+    referred_by: int | None
+
+
+@dataclass(slots=True, frozen=True)
+class ReferralStats:
+    """How many referrals a user has made in each status, and the referral version they were read at."""
+
+    counts: dict[str, int]
+    version: int
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+@dataclass(slots=True, frozen=True)
+class CountDrift:
+    """A referral count that didn't match the referrals it counts."""
+
+    user_id: int
+    status: str
+    stored: int
+    actual: int
+
+
+@dataclass(slots=True, frozen=True)
+class ReferralFilter:
+    """Narrows a referral listing to one status, and to referrals created at or after `since` and before `until`."""
+
+    status: str | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+
+
+@dataclass(slots=True, frozen=True)
+class NewUser:
+    """A user to be created in bulk. The id is assigned by the database if it isn't given."""
+
+    name: str
+    referral_code: str
+    id: int | None = None
+
+
+@dataclass(slots=True, frozen=True)
+class NewReferral:
+    """A referral to be created in bulk. created_at defaults to now if it isn't given."""
+
+    source_user_id: int
+    target_user_id: int
+    status: str
+    created_at: str | None = None
+    id: int | None = None
+
+
 def _make_user(row: aiosqlite.Row) -> User:
     """Creates a User from a database row."""
     return User(
@@ -52,152 +162,1246 @@ def _make_referral(row: aiosqlite.Row) -> Referral:
             name=row["name"],
             avatar_url="https://place-hold.it/64x64",
         ),
-        status=row["status"],
-        created_at=row["created_at"],
+        status=REFERRAL_STATUSES[row["status"]],
+        created_at=to_iso(row["created_at"]),
+    )
+
+
+def _make_relative(row: aiosqlite.Row) -> Relative:
+    """Creates a Relative from a database row."""
+    return Relative(
+        user=ReferralUser(
+            id=row["user_id"],
+            name=row["name"],
+            avatar_url="https://place-hold.it/64x64",
+        ),
+        depth=row["depth"],
+        referred_by=row["referred_by"],
     )
 
 
+# Stands in for an unbounded depth, so that depth limits can always be bound
+# as a parameter.
+_MAX_DEPTH = 2**63 - 1
+
+# Stands in for an unbounded id, so that a descending listing or an export can
+# always be bound an id to stop at.
+_MAX_ID = 2**63 - 1
+
+
+def _referral_listing_conditions(filter: ReferralFilter | None, after: int | None, descending: bool) -> str:
+    """
+    Builds the WHERE clause of a user's referral listing, with a condition for each filter that is set.
+
+    Each combination of filters is its own statement, rather than one with
+    conditions that are switched off by NULL parameters, so that SQLite can
+    plan it around the index that suits it.
+    """
+    conditions = ["r.source_user_id = :source_id"]
+    comparison = "<" if descending else ">"
+    if filter is None:
+        conditions.append(f"r.id {comparison} :after")
+        return " AND ".join(conditions)
+    if filter.status is not None:
+        conditions.append("r.status = :status")
+    if filter.since is not None:
+        conditions.append("r.created_at >= :since")
+    if filter.until is not None:
+        conditions.append("r.created_at < :until")
+    if after is not None:
+        # Filtered listings are in creation order, so the page starts after
+        # the cursor's creation time, with its id breaking ties.
+        conditions.append(f"(r.created_at, r.id) {comparison} (SELECT created_at, id FROM referrals WHERE id = :after)")
+    return " AND ".join(conditions)
+
+
+def _referral_listing_order(filter: ReferralFilter | None, descending: bool) -> str:
+    """
+    Builds the ORDER BY clause of a user's referral listing.
+
+    Unfiltered listings are ordered by id, as the (source_user_id, id) index
+    has them. Filtered listings are ordered by creation time, then id, as the
+    (source_user_id, status, created_at) index has them for each status, so a
+    page filtered by status is read from that index in order and the read
+    stops at the end of the page. Ids are assigned in creation order, so the
+    two orders only differ for referrals imported with their own times.
+    """
+    direction = " DESC" if descending else ""
+    if filter is None:
+        return f"r.id{direction}"
+    return f"r.created_at{direction}, r.id{direction}"
+
+
+def _referral_listing_sql(
+    filter: ReferralFilter | None = None, after: int | None = None, descending: bool = False
+) -> str:
+    """Builds the query for a page of a user's referrals."""
+    return f"""
+    SELECT
+        r.id,
+        u.id as user_id,
+        u.name,
+        r.status,
+        r.created_at
+    FROM referrals r
+    JOIN users u ON r.target_user_id = u.id
+    WHERE {_referral_listing_conditions(filter, after, descending)}
+    ORDER BY {_referral_listing_order(filter, descending)}
+    LIMIT :limit
+"""
+
+
+_REFERRALS_BY_SOURCE_SQL = _referral_listing_sql()
+
+
+def _referral_listing_params(
+    source_id: int,
+    after: int | None,
+    limit: int | None,
+    filter: ReferralFilter | None = None,
+    descending: bool = False,
+) -> dict[str, Any]:
+    """Builds the parameters for _referral_listing_sql. Ids start at 1, and a negative LIMIT means no limit."""
+    params: dict[str, Any] = {"source_id": source_id, "limit": -1 if limit is None else limit}
+    if filter is None:
+        params["after"] = after if after is not None else (_MAX_ID if descending else 0)
+        return params
+    if after is not None:
+        params["after"] = after
+    if filter.status is not None:
+        params["status"] = _status_code(filter.status)
+    if filter.since is not None:
+        params["since"] = to_microseconds(filter.since)
+    if filter.until is not None:
+        params["until"] = to_microseconds(filter.until)
+    return params
+
+
+def _select_referral_page(
+    conn: sqlite3.Connection,
+    source_id: int,
+    after: int | None = None,
+    limit: int | None = None,
+    filter: ReferralFilter | None = None,
+    descending: bool = False,
+    metrics: Metrics | None = None,
+) -> tuple[int, list[Referral]] | None:
+    """
+    Selects a user's referral version along with a page of their referrals, or None if the user doesn't exist.
+
+    Both are read in the same transaction so that the page is the one the
+    version describes.
+    """
+    conn.execute("BEGIN")
+    try:
+        versions = run_query(
+            conn, metrics, "get_referral_version", "SELECT referral_version FROM users WHERE id = ?", (source_id,)
+        )
+        if not versions:
+            return None
+        rows = run_query(
+            conn,
+            metrics,
+            "get_referrals_by_source_id",
+            _referral_listing_sql(filter, after, descending),
+            _referral_listing_params(source_id, after, limit, filter, descending),
+        )
+    finally:
+        conn.execute("COMMIT")
+    return versions[0][0], [_make_referral(row) for row in rows]
+
+
+def _slice_referrals(
+    referrals: list[Referral], after: int | None, limit: int | None, descending: bool
+) -> list[Referral]:
+    """Slices a page out of a user's full list of referrals, ordered by id, as the listing query would read it."""
+    if descending:
+        end = len(referrals) if after is None else bisect_left(referrals, after, key=lambda referral: referral.id)
+        start = 0 if limit is None else max(0, end - limit)
+        return referrals[start:end][::-1]
+    start = bisect_right(referrals, after or 0, key=lambda referral: referral.id)
+    return referrals[start:] if limit is None else referrals[start : start + limit]
+
+
+def _select_referrals_by_source_ids(
+    conn: sqlite3.Connection, source_ids: list[int], metrics: Metrics | None = None
+) -> dict[int, list[Referral] | None]:
+    """
+    Selects the referrals of many users in two queries, regardless of how many users there are.
+
+    The ids are passed as a single JSON array parameter, so there is no limit
+    on how many can be bound. Both queries run in one transaction so the
+    users and referrals agree with each other.
+    """
+    ids = json.dumps(source_ids)
+    conn.execute("BEGIN")
+    try:
+        users = run_query(
+            conn,
+            metrics,
+            "get_users_by_ids",
+            "SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?))",
+            (ids,),
+        )
+        found = {row[0] for row in users}
+        rows = run_query(
+            conn,
+            metrics,
+            "get_referrals_by_source_ids",
+            """
+            SELECT
+                r.source_user_id,
+                r.id,
+                u.id as user_id,
+                u.name,
+                r.status,
+                r.created_at
+            FROM referrals r
+            JOIN users u ON r.target_user_id = u.id
+            WHERE r.source_user_id IN (SELECT value FROM json_each(?))
+            ORDER BY r.source_user_id, r.id
+            """,
+            (ids,),
+        )
+    finally:
+        conn.execute("COMMIT")
+
+    # Rows arrive grouped by source user, so they can be split up in one pass.
+    results: dict[int, list[Referral] | None] = {
+        source_id: [] if source_id in found else None for source_id in source_ids
+    }
+    for source_id, group in groupby(rows, key=lambda row: row["source_user_id"]):
+        results[source_id] = [_make_referral(row) for row in group]
+    return results
+
+
+def _reconcile_referral_counts(conn: sqlite3.Connection, fix: bool) -> list[CountDrift]:
+    """
+    Compares the referral counts with a fresh count of the referrals, and rebuilds them if `fix` is set.
+
+    This runs as a write job, so no referral can be written between the
+    comparison and the rebuild.
+    """
+    rows = conn.execute(
+        """
+        SELECT user_id, status, SUM(stored), SUM(actual)
+        FROM (
+            SELECT user_id, status, count as stored, 0 as actual FROM referral_counts
+            UNION ALL
+            SELECT source_user_id, status, 0, COUNT(*) FROM referrals GROUP BY source_user_id, status
+        )
+        GROUP BY user_id, status
+        HAVING SUM(stored) != SUM(actual)
+        ORDER BY user_id, status
+        """
+    ).fetchall()
+
+    if fix and rows:
+        conn.execute("DELETE FROM referral_counts")
+        conn.execute(
+            """
+            INSERT INTO referral_counts (user_id, status, count)
+            SELECT source_user_id, status, COUNT(*) FROM referrals GROUP BY source_user_id, status
+            """
+        )
+
+    return [CountDrift(user_id=row[0], status=REFERRAL_STATUSES[row[1]], stored=row[2], actual=row[3]) for row in rows]
+
+
+def _fetch_returning(conn: sqlite3.Connection, sql: str, parameters: tuple) -> sqlite3.Row | None:
+    """
+    Executes a statement with a RETURNING clause and returns the first row.
+
+    The statement has to be stepped to completion, otherwise it is left in
+    progress and blocks the savepoint that follows it in a write batch.
+    """
+    rows = conn.execute(sql, parameters).fetchall()
+    return rows[0] if rows else None
+
+
+def _insert_user(conn: sqlite3.Connection, name: str, referral_code: str) -> User:
+    """Inserts a user and returns it, using RETURNING to avoid a second query."""
+    row = _fetch_returning(
+        conn,
+        "INSERT INTO users (name, referral_code) VALUES (?, ?) RETURNING id, name, referral_code",
+        (name, referral_code),
+    )
+
+    if row is None:
+        raise RuntimeError("Failed to create or retrieve user after insertion.")
+
+    return _make_user(row)
+
+
+def _insert_referral(conn: sqlite3.Connection, source_user_id: int, target_user_id: int, status: str) -> Referral:
+    """Inserts a referral and returns it, using RETURNING to avoid a second query."""
+    row = _fetch_returning(
+        conn,
+        """
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (?, ?, ?, ?)
+        RETURNING
+            id,
+            target_user_id as user_id,
+            (SELECT name FROM users WHERE id = target_user_id) as name,
+            status,
+            created_at
+        """,
+        (source_user_id, target_user_id, now_microseconds(), _status_code(status)),
+    )
+
+    if row is None or row["name"] is None:
+        raise RuntimeError("Failed to create or retrieve referral after insertion.")
+
+    return _make_referral(row)
+
+
+def _select_referral_version(conn: sqlite3.Connection, user_id: int) -> int:
+    """Reads a user's referral version inside a write job, as it stands once the job's changes are made."""
+    return conn.execute("SELECT referral_version FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+
+
+# How many times a signup draws a new referral code after colliding with an existing one.
+_CODE_ATTEMPTS = 5
+
+
+def _insert_user_with_new_code(conn: sqlite3.Connection, name: str) -> User:
+    """Inserts a user with a random referral code, drawing another if it is already taken."""
+    attempts = 1
+    while True:
+        try:
+            return _insert_user(conn, name, new_referral_code())
+        except sqlite3.IntegrityError as e:
+            if "users.name" in str(e):
+                raise ConflictError(f"A user named {name} already exists") from e
+            if "users.referral_code" not in str(e) or attempts == _CODE_ATTEMPTS:
+                raise
+            attempts += 1
+
+
+# The most recent holders of a signal that are checked against a referrer's
+# tree. A signal shared by more users than this, such as a busy carrier's IP
+# prefix, says little on its own, and checking them all would blow the
+# latency budget of a signup.
+_SIGNAL_HOLDERS_CHECKED = 1000
+
+# Whether any of the latest holders of a signal is the referrer, or in their
+# upline or downline. Both closure lookups go through the descendant index,
+# so they scan users' (short) uplines: each holder's, to find the referrer in
+# it, rather than the referrer's (possibly huge) downline, and the referrer's
+# once.
+_SIGNAL_IN_TREE_SQL = """
+    SELECT EXISTS (
+        SELECT 1 FROM (
+            SELECT user_id FROM signup_signals
+            WHERE kind = :kind AND value = :value
+            ORDER BY user_id DESC
+            LIMIT :limit
+        ) AS holders
+        WHERE holders.user_id = :referrer
+           OR EXISTS (
+               SELECT 1 FROM referral_paths INDEXED BY referral_paths_descendant_id
+               WHERE descendant_id = holders.user_id AND ancestor_id = :referrer
+           )
+           OR holders.user_id IN (SELECT ancestor_id FROM referral_paths WHERE descendant_id = :referrer)
+    )
+"""
+
+
+def _match_signals(conn: sqlite3.Connection, referrer_id: int, signals: list[tuple[str, bytes]]) -> list[str]:
+    """Returns the kinds of signal that have already been seen in the referrer's tree."""
+    return [
+        kind
+        for kind, value in signals
+        if conn.execute(
+            _SIGNAL_IN_TREE_SQL,
+            {"kind": kind, "value": value, "referrer": referrer_id, "limit": _SIGNAL_HOLDERS_CHECKED},
+        ).fetchone()[0]
+    ]
+
+
+def _signup(
+    conn: sqlite3.Connection, name: str, referred_by_code: str | None, signals: SignupSignals | None = None
+) -> Signup:
+    """
+    Creates a user with a fresh referral code, and the pending referral from whoever referred them.
+
+    Everything happens in the one job, so the user is never created without
+    their referral, nor attributed to a referrer whose code has changed hands.
+
+    The user's signals are recorded too. If enough of them have already been
+    seen in the referrer's tree, the user is probably the referrer (or one of
+    their other accounts) again, and the referral is held instead.
+    """
+    hashed = signals.hashed() if signals is not None else []
+
+    source_user_id = None
+    status = "pending"
+    if referred_by_code is not None:
+        row = conn.execute("SELECT id FROM users WHERE referral_code = ?", (referred_by_code,)).fetchone()
+        if row is None:
+            raise InvalidReferralCodeError(f"Referral code {referred_by_code} not found")
+        source_user_id = row[0]
+        if hashed and sum(SIGNAL_WEIGHTS[kind] for kind in _match_signals(conn, source_user_id, hashed)) >= HOLD_SCORE:
+            status = "held"
+
+    user = _insert_user_with_new_code(conn, name)
+    if hashed:
+        conn.executemany(
+            "INSERT INTO signup_signals (kind, value, user_id) VALUES (?, ?, ?)",
+            [(kind, value, user.id) for kind, value in hashed],
+        )
+
+    referral = None
+    if source_user_id is not None:
+        try:
+            referral = _insert_referral(conn, source_user_id, user.id, status)
+        except sqlite3.IntegrityError as e:
+            if "referrals.target_user_id" in str(e):
+                raise ConflictError(f"User {user.id} has already been referred") from e
+            raise
+
+    return Signup(user=user, referral=referral, referred_by=source_user_id)
+
+
+def _insert_users(conn: sqlite3.Connection, users: list[NewUser], import_name: str | None) -> None:
+    """Inserts a chunk of users with a single executemany."""
+    conn.executemany(
+        "INSERT INTO users (id, name, referral_code) VALUES (?, ?, ?)",
+        [(user.id, user.name, user.referral_code) for user in users],
+    )
+    if import_name is not None:
+        _advance_import(conn, import_name, len(users))
+
+
+def _insert_referrals(conn: sqlite3.Connection, referrals: list[NewReferral], import_name: str | None) -> None:
+    """Inserts a chunk of referrals with a single executemany."""
+    now = now_microseconds()
+    conn.executemany(
+        "INSERT INTO referrals (id, source_user_id, target_user_id, created_at, status) VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                r.id,
+                r.source_user_id,
+                r.target_user_id,
+                to_microseconds(r.created_at) if r.created_at else now,
+                _status_code(r.status),
+            )
+            for r in referrals
+        ],
+    )
+    if import_name is not None:
+        _advance_import(conn, import_name, len(referrals))
+
+
+# Every user, with whoever referred them, and every referral, with both users'
+# names. Rows are read in id order after a watermark, so that an export can
+# pick up where the last one left off, and up to a fixed id, so that rows
+# added while it runs are left for the next one.
+_EXPORT_SQL = {
+    "users": """
+        SELECT u.id, u.name, u.referral_code, r.source_user_id AS referred_by
+        FROM users u
+        LEFT JOIN referrals r ON r.target_user_id = u.id
+        WHERE u.id > ? AND u.id <= ?
+        ORDER BY u.id
+    """,
+    "referrals": f"""
+        SELECT
+            r.id,
+            r.source_user_id,
+            s.name AS source_name,
+            r.target_user_id,
+            t.name AS target_name,
+            st.name AS status,
+            {iso_sql("r.created_at")} AS created_at
+        FROM referrals r
+        JOIN users s ON s.id = r.source_user_id
+        JOIN users t ON t.id = r.target_user_id
+        JOIN referral_statuses st ON st.code = r.status
+        WHERE r.id > ? AND r.id <= ? AND r.created_at >= ?
+        ORDER BY r.id
+    """,
+}
+
+
+# Confirms a referred user's referral, found through the unique index on
+# target_user_id. Only pending referrals are confirmed, so confirming a
+# user again (a replayed event) changes nothing, and held referrals stay
+# held until they are reviewed.
+_CONFIRM_REFERRAL_SQL = (
+    f"UPDATE referrals SET status = {_STATUS_CODES['confirmed']} "
+    f"WHERE target_user_id = ? AND status = {_STATUS_CODES['pending']}"
+)
+
+
+def _confirm_referrals(conn: sqlite3.Connection, target_user_ids: list[int]) -> int:
+    """Confirms the pending referrals of a chunk of referred users with a single executemany, and returns how many."""
+    return conn.executemany(_CONFIRM_REFERRAL_SQL, [(user_id,) for user_id in target_user_ids]).rowcount
+
+
+# The same, returning the confirmed referral, so that it can be published.
+_CONFIRM_REFERRAL_RETURNING_SQL = f"""
+    {_CONFIRM_REFERRAL_SQL}
+    RETURNING
+        id,
+        source_user_id,
+        target_user_id as user_id,
+        (SELECT name FROM users WHERE id = target_user_id) as name,
+        status,
+        created_at
+"""
+
+
+def _confirm_referrals_returning(
+    conn: sqlite3.Connection, target_user_ids: list[int]
+) -> list[tuple[int, int, Referral]]:
+    """
+    Confirms the pending referrals of a chunk of referred users one at a time.
+
+    Returns each confirmed referral with its referrer and their referral
+    version once it was confirmed. A statement returning rows can't be run by
+    executemany, so this is only used when there are subscribers to tell.
+    """
+    confirmed = []
+    for user_id in target_user_ids:
+        row = _fetch_returning(conn, _CONFIRM_REFERRAL_RETURNING_SQL, (user_id,))
+        if row is not None:
+            source_user_id = row["source_user_id"]
+            confirmed.append((source_user_id, _select_referral_version(conn, source_user_id), _make_referral(row)))
+    return confirmed
+
+
+def _advance_import(conn: sqlite3.Connection, import_name: str, rows: int) -> None:
+    """Records that another chunk of an import has been written, in the same transaction as the chunk."""
+    conn.execute(
+        """
+        INSERT INTO import_progress (name, rows) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET rows = rows + excluded.rows
+        """,
+        (import_name, rows),
+    )
+
+
+# Scans of each table and index that requests read from. SQLite memory maps
+# the database, so the pages they read stay in the OS page cache, where every
+# connection (and every server worker) shares them.
+_WARM_UP_SQL = [
+    "SELECT COUNT(referral_version) FROM users NOT INDEXED",
+    "SELECT COUNT(*) FROM users WHERE referral_code >= ''",
+    "SELECT COUNT(created_at) FROM referrals INDEXED BY referrals_source_user_id",
+    "SELECT COUNT(created_at) FROM referrals INDEXED BY referrals_source_user_id_status_created_at",
+    "SELECT COUNT(count) FROM referral_counts",
+    "SELECT COUNT(depth) FROM referral_paths WHERE ancestor_id >= 0",
+    "SELECT COUNT(depth) FROM referral_paths INDEXED BY referral_paths_descendant_id",
+]
+
+
+def _warm_up(conn: sqlite3.Connection) -> None:
+    for sql in _WARM_UP_SQL:
+        conn.execute(sql).fetchall()
+
+
 class Database:
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        pool: ConnectionPool | None = None,
+        writer: Writer | None = None,
+        cache: Cache | None = None,
+        codes: ReferralCodeIndex | None = None,
+        metrics: Metrics | None = None,
+        events: EventBus | None = None,
+    ):
         self._path = path
+        self._pool = pool
+        self._writer = writer
+        self._cache = cache
+        self._codes = codes
+        self._metrics = metrics
+        self._events = events
         self._conn = None
 
     async def get_conn(self) -> aiosqlite.Connection:
-        """Returns the database connection, creating it if it doesn't exist."""
+        """
+        Returns the database connection, creating it if it doesn't exist.
+
+        If a pool was provided the connection is leased from it, otherwise a
+        dedicated connection is opened.
+        """
         if not self._conn:
-            self._conn = await aiosqlite.connect(self._path)
-            self._conn.row_factory = aiosqlite.Row
+            if self._pool is not None:
+                self._conn = await self._pool.acquire()
+            else:
+                self._conn = await connect(self._path)
         return self._conn
 
     async def close(self) -> None:
-        """Closes the database connection."""
+        """Closes the database connection, or returns it to the pool it was leased from."""
         if self._conn is not None:
-            await self._conn.close()
+            if self._pool is not None:
+                await self._pool.release(self._conn)
+            else:
+                await self._conn.close()
             self._conn = None
 
+    async def _fetchall(self, name: str, sql: str, parameters: Any = ()) -> list[sqlite3.Row]:
+        """
+        Runs a read query and returns all of its rows, recording it in the metrics under `name`.
+
+        The query is executed and read in a single trip to the connection's thread.
+        """
+        conn = await self.get_conn()
+        return await run_sync(conn, run_query, self._metrics, name, sql, parameters)
+
+    async def _write(self, name: str, job: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Runs a write job, recording how long it took to commit in the metrics under `name`.
+
+        If a writer was provided the job is handed to it, to be group committed
+        with any other pending writes. Otherwise it runs in its own transaction
+        on this instance's connection.
+        """
+        started = time.perf_counter()
+        try:
+            if self._writer is not None:
+                return await self._writer.submit(job)
+            conn = await self.get_conn()
+            return await run_sync(conn, run_in_transaction, job)
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe_write(name, time.perf_counter() - started)
+
     async def get_user_by_id(self, user_id: int) -> User | None:
         """Retrieves a single user by their id."""
+        if self._cache is not None:
+            return await self._cache.get_or_load(("user", user_id), lambda: self._fetch_user_by_id(user_id))
+        return await self._fetch_user_by_id(user_id)
+
+    async def _fetch_user_by_id(self, user_id: int) -> User | None:
+        rows = await self._fetchall("get_user_by_id", "SELECT * FROM users WHERE id = ?", (user_id,))
+        return _make_user(rows[0]) if rows else None
+
+    async def resolve_referral_code(self, referral_code: str) -> User | None:
+        """
+        Retrieves the user a referral code belongs to, or None if it isn't a valid code.
+
+        If a code index was provided, codes it doesn't contain are turned away
+        without querying the database.
+        """
+        if self._codes is not None and not await self._codes.might_contain(referral_code):
+            return None
+        if self._cache is not None:
+            return await self._cache.get_or_load(
+                ("code", referral_code), lambda: self._fetch_user_by_referral_code(referral_code)
+            )
+        return await self._fetch_user_by_referral_code(referral_code)
+
+    async def _fetch_user_by_referral_code(self, referral_code: str) -> User | None:
+        rows = await self._fetchall(
+            "resolve_referral_code", "SELECT * FROM users WHERE referral_code = ?", (referral_code,)
+        )
+        return _make_user(rows[0]) if rows else None
+
+    async def get_referral_version(self, user_id: int) -> int | None:
+        """
+        Returns the version of a user's referrals, or None if the user doesn't exist.
+
+        The version changes whenever any of the user's referrals are created,
+        updated or deleted.
+        """
+        rows = await self._fetchall(
+            "get_referral_version", "SELECT referral_version FROM users WHERE id = ?", (user_id,)
+        )
+        return rows[0][0] if rows else None
+
+    async def get_referral_stats(self, user_id: int) -> ReferralStats | None:
+        """
+        Returns how many referrals a user has made in each status, or None if the user doesn't exist.
+
+        The counts are kept current by triggers, so this reads only the user's
+        own rows rather than counting their referrals.
+        """
+        rows = await self._fetchall(
+            "get_referral_stats",
+            """
+            SELECT u.referral_version, c.status, c.count
+            FROM users u
+            LEFT JOIN referral_counts c ON c.user_id = u.id
+            WHERE u.id = ?
+            """,
+            (user_id,),
+        )
+        if not rows:
+            return None
+        return ReferralStats(
+            counts={REFERRAL_STATUSES[row["status"]]: row["count"] for row in rows if row["status"] is not None},
+            version=rows[0]["referral_version"],
+        )
+
+    async def get_referrals_by_source_id(
+        self,
+        source_id: int,
+        after: int | None = None,
+        limit: int | None = None,
+        min_version: int | None = None,
+        filter: ReferralFilter | None = None,
+        descending: bool = False,
+    ) -> list[Referral]:
+        """
+        Retrieves referrals initiated by a specific user, ordered by id, or by id descending.
+
+        Pass the id of the last referral seen as `after` to fetch the next
+        page (keyset pagination), and `limit` to bound the page size. A
+        `filter` narrows the list to a status and a range of creation times,
+        and orders it by creation time, then id.
+
+        If a cache was provided, a user's full list of referrals is cached, and
+        unfiltered pages are sliced from it when it is cached already. A cached
+        list older than `min_version` is reloaded, which catches writes made
+        by other processes that this cache wasn't told about. Filtered pages
+        are always read from the database, where an index answers them.
+        """
+        if self._cache is None or filter is not None:
+            return await self._fetch_referrals_by_source_id(source_id, after, limit, filter, descending)
+
+        key = ("referrals", source_id)
+        listing = self._cache.get(key)
+        if listing is not None and min_version is not None and listing[0] < min_version:
+            self._cache.invalidate(key)
+            listing = None
+
+        if listing is None:
+            if after is not None or limit is not None:
+                # Only full lists are cached, so don't load one to serve a single page.
+                return await self._fetch_referrals_by_source_id(source_id, after, limit, descending=descending)
+            listing = await self._load_referral_listing(key, source_id)
+            if listing is None:
+                return []
+
+        return _slice_referrals(listing[1], after, limit, descending)
+
+    async def get_referral_page(
+        self,
+        source_id: int,
+        after: int | None = None,
+        limit: int | None = None,
+        filter: ReferralFilter | None = None,
+        descending: bool = False,
+    ) -> tuple[int, list[Referral]] | None:
+        """
+        Retrieves a user's referral version along with a page of their referrals, or None if the user doesn't exist.
+
+        This is `get_referral_version` and `get_referrals_by_source_id` in one,
+        read in a single trip to the connection's thread rather than two. A
+        page sliced from a cached list still reads the version, to check that
+        the list is current.
+        """
+        if self._cache is not None and filter is None:
+            key = ("referrals", source_id)
+            listing = self._cache.get(key)
+            if listing is not None:
+                version = await self.get_referral_version(source_id)
+                if version is None:
+                    return None
+                if listing[0] >= version:
+                    return version, _slice_referrals(listing[1], after, limit, descending)
+                self._cache.invalidate(key)
+            if after is None and limit is None:
+                listing = await self._load_referral_listing(key, source_id)
+                if listing is None:
+                    return None
+                return listing[0], _slice_referrals(listing[1], None, None, descending)
+
+        conn = await self.get_conn()
+        return await run_sync(conn, _select_referral_page, source_id, after, limit, filter, descending, self._metrics)
+
+    async def _fetch_referrals_by_source_id(
+        self,
+        source_id: int,
+        after: int | None = None,
+        limit: int | None = None,
+        filter: ReferralFilter | None = None,
+        descending: bool = False,
+    ) -> list[Referral]:
+        rows = await self._fetchall(
+            "get_referrals_by_source_id",
+            _referral_listing_sql(filter, after, descending),
+            _referral_listing_params(source_id, after, limit, filter, descending),
+        )
+        return [_make_referral(row) for row in rows]
+
+    async def _load_referral_listing(self, key: tuple, source_id: int) -> tuple[int, list[Referral]] | None:
+        """Loads a user's version and full list of referrals into the cache, or returns None if the user doesn't exist."""
+        assert self._cache is not None
+
+        async def load() -> tuple[int, list[Referral]] | None:
+            conn = await self.get_conn()
+            return await run_sync(conn, _select_referral_page, source_id, None, None, None, False, self._metrics)
+
+        listing = await self._cache.get_or_load(key, load)
+        if listing is None:
+            # Creating a user doesn't invalidate their listing, so a missing one mustn't stay cached.
+            self._cache.invalidate(key)
+        return listing
+
+    async def get_referrals_by_source_ids(self, source_ids: list[int]) -> dict[int, list[Referral] | None]:
+        """
+        Retrieves the referrals of many users at once.
+
+        Returns a dictionary keyed by each of the given ids, holding that
+        user's referrals ordered by id, or None if the user doesn't exist.
+        """
         conn = await self.get_conn()
-        async with conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return _make_user(row) if row else None
+        return await run_sync(conn, _select_referrals_by_source_ids, list(dict.fromkeys(source_ids)), self._metrics)
 
-    async def get_referrals_by_source_id(self, source_id: int) -> list[Referral]:
-        """Retrieves all referrals initiated by a specific user."""
+    async def iter_referrals_by_source_id(
+        self,
+        source_id: int,
+        after: int | None = None,
+        limit: int | None = None,
+        filter: ReferralFilter | None = None,
+        descending: bool = False,
+    ) -> AsyncGenerator[Referral, None]:
+        """
+        Iterates over referrals initiated by a specific user, in the order `get_referrals_by_source_id` returns them.
+
+        Unlike `get_referrals_by_source_id`, rows are fetched from the cursor a
+        chunk at a time, so memory use doesn't grow with the number of referrals.
+        """
         conn = await self.get_conn()
-        async with conn.execute(
+        started = time.perf_counter()
+        count = 0
+        try:
+            async with conn.execute(
+                _referral_listing_sql(filter, after, descending),
+                _referral_listing_params(source_id, after, limit, filter, descending),
+            ) as cursor:
+                async for row in cursor:
+                    count += 1
+                    yield _make_referral(row)
+        finally:
+            # The duration includes time spent waiting on the client, so it is
+            # recorded but never logged as a slow query.
+            if self._metrics is not None:
+                self._metrics.observe_query("iter_referrals_by_source_id", time.perf_counter() - started, count)
+
+    async def get_next_referral_cursor(
+        self,
+        source_id: int,
+        after: int | None,
+        limit: int,
+        filter: ReferralFilter | None = None,
+        descending: bool = False,
+    ) -> int | None:
+        """
+        Returns the cursor for the page following the given one, or None if it is the last page.
+
+        This lets a caller emit the next cursor before it has read the page itself.
+        """
+        rows = await self._fetchall(
+            "get_next_referral_cursor",
+            f"""
+            SELECT r.id
+            FROM referrals r
+            WHERE {_referral_listing_conditions(filter, after, descending)}
+            ORDER BY {_referral_listing_order(filter, descending)}
+            LIMIT 2 OFFSET :offset
+            """,
+            {**_referral_listing_params(source_id, after, None, filter, descending), "offset": limit - 1},
+        )
+        # The first row is the last one on this page, the second only exists if there is another page
+        return rows[0]["id"] if len(rows) == 2 else None
+
+    async def get_downline(
+        self,
+        user_id: int,
+        max_depth: int | None = None,
+        after: tuple[int, int] | None = None,
+        limit: int | None = None,
+    ) -> list[Relative]:
+        """
+        Retrieves the users a user referred, directly or indirectly, up to `max_depth` referrals away.
+
+        Users are ordered by depth, then id. Pass the `(depth, id)` of the last
+        user seen as `after` to fetch the next page, and `limit` to bound the
+        page size. This is a range scan of the closure table, however deep the
+        tree is.
+        """
+        after_depth, after_id = after or (0, 0)
+        rows = await self._fetchall(
+            "get_downline",
             """
             SELECT
-                r.id,
+                p.depth,
                 u.id as user_id,
                 u.name,
-                r.status,
-                r.created_at
-            FROM referrals r
-            JOIN users u ON r.target_user_id = u.id
-            WHERE r.source_user_id = ?
+                r.source_user_id as referred_by
+            FROM referral_paths p
+            JOIN users u ON u.id = p.descendant_id
+            JOIN referrals r ON r.target_user_id = p.descendant_id
+            WHERE p.ancestor_id = ? AND p.depth <= ? AND (p.depth, p.descendant_id) > (?, ?)
+            ORDER BY p.depth, p.descendant_id
+            LIMIT ?
             """,
-            (source_id,),
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [_make_referral(row) for row in rows]
+            (user_id, max_depth or _MAX_DEPTH, after_depth, after_id, -1 if limit is None else limit),
+        )
+        return [_make_relative(row) for row in rows]
+
+    async def get_upline(self, user_id: int, max_depth: int | None = None) -> list[Relative]:
+        """
+        Retrieves the chain of users who led to a user joining, up to `max_depth` referrals away.
+
+        The user's referrer comes first and the user at the root of the tree last.
+        """
+        rows = await self._fetchall(
+            "get_upline",
+            """
+            SELECT
+                p.depth,
+                u.id as user_id,
+                u.name,
+                r.source_user_id as referred_by
+            FROM referral_paths p
+            JOIN users u ON u.id = p.ancestor_id
+            LEFT JOIN referrals r ON r.target_user_id = p.ancestor_id
+            WHERE p.descendant_id = ? AND p.depth <= ?
+            ORDER BY p.depth
+            """,
+            (user_id, max_depth or _MAX_DEPTH),
+        )
+        return [_make_relative(row) for row in rows]
+
+    async def get_downline_size(self, user_id: int, max_depth: int | None = None) -> dict[int, int]:
+        """
+        Counts the users in a user's downline, up to `max_depth` referrals away.
+
+        Returns the number of users at each depth, in order of depth. Depths
+        with no users are left out. The count is answered from the closure
+        table's primary key alone.
+        """
+        rows = await self._fetchall(
+            "get_downline_size",
+            """
+            SELECT depth, COUNT(*)
+            FROM referral_paths
+            WHERE ancestor_id = ? AND depth <= ?
+            GROUP BY depth
+            ORDER BY depth
+            """,
+            (user_id, max_depth or _MAX_DEPTH),
+        )
+        return {row[0]: row[1] for row in rows}
 
     async def create_user(self, name: str, referral_code: str) -> User:
         """Creates a new user in the database and returns it."""
-        conn = await self.get_conn()
-        async with conn.execute(
-            "INSERT INTO users (name, referral_code) VALUES (?, ?)",
-            (name, referral_code),
-        ) as cursor:
-            user_id = cursor.lastrowid
-        await conn.commit()
+        user = await self._write("create_user", lambda conn: _insert_user(conn, name, referral_code))
+        # The user may have been looked up, and cached as missing, before they existed.
+        self._invalidate(("user", user.id))
+        self._invalidate(("code", referral_code))
+        if self._codes is not None:
+            self._codes.add(referral_code)
+        return user
+
+    async def signup(
+        self, name: str, referred_by_code: str | None = None, signals: SignupSignals | None = None
+    ) -> Signup:
+        """
+        Signs up a new user, giving them a referral code of their own.
 
-        async with conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
-            new_user = await cursor.fetchone()
+        If `referred_by_code` is given, the pending referral from the user it
+        belongs to is created in the same transaction as the user. It is held
+        instead if the user's `signals` suggest they referred themselves.
+        Raises InvalidReferralCodeError if the code doesn't belong to anyone,
+        and ConflictError if the name is taken.
+        """
+        if referred_by_code is not None and self._codes is not None:
+            # Turn away codes that certainly aren't valid before queueing a write.
+            if not await self._codes.might_contain(referred_by_code):
+                raise InvalidReferralCodeError(f"Referral code {referred_by_code} not found")
+        publish = self._events is not None
 
-        if new_user is None:
-            raise RuntimeError("Failed to create or retrieve user after insertion.")
+        def job(conn: sqlite3.Connection) -> tuple[Signup, int | None]:
+            signup = _signup(conn, name, referred_by_code, signals)
+            if not publish or signup.referred_by is None:
+                return signup, None
+            return signup, _select_referral_version(conn, signup.referred_by)
 
-        return _make_user(new_user)
+        signup, version = await self._write("signup", job)
+        user = signup.user
+        self._invalidate(("user", user.id))
+        self._invalidate(("code", user.referral_code))
+        if signup.referred_by is not None:
+            self._invalidate(("referrals", signup.referred_by))
+        if signup.referred_by is not None and signup.referral is not None and version is not None:
+            self._publish(signup.referred_by, version, "referral.created", signup.referral)
+        if self._codes is not None:
+            self._codes.add(user.referral_code)
+        return signup
 
     async def create_referral(self, source_user_id: int, target_user_id: int, status: str) -> Referral:
         """Creates a new referral in the database and returns it."""
+        publish = self._events is not None
+
+        def job(conn: sqlite3.Connection) -> tuple[Referral, int | None]:
+            referral = _insert_referral(conn, source_user_id, target_user_id, status)
+            return referral, _select_referral_version(conn, source_user_id) if publish else None
+
+        referral, version = await self._write("create_referral", job)
+        self._invalidate(("referrals", source_user_id))
+        if version is not None:
+            self._publish(source_user_id, version, "referral.created", referral)
+        return referral
+
+    async def bulk_create_users(
+        self,
+        users: Iterable[NewUser],
+        chunk_size: int = 10_000,
+        import_name: str | None = None,
+        on_chunk: Callable[[int], None] | None = None,
+    ) -> int:
+        """
+        Creates users in bulk, committing a chunk at a time. Returns the number created.
+
+        `users` is consumed lazily, so it may be a generator over more rows
+        than fit in memory. If `import_name` is given, each chunk also advances
+        that import's progress (see `get_import_progress`) in the same
+        transaction. `on_chunk` is called with the size of each committed chunk.
+        """
+        if self._codes is not None:
+            users = self._add_codes(users)
+        return await self._bulk_write(
+            "bulk_create_users",
+            users,
+            chunk_size,
+            lambda conn, chunk: _insert_users(conn, chunk, import_name),
+            on_chunk,
+        )
+
+    def _add_codes(self, users: Iterable[NewUser]) -> Iterator[NewUser]:
+        """Adds each user's code to the code index as they are read, ahead of them being written."""
+        assert self._codes is not None
+        for user in users:
+            self._codes.add(user.referral_code)
+            yield user
+
+    async def bulk_create_referrals(
+        self,
+        referrals: Iterable[NewReferral],
+        chunk_size: int = 10_000,
+        import_name: str | None = None,
+        on_chunk: Callable[[int], None] | None = None,
+    ) -> int:
+        """
+        Creates referrals in bulk, committing a chunk at a time. Returns the number created.
+
+        See `bulk_create_users` for the arguments.
+        """
+        return await self._bulk_write(
+            "bulk_create_referrals",
+            referrals,
+            chunk_size,
+            lambda conn, chunk: _insert_referrals(conn, chunk, import_name),
+            on_chunk,
+        )
+
+    async def _bulk_write(
+        self,
+        name: str,
+        rows: Iterable[T],
+        chunk_size: int,
+        insert: Callable[[sqlite3.Connection, list[T]], None],
+        on_chunk: Callable[[int], None] | None,
+    ) -> int:
+        total = 0
+        try:
+            for batch in batched(rows, chunk_size):
+                chunk = list(batch)
+                await self._write(name, lambda conn: insert(conn, chunk))
+                total += len(chunk)
+                if on_chunk is not None:
+                    on_chunk(len(chunk))
+        finally:
+            # Bulk writes touch too many entries to invalidate one by one.
+            if self._cache is not None and total:
+                self._cache.clear()
+        return total
+
+    async def confirm_referrals(self, target_user_ids: list[int]) -> int:
+        """
+        Confirms the pending referrals that brought in the given users, in one transaction.
+
+        Returns how many were confirmed. Users who weren't referred, or whose
+        referral isn't pending, are left as they are, so confirming the same
+        users again is harmless. The referral counts and versions are kept
+        current by triggers. If there is an event bus, each confirmed referral
+        is published to its referrer's subscribers as a `referral.updated` event.
+        """
+        if self._events is None:
+            confirmed = await self._write("confirm_referrals", lambda conn: _confirm_referrals(conn, target_user_ids))
+            changes = []
+        else:
+            changes = await self._write(
+                "confirm_referrals", lambda conn: _confirm_referrals_returning(conn, target_user_ids)
+            )
+            confirmed = len(changes)
+        # Like bulk writes, this touches too many entries to invalidate one by one.
+        if self._cache is not None and confirmed:
+            self._cache.clear()
+        for source_user_id, version, referral in changes:
+            self._publish(source_user_id, version, "referral.updated", referral)
+        return confirmed
+
+    async def get_import_progress(self, import_name: str) -> int:
+        """Returns how many rows of an import have been committed."""
+        rows = await self._fetchall(
+            "get_import_progress", "SELECT rows FROM import_progress WHERE name = ?", (import_name,)
+        )
+        return rows[0][0] if rows else 0
+
+    async def reset_import_progress(self, import_name: str) -> None:
+        """Forgets an import's progress, so that it starts again from the beginning."""
+        await self._write(
+            "reset_import_progress",
+            lambda conn: conn.execute("DELETE FROM import_progress WHERE name = ?", (import_name,)),
+        )
+
+    async def reconcile_referral_counts(self, fix: bool = True) -> list[CountDrift]:
+        """
+        Checks the referral counts against the referrals themselves, and returns any that have drifted.
+
+        Drift should only come from writes that bypassed the triggers, such as
+        a restored backup of one table. If `fix` is set, the counts are rebuilt
+        from scratch when any have drifted.
+        """
+        return await self._write("reconcile_referral_counts", lambda conn: _reconcile_referral_counts(conn, fix))
+
+    async def get_export_watermark(self, kind: str) -> int:
+        """Returns the highest id of the given kind of row ("users" or "referrals"), or 0 if there are none."""
+        if kind not in _EXPORT_SQL:
+            raise ValueError(f"Unknown kind of data: {kind}")
+        rows = await self._fetchall("get_export_watermark", f"SELECT COALESCE(MAX(id), 0) FROM {kind}")
+        return rows[0][0]
+
+    async def iter_export(
+        self,
+        kind: str,
+        after_id: int = 0,
+        through_id: int | None = None,
+        since: datetime | None = None,
+        batch_size: int = 1000,
+    ) -> AsyncGenerator[list[sqlite3.Row], None]:
+        """
+        Iterates over every user or referral, with the rows they join to, in batches of up to `batch_size` rows.
+
+        Rows are in id order, after `after_id` and up to `through_id`. Referrals
+        can also be limited to those created at or after `since`. The whole
+        export is read by a single statement, stepped a batch at a time, so
+        it sees the database as it was when it started and memory use doesn't
+        grow with the number of rows.
+        """
+        if kind not in _EXPORT_SQL:
+            raise ValueError(f"Unknown kind of data: {kind}")
+        if since is not None and kind != "referrals":
+            raise ValueError("Only referrals can be exported since a time")
+        parameters: tuple = (after_id, _MAX_ID if through_id is None else through_id)
+        if kind == "referrals":
+            parameters += (to_microseconds(since) if since is not None else 0,)
+
         conn = await self.get_conn()
-        now = datetime.now(UTC).isoformat()
-        async with conn.execute(
-            "INSERT INTO referrals (source_user_id, target_user_id, created_at, status) VALUES (?, ?, ?, ?)",
-            (source_user_id, target_user_id, now, status),
-        ) as cursor:
-            referral_id = cursor.lastrowid
-        await conn.commit()
+        started = time.perf_counter()
+        count = 0
+        try:
+            async with conn.execute(_EXPORT_SQL[kind], parameters) as cursor:
+                # The next batch is read on the connection's thread while the
+                # caller works on this one.
+                next_rows = asyncio.ensure_future(cursor.fetchmany(batch_size))
+                try:
+                    while rows := list(await next_rows):
+                        next_rows = asyncio.ensure_future(cursor.fetchmany(batch_size))
+                        count += len(rows)
+                        yield rows
+                finally:
+                    # If the caller stopped early, let the read in flight finish
+                    # before the cursor is closed.
+                    await asyncio.wait([next_rows])
+        finally:
+            # Like iter_referrals_by_source_id, this includes time spent
+            # waiting on the consumer, so it is never logged as slow.
+            if self._metrics is not None:
+                self._metrics.observe_query(f"export_{kind}", time.perf_counter() - started, count)
 
-        async with conn.execute(
-            """
-            SELECT
-                r.id,
-                u.id as user_id,
-                u.name,
-                r.status,
-                r.created_at
-            FROM referrals r
-            JOIN users u ON r.target_user_id = u.id
-            WHERE r.id = ?
-            """,
-            (referral_id,),
-        ) as cursor:
-            row = await cursor.fetchone()
+    def _invalidate(self, key: tuple) -> None:
+        """Removes an entry that a write has made out of date from the cache, if there is one."""
+        if self._cache is not None:
+            self._cache.invalidate(key)
 
-        if row is None:
-            raise RuntimeError("Failed to create or retrieve referral after insertion.")
+    def _publish(self, user_id: int, version: int, type: str, referral: Referral) -> None:
+        """
+        Tells subscribers to a user's referral events about a committed change, if there is a bus.
 
-        return _make_referral(row)
+        Writes are committed in order and their callers resumed in the same
+        order, so each user's events are published in version order.
+        """
+        if self._events is not None:
+            self._events.publish(ReferralEvent(user_id=user_id, version=version, type=type, referral=referral))
 
-    async def init_db(self) -> None:
-        """Initializes the database schema."""
+    async def init_db(self) -> list[int]:
+        """
+        Initializes the database schema, or migrates an existing database to the
+        current schema version in place. Returns the versions that were applied.
+        """
         conn = await self.get_conn()
+        return await run_sync(conn, migrate)
 
-        await conn.executescript(
-            """
-            DROP TABLE IF EXISTS referrals;
-            DROP TABLE IF EXISTS users;
-
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY,
-                name TEXT(256) NOT NULL UNIQUE,
-                referral_code TEXT(16) NOT NULL UNIQUE
-            );
-
-            CREATE TABLE referrals (
-                id INTEGER PRIMARY KEY,
-                source_user_id INTEGER NOT NULL,
-                target_user_id INTEGER NOT NULL UNIQUE,
-                created_at TEXT NOT NULL,
-                status TEXT NOT NULL,
-                FOREIGN KEY (source_user_id) REFERENCES users(id) ON DELETE RESTRICT,
-                FOREIGN KEY (target_user_id) REFERENCES users(id) ON DELETE RESTRICT
-            );
-            """
-        )
-        await conn.commit()
+    async def get_schema_version(self) -> int:
+        """Returns the schema version of the database, 0 if it has no schema yet."""
+        conn = await self.get_conn()
+        return await run_sync(conn, get_schema_version)
+
+    async def warm_up(self) -> None:
+        """
+        Reads the tables and indexes that requests use through once, so that
+        the first requests after startup don't wait on the disk.
+
+        This isn't recorded in the metrics: on a large database it is slow by
+        design, and would only fill the slow query log.
+        """
+        conn = await self.get_conn()
+        await run_sync(conn, _warm_up)
+
+    async def has_users(self) -> bool:
+        """Returns whether the database holds any users, without counting them all."""
+        rows = await self._fetchall("has_users", "SELECT EXISTS (SELECT 1 FROM users)")
+        return bool(rows[0][0])
 
     async def seed_db(self) -> None:
         """Creates realistic seed data for testing."""
-        mulder = await self.create_user("Fox Mulder", "TRUSTNO1")
-        scully = await self.create_user("Dana Scully", "SCULLYMD")
-        skinner = await self.create_user("Walter Skinner", "SKINNERAD")
-        spender = await self.create_user("C.G.B. Spender", "CANCERMAN")
-        flukeman = await self.create_user("The Flukeman", "FLUKEMAN")
-        tooms = await self.create_user("Eugene Victor Tooms", "LIVERLVR")
-        mutato = await self.create_user("The Great Mutato", "CHERFAN")
-        betts = await self.create_user("Leonard Betts", "REGENERATE")
-
-        await self.create_referral(source_user_id=spender.id, target_user_id=skinner.id, status="confirmed")
-        await self.create_referral(source_user_id=skinner.id, target_user_id=mulder.id, status="confirmed")
-        await self.create_referral(source_user_id=skinner.id, target_user_id=scully.id, status="confirmed")
-        await self.create_referral(source_user_id=mulder.id, target_user_id=flukeman.id, status="confirmed")
-        await self.create_referral(source_user_id=mulder.id, target_user_id=tooms.id, status="confirmed")
-        await self.create_referral(source_user_id=mulder.id, target_user_id=mutato.id, status="pending")
-        await self.create_referral(source_user_id=mulder.id, target_user_id=betts.id, status="pending")
+        # Written in bulk, two transactions in all, rather than a write per row.
+        await self.bulk_create_users(
+            [
+                NewUser(id=1, name="Fox Mulder", referral_code="TRUSTNO1"),
+                NewUser(id=2, name="Dana Scully", referral_code="SCULLYMD"),
+                NewUser(id=3, name="Walter Skinner", referral_code="SKINNERAD"),
+                NewUser(id=4, name="C.G.B. Spender", referral_code="CANCERMAN"),
+                NewUser(id=5, name="The Flukeman", referral_code="FLUKEMAN"),
+                NewUser(id=6, name="Eugene Victor Tooms", referral_code="LIVERLVR"),
+                NewUser(id=7, name="The Great Mutato", referral_code="CHERFAN"),
+                NewUser(id=8, name="Leonard Betts", referral_code="REGENERATE"),
+            ]
+        )
+        mulder, scully, skinner, spender, flukeman, tooms, mutato, betts = range(1, 9)
+        await self.bulk_create_referrals(
+            [
+                NewReferral(source_user_id=spender, target_user_id=skinner, status="confirmed"),
+                NewReferral(source_user_id=skinner, target_user_id=mulder, status="confirmed"),
+                NewReferral(source_user_id=skinner, target_user_id=scully, status="confirmed"),
+                NewReferral(source_user_id=mulder, target_user_id=flukeman, status="confirmed"),
+                NewReferral(source_user_id=mulder, target_user_id=tooms, status="confirmed"),
+                NewReferral(source_user_id=mulder, target_user_id=mutato, status="pending"),
+                NewReferral(source_user_id=mulder, target_user_id=betts, status="pending"),
+            ]
+        )
 
         # Print some helpful debug output for testing...
 
@@ -208,9 +1412,9 @@ class Database:
                 u.id,
                 u.name,
                 u.referral_code,
-                COUNT(r.id) as referral_count
+                COALESCE(SUM(c.count), 0) as referral_count
             FROM users u
-            LEFT JOIN referrals r ON u.id = r.source_user_id
+            LEFT JOIN referral_counts c ON u.id = c.user_id
             GROUP BY u.id
             ORDER BY u.id
             """
@@ -0,0 +1,186 @@
+import asyncio
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from carton_caps.database import Referral
+
+
+@dataclass(slots=True, frozen=True)
+class ReferralEvent:
+    """
+    A change to one of a user's referrals.
+
+    `version` is the user's referral version once the change was committed,
+    which doubles as the event's id: it goes up by one with every change, so
+    a gap between two events means a change was missed.
+    """
+
+    user_id: int
+    version: int
+    type: str
+    referral: "Referral"
+
+
+@dataclass
+class EventBusStats:
+    """A point-in-time snapshot of event bus usage."""
+
+    subscribers: int
+    published: int
+    dropped: int
+    replayed: int
+    resyncs: int
+
+
+class Subscription:
+    """
+    One client's subscription to a user's referral events.
+
+    Events are queued until the client reads them. A client that falls more
+    than `max_queued` events behind is dropped: its queue is emptied and it
+    should disconnect, to resume where it left off once it reconnects.
+    """
+
+    def __init__(self, bus: "EventBus", user_id: int, max_queued: int):
+        self.user_id = user_id
+        self.dropped = False
+        self.closed = False
+        self._bus = bus
+        self._events: deque[ReferralEvent] = deque()
+        self._max_queued = max_queued
+        self._ready = asyncio.Event()
+
+    def _push(self, event: ReferralEvent) -> None:
+        if self.dropped:
+            return
+        if len(self._events) >= self._max_queued:
+            self.dropped = True
+            self._events.clear()
+            self._bus._dropped += 1
+        else:
+            self._events.append(event)
+        self._ready.set()
+
+    async def get(self, timeout: float) -> list[ReferralEvent]:
+        """
+        Waits up to `timeout` seconds for events, and returns every one queued.
+
+        Returns an empty list if none arrived in time, or if the subscription
+        was dropped or closed while waiting.
+        """
+        if not self._events and not self.dropped and not self.closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except TimeoutError:
+                pass
+        self._ready.clear()
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+    def record_resync(self) -> None:
+        """Counts the client being told to start afresh, after missing changes made elsewhere."""
+        self._bus._resyncs += 1
+
+    def close(self) -> None:
+        """Unsubscribes, waking the reader if it is waiting."""
+        self.closed = True
+        self._ready.set()
+        self._bus._unsubscribe(self)
+
+
+class EventBus:
+    """
+    An in-process publish/subscribe bus for referral events, keyed by the referring user.
+
+    `Database` publishes an event once each change to a referral is
+    committed, and each subscriber gets its own bounded queue, so one slow
+    client never holds up the writer or other clients.
+
+    The most recent `replay_size` events of up to `replay_users` users are
+    kept, so that a client that reconnects can be sent the events it missed.
+    Only changes made through this process are published. Subscribers learn
+    of others by comparing the user's referral version with the last event
+    they were sent.
+    """
+
+    def __init__(self, max_queued: int = 100, replay_size: int = 32, replay_users: int = 10_000):
+        self._max_queued = max_queued
+        self._replay_size = replay_size
+        self._replay_users = replay_users
+        self._subscribers: dict[int, set[Subscription]] = {}
+        # Ordered from least to most recently published to.
+        self._recent: OrderedDict[int, deque[ReferralEvent]] = OrderedDict()
+
+        self._published = 0
+        self._dropped = 0
+        self._replayed = 0
+        self._resyncs = 0
+
+    def subscribe(self, user_id: int) -> Subscription:
+        """Subscribes to a user's referral events. Close the subscription when done with it."""
+        subscription = Subscription(self, user_id, self._max_queued)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def publish(self, event: ReferralEvent) -> None:
+        """Queues an event for each of the user's subscribers, and keeps it for replay."""
+        recent = self._recent.get(event.user_id)
+        if recent is None:
+            recent = self._recent[event.user_id] = deque(maxlen=self._replay_size)
+            if len(self._recent) > self._replay_users:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(event.user_id)
+        recent.append(event)
+
+        for subscription in self._subscribers.get(event.user_id, ()):
+            subscription._push(event)
+        self._published += 1
+
+    def replay(self, user_id: int, after_version: int, current_version: int) -> list[ReferralEvent] | None:
+        """
+        Returns the user's events after `after_version`, up to and including `current_version`.
+
+        Returns None if any of them are no longer kept, or were never
+        published here, in which case the client needs to start afresh.
+        """
+        events = [event for event in self._recent.get(user_id, ()) if after_version < event.version <= current_version]
+        if [event.version for event in events] != list(range(after_version + 1, current_version + 1)):
+            self._resyncs += 1
+            return None
+        self._replayed += len(events)
+        return events
+
+    def close(self) -> None:
+        """Closes every subscription, so that their readers finish."""
+        for subscribers in list(self._subscribers.values()):
+            for subscription in list(subscribers):
+                subscription.close()
+
+    def stats(self) -> EventBusStats:
+        """Returns a snapshot of how many clients are subscribed and how many events went where."""
+        return EventBusStats(
+            subscribers=sum(len(subscribers) for subscribers in self._subscribers.values()),
+            published=self._published,
+            dropped=self._dropped,
+            replayed=self._replayed,
+            resyncs=self._resyncs,
+        )
+
+
+def sse_message(event: str, data: bytes, id: int | None = None) -> bytes:
+    """Formats a server-sent event. `data` must be a single line, as compact JSON is."""
+    message = b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+    if id is not None:
+        message = f"id: {id}\n".encode() + message
+    return message
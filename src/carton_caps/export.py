@@ -0,0 +1,128 @@
+import csv
+import io
+import os
+import sqlite3
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncGenerator, BinaryIO, Callable
+
+from carton_caps.compression import ENCODINGS
+from carton_caps.database import Database
+from carton_caps.serialization import dumps
+
+# The columns of each kind of export, in the order the rows have them. Exports
+# can be imported again with import-data, which ignores the joined columns.
+COLUMNS = {
+    "users": ("id", "name", "referral_code", "referred_by"),
+    "referrals": ("id", "source_user_id", "source_name", "target_user_id", "target_name", "status", "created_at"),
+}
+
+MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# File extensions that select an encoding to compress an export with.
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd", ".br": "br"}
+
+
+@dataclass
+class ExportResult:
+    """A summary of a finished export."""
+
+    exported: int
+    # The highest id the export covered. Exporting again after it picks up
+    # only what was added since.
+    through_id: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.exported / self.seconds if self.seconds else 0.0
+
+
+def infer_compression(path: str) -> tuple[str | None, str]:
+    """
+    Infers the encoding to compress an export with from its path's extension.
+
+    Returns the encoding, or None if the extension doesn't call for one, and
+    the path without the compression extension.
+    """
+    root, extension = os.path.splitext(path)
+    encoding = COMPRESSION_EXTENSIONS.get(extension.lower())
+    if encoding is None:
+        return None, path
+    if encoding not in ENCODINGS:
+        raise ValueError(f"{encoding} compression isn't installed (pip install carton-caps[compression])")
+    return encoding, root
+
+
+def _encode_ndjson(rows: list[sqlite3.Row], columns: tuple[str, ...]) -> bytes:
+    return b"".join(dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+def _encode_csv(rows: list[sqlite3.Row] | list[tuple[str, ...]]) -> bytes:
+    out = io.StringIO(newline="")
+    csv.writer(out).writerows(rows)
+    return out.getvalue().encode()
+
+
+async def encode_export(
+    batches: AsyncGenerator[list[sqlite3.Row], None], kind: str, file_format: str
+) -> AsyncGenerator[bytes, None]:
+    """
+    Encodes batches of exported rows as NDJSON or CSV, a batch at a time.
+
+    CSV starts with a header row. Null columns are written as empty CSV
+    fields, which import-data reads back as missing. `batches` is closed when
+    the encoded stream is, so that it can clean up even if the client goes away.
+    """
+    if file_format not in MIMETYPES:
+        raise ValueError(f"Unknown format: {file_format}")
+    columns = COLUMNS[kind]
+    if file_format == "csv":
+        yield _encode_csv([columns])
+    async with aclosing(batches):
+        async for rows in batches:
+            yield _encode_ndjson(rows, columns) if file_format == "ndjson" else _encode_csv(rows)
+
+
+async def export_file(
+    db: Database,
+    output: BinaryIO,
+    kind: str,
+    file_format: str,
+    encoding: str | None = None,
+    after_id: int = 0,
+    since: datetime | None = None,
+    batch_size: int = 1000,
+    report: Callable[[str], None] = print,
+) -> ExportResult:
+    """
+    Exports every user or referral with an id after `after_id` to a binary file, optionally compressed.
+
+    The export runs up to the highest id when it starts, so its result's
+    `through_id` is the `after_id` for the next incremental export.
+    Progress is reported every 100 batches.
+    """
+    started = time.monotonic()
+    through_id = await db.get_export_watermark(kind)
+    exported = 0
+
+    async def counted() -> AsyncGenerator[list[sqlite3.Row], None]:
+        nonlocal exported
+        batch_count = 0
+        async with aclosing(db.iter_export(kind, after_id, through_id, since, batch_size)) as batches:
+            async for rows in batches:
+                exported += len(rows)
+                batch_count += 1
+                if batch_count % 100 == 0:
+                    report(f"Exported {exported} rows ({exported / (time.monotonic() - started):.0f} rows/s)")
+                yield rows
+
+    compressor = ENCODINGS[encoding]() if encoding is not None else None
+    async for chunk in encode_export(counted(), kind, file_format):
+        output.write(compressor.compress(chunk) if compressor is not None else chunk)
+    if compressor is not None:
+        output.write(compressor.flush())
+
+    return ExportResult(exported=exported, through_id=through_id, seconds=time.monotonic() - started)
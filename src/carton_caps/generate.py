@@ -0,0 +1,59 @@
+import random
+from datetime import datetime, timedelta, UTC
+from typing import Iterator
+
+from carton_caps.codes import CODE_ALPHABET, CODE_LENGTH
+from carton_caps.database import NewReferral, NewUser
+
+# An odd multiplier is invertible modulo a power of two, so multiplying by it
+# shuffles user numbers into distinct, random looking codes.
+_CODE_MULTIPLIER = 0x9E3779B1
+
+
+def make_referral_code(n: int) -> str:
+    """Returns the referral code for the nth generated user. Distinct users always get distinct codes."""
+    value = (n * _CODE_MULTIPLIER) % (len(CODE_ALPHABET) ** CODE_LENGTH)
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, digit = divmod(value, len(CODE_ALPHABET))
+        chars.append(CODE_ALPHABET[digit])
+    return "".join(chars)
+
+
+def generate_users(count: int) -> Iterator[NewUser]:
+    """Generates `count` users, with ids from 1 to `count`."""
+    for n in range(1, count + 1):
+        yield NewUser(name=f"Generated User {n}", referral_code=make_referral_code(n), id=n)
+
+
+def generate_referrals(
+    user_count: int,
+    referred_fraction: float = 0.8,
+    skew: float = 2.0,
+    pending_fraction: float = 0.3,
+    seed: int = 0,
+    start: datetime = datetime(2024, 1, 1, tzinfo=UTC),
+    interval: timedelta = timedelta(minutes=1),
+) -> Iterator[NewReferral]:
+    """
+    Generates referrals between the users made by `generate_users`.
+
+    Users sign up in id order, and each one after the first was referred with
+    probability `referred_fraction`, by a user who signed up before them.
+    Referrers are drawn with a power-law bias towards early users: a `skew`
+    of 1 picks them uniformly, and larger values concentrate referrals on a
+    small number of prolific referrers, as happens in practice.
+
+    The same arguments always generate the same referrals.
+    """
+    rng = random.Random(seed)
+    for target in range(2, user_count + 1):
+        if rng.random() >= referred_fraction:
+            continue
+        source = 1 + int((target - 1) * rng.random() ** skew)
+        yield NewReferral(
+            source_user_id=source,
+            target_user_id=target,
+            status="pending" if rng.random() < pending_fraction else "confirmed",
+            created_at=(start + interval * target).isoformat(),
+        )
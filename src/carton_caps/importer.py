@@ -0,0 +1,116 @@
+import csv
+import json
+import os
+import time
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any, Callable, Iterator
+
+from carton_caps.database import Database, NewReferral, NewUser
+
+FORMATS = ("ndjson", "csv")
+KINDS = ("users", "referrals")
+
+
+@dataclass
+class ImportResult:
+    """A summary of a finished import."""
+
+    imported: int
+    skipped: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.imported / self.seconds if self.seconds else 0.0
+
+
+def infer_format(path: str) -> str:
+    """Infers the format of a data file from its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    if extension == ".csv":
+        return "csv"
+    raise ValueError(f"Can't infer the format of {path}, please specify it")
+
+
+def read_records(path: str, file_format: str) -> Iterator[dict[str, Any]]:
+    """Reads records from an NDJSON or CSV file, one at a time, so the file is never held in memory."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "ndjson":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif file_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            raise ValueError(f"Unknown format: {file_format}")
+
+
+def _optional_int(value: Any) -> int | None:
+    # CSV has no nulls, so an empty column means the value wasn't given.
+    return None if value is None or value == "" else int(value)
+
+
+def _to_user(record: dict[str, Any]) -> NewUser:
+    return NewUser(
+        name=record["name"],
+        referral_code=record["referral_code"],
+        id=_optional_int(record.get("id")),
+    )
+
+
+def _to_referral(record: dict[str, Any]) -> NewReferral:
+    return NewReferral(
+        source_user_id=int(record["source_user_id"]),
+        target_user_id=int(record["target_user_id"]),
+        status=record["status"],
+        created_at=record.get("created_at") or None,
+        id=_optional_int(record.get("id")),
+    )
+
+
+async def import_file(
+    db: Database,
+    path: str,
+    kind: str,
+    file_format: str | None = None,
+    chunk_size: int = 10_000,
+    restart: bool = False,
+    report: Callable[[str], None] = print,
+) -> ImportResult:
+    """
+    Imports users or referrals from a file, a chunk at a time.
+
+    Progress is committed along with each chunk, keyed by the file's path and
+    the kind of data. If an import is interrupted, importing the same file
+    again skips the rows that were already committed, unless `restart` is set.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind of data: {kind}")
+    file_format = file_format or infer_format(path)
+
+    import_name = f"{kind}:{os.path.abspath(path)}"
+    if restart:
+        await db.reset_import_progress(import_name)
+    skipped = await db.get_import_progress(import_name)
+    if skipped:
+        report(f"Resuming after {skipped} rows that were already imported")
+
+    started = time.monotonic()
+    imported = 0
+
+    def on_chunk(rows: int) -> None:
+        nonlocal imported
+        imported += rows
+        elapsed = time.monotonic() - started
+        report(f"Imported {skipped + imported} rows ({imported / elapsed:.0f} rows/s)")
+
+    records = islice(read_records(path, file_format), skipped, None)
+    if kind == "users":
+        await db.bulk_create_users(map(_to_user, records), chunk_size, import_name, on_chunk)
+    else:
+        await db.bulk_create_referrals(map(_to_referral, records), chunk_size, import_name, on_chunk)
+
+    return ImportResult(imported=imported, skipped=skipped, seconds=time.monotonic() - started)
@@ -0,0 +1,243 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, fields, is_dataclass
+from typing import Any
+
+# Upper bounds of the histogram buckets, in seconds. Most queries are answered
+# from an index in well under a millisecond, so the buckets start small.
+DURATION_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000)
+
+slow_query_logger = logging.getLogger("carton_caps.slow_queries")
+
+
+@dataclass
+class StartupStats:
+    """How long each phase of starting the server took, in seconds."""
+
+    import_seconds: float = 0.0
+    app_seconds: float = 0.0
+    schema_seconds: float = 0.0
+    open_seconds: float = 0.0
+    warm_up_seconds: float = 0.0
+
+    def describe(self) -> str:
+        """Summarizes the timings in a line, for the log."""
+        phases = {
+            "import": self.import_seconds,
+            "app creation": self.app_seconds,
+            "schema check": self.schema_seconds,
+            "open": self.open_seconds,
+            "warm-up": self.warm_up_seconds,
+        }
+        breakdown = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in phases.items())
+        return f"Started in {sum(phases.values()):.3f}s ({breakdown})"
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, as a Prometheus histogram does."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # One count per bucket, plus one for observations above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    In-process metrics for queries and requests, rendered in the Prometheus text format.
+
+    Queries are observed from the database connections' worker threads as well
+    as the event loop, so observations are guarded by a lock. It is held only
+    long enough to bump a few counters.
+
+    Queries that take `slow_query_threshold` seconds or more are logged to the
+    `carton_caps.slow_queries` logger along with their query plan. Pass None to
+    turn the slow query log off.
+    """
+
+    def __init__(self, slow_query_threshold: float | None = 0.1):
+        self.slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self._query_durations: dict[str, Histogram] = {}
+        self._query_rows: dict[str, Histogram] = {}
+        self._slow_queries: dict[str, int] = {}
+        self._write_durations: dict[str, Histogram] = {}
+        self._request_durations: dict[tuple[str, str, str], Histogram] = {}
+
+    def is_slow(self, seconds: float) -> bool:
+        """Returns whether a query that took this long belongs in the slow query log."""
+        return self.slow_query_threshold is not None and seconds >= self.slow_query_threshold
+
+    def observe_query(self, name: str, seconds: float, rows: int) -> None:
+        """Records how long a query took and how many rows it returned."""
+        with self._lock:
+            if name not in self._query_durations:
+                self._query_durations[name] = Histogram(DURATION_BUCKETS)
+                self._query_rows[name] = Histogram(ROW_BUCKETS)
+            self._query_durations[name].observe(seconds)
+            self._query_rows[name].observe(rows)
+
+    def observe_write(self, name: str, seconds: float) -> None:
+        """Records how long a write took to commit, including time spent queued for the writer."""
+        with self._lock:
+            if name not in self._write_durations:
+                self._write_durations[name] = Histogram(DURATION_BUCKETS)
+            self._write_durations[name].observe(seconds)
+
+    def log_slow_query(self, name: str, seconds: float, sql: str, plan: list[str] | None = None) -> None:
+        """Logs a slow query, with its plan if it has one."""
+        with self._lock:
+            self._slow_queries[name] = self._slow_queries.get(name, 0) + 1
+        message = f"Slow query {name} took {seconds * 1000:.1f}ms\n{sql.strip()}"
+        if plan:
+            message += "\nQuery plan:\n" + "\n".join(f"  {step}" for step in plan)
+        slow_query_logger.warning(message)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float) -> None:
+        """Records how long a request took to produce its response."""
+        key = (method, route, str(status))
+        with self._lock:
+            if key not in self._request_durations:
+                self._request_durations[key] = Histogram(DURATION_BUCKETS)
+            self._request_durations[key].observe(seconds)
+
+    def render(self, stats: dict[str, Any] | None = None) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        `stats` maps a prefix to a stats snapshot (such as `PoolStats`), each
+        field of which is exported as a gauge named `carton_caps_<prefix>_<field>`.
+        """
+        lines: list[str] = []
+        with self._lock:
+            self._render_histograms(
+                lines,
+                "carton_caps_query_duration_seconds",
+                "Time taken by database queries.",
+                {(name,): histogram for name, histogram in self._query_durations.items()},
+                ("query",),
+            )
+            self._render_histograms(
+                lines,
+                "carton_caps_query_rows",
+                "Rows returned by database queries.",
+                {(name,): histogram for name, histogram in self._query_rows.items()},
+                ("query",),
+            )
+            self._render_histograms(
+                lines,
+                "carton_caps_write_duration_seconds",
+                "Time taken for writes to commit, including time queued for the writer.",
+                {(name,): histogram for name, histogram in self._write_durations.items()},
+                ("write",),
+            )
+            lines.append("# HELP carton_caps_slow_queries_total Queries that were logged as slow.")
+            lines.append("# TYPE carton_caps_slow_queries_total counter")
+            for name, count in sorted(self._slow_queries.items()):
+                lines.append(f"carton_caps_slow_queries_total{_format_labels({'query': name})} {count}")
+            self._render_histograms(
+                lines,
+                "carton_caps_request_duration_seconds",
+                "Time taken to produce responses, up to the start of the body for streamed responses.",
+                dict(self._request_durations),
+                ("method", "route", "status"),
+            )
+
+        for prefix, snapshot in (stats or {}).items():
+            if not is_dataclass(snapshot):
+                continue
+            for field in fields(snapshot):
+                value = getattr(snapshot, field.name)
+                if isinstance(value, (int, float)):
+                    name = f"carton_caps_{prefix}_{field.name}"
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histograms(
+        lines: list[str],
+        name: str,
+        description: str,
+        histograms: dict[tuple[str, ...], Histogram],
+        label_names: tuple[str, ...],
+    ) -> None:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for label_values, histogram in sorted(histograms.items()):
+            labels = dict(zip(label_names, label_values))
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, math.inf), histogram.counts):
+                cumulative += count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+
+def run_query(
+    conn: sqlite3.Connection, metrics: Metrics | None, name: str, sql: str, parameters: Any = ()
+) -> list[sqlite3.Row]:
+    """
+    Runs a query to completion and returns its rows, recording it in `metrics` if they are given.
+
+    This runs on the connection's own thread, so a slow query's plan is read
+    on the same connection, with the same parameters, right after it.
+    """
+    started = time.perf_counter()
+    rows = conn.execute(sql, parameters).fetchall()
+    if metrics is None:
+        return rows
+
+    seconds = time.perf_counter() - started
+    metrics.observe_query(name, seconds, len(rows))
+    if metrics.is_slow(seconds):
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+        metrics.log_slow_query(name, seconds, sql, plan)
+    return rows
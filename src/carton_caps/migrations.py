@@ -0,0 +1,400 @@
+import sqlite3
+
+from carton_caps.timestamps import to_microseconds
+
+# Each migration upgrades the schema by one version, so the schema version of
+# a database (stored in SQLite's `user_version`) is the number of migrations
+# that have been applied to it. Migrations must never be edited once they
+# have shipped. Add a new one instead.
+MIGRATIONS: list[str] = [
+    # 1: The original schema. Databases created before migrations existed
+    # already have these tables, so they are created only if missing.
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        name TEXT(256) NOT NULL UNIQUE,
+        referral_code TEXT(16) NOT NULL UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS referrals (
+        id INTEGER PRIMARY KEY,
+        source_user_id INTEGER NOT NULL,
+        target_user_id INTEGER NOT NULL UNIQUE,
+        created_at TEXT NOT NULL,
+        status TEXT NOT NULL,
+        FOREIGN KEY (source_user_id) REFERENCES users(id) ON DELETE RESTRICT,
+        FOREIGN KEY (target_user_id) REFERENCES users(id) ON DELETE RESTRICT
+    );
+    """,
+    # 2: Covers the referral listing, so that it is answered from the index
+    # alone, in id order, rather than by scanning the table.
+    """
+    CREATE INDEX referrals_source_user_id ON referrals (source_user_id, id, target_user_id, status, created_at);
+    """,
+    # 3: A per-user version number that changes whenever any of the user's
+    # referrals do, so clients can tell whether their copy is current without
+    # the referrals being read. Triggers keep it current for every write path.
+    """
+    ALTER TABLE users ADD COLUMN referral_version INTEGER NOT NULL DEFAULT 0;
+
+    CREATE TRIGGER referrals_version_insert AFTER INSERT ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id = NEW.source_user_id;
+    END;
+
+    CREATE TRIGGER referrals_version_update AFTER UPDATE ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id IN (OLD.source_user_id, NEW.source_user_id);
+    END;
+
+    CREATE TRIGGER referrals_version_delete AFTER DELETE ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id = OLD.source_user_id;
+    END;
+    """,
+    # 4: How many rows of each bulk import have been committed, so that an
+    # interrupted import can resume where it left off.
+    """
+    CREATE TABLE import_progress (
+        name TEXT PRIMARY KEY,
+        rows INTEGER NOT NULL
+    );
+    """,
+    # 5: A closure table over the referral tree, holding a row for every
+    # ancestor and descendant pair along with how many referrals apart they
+    # are, so that uplines and downlines are index lookups rather than
+    # recursive walks. It is backfilled from the existing referrals, then kept
+    # current by triggers. A user has at most one referrer, so each pair has
+    # exactly one path between them.
+    """
+    CREATE TABLE referral_paths (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, depth, descendant_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX referral_paths_descendant_id ON referral_paths (descendant_id, depth, ancestor_id);
+
+    INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+    WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+        SELECT source_user_id, target_user_id, 1 FROM referrals
+        UNION ALL
+        SELECT p.ancestor_id, r.target_user_id, p.depth + 1
+        FROM paths p
+        JOIN referrals r ON r.source_user_id = p.descendant_id
+    )
+    SELECT ancestor_id, descendant_id, depth FROM paths;
+
+    -- A referral from a user's own downline would make the tree a cycle.
+    CREATE TRIGGER referrals_paths_check_insert BEFORE INSERT ON referrals
+    BEGIN
+        SELECT RAISE(ABORT, 'referral would create a cycle')
+        WHERE NEW.source_user_id = NEW.target_user_id
+            OR EXISTS (
+                SELECT 1 FROM referral_paths WHERE ancestor_id = NEW.target_user_id AND descendant_id = NEW.source_user_id
+            );
+    END;
+
+    -- Connects the source and everyone above them to the target and everyone
+    -- below them. The target only has a downline already if referrals were
+    -- created out of order, as an import may do.
+    CREATE TRIGGER referrals_paths_insert AFTER INSERT ON referrals
+    BEGIN
+        INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM (
+            SELECT NEW.source_user_id AS ancestor_id, 0 AS depth
+            UNION ALL
+            SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = NEW.source_user_id
+        ) a, (
+            SELECT NEW.target_user_id AS descendant_id, 0 AS depth
+            UNION ALL
+            SELECT descendant_id, depth FROM referral_paths WHERE ancestor_id = NEW.target_user_id
+        ) d;
+    END;
+
+    CREATE TRIGGER referrals_paths_delete AFTER DELETE ON referrals
+    BEGIN
+        DELETE FROM referral_paths
+        WHERE ancestor_id IN (
+            SELECT OLD.source_user_id UNION ALL SELECT ancestor_id FROM referral_paths WHERE descendant_id = OLD.source_user_id
+        )
+        AND descendant_id IN (
+            SELECT OLD.target_user_id UNION ALL SELECT descendant_id FROM referral_paths WHERE ancestor_id = OLD.target_user_id
+        );
+    END;
+
+    CREATE TRIGGER referrals_paths_check_update BEFORE UPDATE OF source_user_id, target_user_id ON referrals
+    BEGIN
+        SELECT RAISE(ABORT, 'referral would create a cycle')
+        WHERE NEW.source_user_id = NEW.target_user_id
+            OR EXISTS (
+                SELECT 1 FROM referral_paths
+                WHERE ancestor_id = NEW.target_user_id AND descendant_id = NEW.source_user_id
+                    AND NOT (NEW.target_user_id = OLD.target_user_id AND NEW.source_user_id = OLD.source_user_id)
+            );
+    END;
+
+    CREATE TRIGGER referrals_paths_update AFTER UPDATE OF source_user_id, target_user_id ON referrals
+    BEGIN
+        DELETE FROM referral_paths
+        WHERE ancestor_id IN (
+            SELECT OLD.source_user_id UNION ALL SELECT ancestor_id FROM referral_paths WHERE descendant_id = OLD.source_user_id
+        )
+        AND descendant_id IN (
+            SELECT OLD.target_user_id UNION ALL SELECT descendant_id FROM referral_paths WHERE ancestor_id = OLD.target_user_id
+        );
+
+        INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM (
+            SELECT NEW.source_user_id AS ancestor_id, 0 AS depth
+            UNION ALL
+            SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = NEW.source_user_id
+        ) a, (
+            SELECT NEW.target_user_id AS descendant_id, 0 AS depth
+            UNION ALL
+            SELECT descendant_id, depth FROM referral_paths WHERE ancestor_id = NEW.target_user_id
+        ) d;
+    END;
+    """,
+    # 6: How many referrals each user has made in each status, kept current by
+    # triggers so that a user's stats are read from a handful of rows rather
+    # than counted from their referrals. Rows whose count drops to zero are
+    # removed.
+    """
+    CREATE TABLE referral_counts (
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, status)
+    ) WITHOUT ROWID;
+
+    INSERT INTO referral_counts (user_id, status, count)
+    SELECT source_user_id, status, COUNT(*) FROM referrals GROUP BY source_user_id, status;
+
+    CREATE TRIGGER referrals_counts_insert AFTER INSERT ON referrals
+    BEGIN
+        INSERT INTO referral_counts (user_id, status, count) VALUES (NEW.source_user_id, NEW.status, 1)
+        ON CONFLICT (user_id, status) DO UPDATE SET count = count + 1;
+    END;
+
+    CREATE TRIGGER referrals_counts_update AFTER UPDATE OF source_user_id, status ON referrals
+    BEGIN
+        UPDATE referral_counts SET count = count - 1 WHERE user_id = OLD.source_user_id AND status = OLD.status;
+        DELETE FROM referral_counts WHERE user_id = OLD.source_user_id AND status = OLD.status AND count <= 0;
+        INSERT INTO referral_counts (user_id, status, count) VALUES (NEW.source_user_id, NEW.status, 1)
+        ON CONFLICT (user_id, status) DO UPDATE SET count = count + 1;
+    END;
+
+    CREATE TRIGGER referrals_counts_delete AFTER DELETE ON referrals
+    BEGIN
+        UPDATE referral_counts SET count = count - 1 WHERE user_id = OLD.source_user_id AND status = OLD.status;
+        DELETE FROM referral_counts WHERE user_id = OLD.source_user_id AND status = OLD.status AND count <= 0;
+    END;
+    """,
+    # 7: Signals (hashed device ids, IP prefixes and email addresses) recorded
+    # at signup, for spotting users who refer themselves. Keyed by the signal
+    # first, so the users a signal has been seen under are an index range,
+    # newest last.
+    """
+    CREATE TABLE signup_signals (
+        kind TEXT NOT NULL,
+        value BLOB NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (kind, value, user_id),
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+    """,
+    # 8: Compact referrals. created_at is stored as microseconds since the Unix
+    # epoch and status as a code from referral_statuses, rather than both as
+    # text, which shrinks rows and indexes and makes time ranges integer
+    # comparisons. A status other than those in referral_statuses fails the
+    # migration, and writes of text (from an older version of the app, say)
+    # fail their CHECK. The table is rebuilt, which drops its indexes and triggers,
+    # so they are created again. referral_counts is rebuilt to count by code.
+    # Then an index on (source_user_id, status, created_at) has each user's
+    # referrals of a status in creation order, so listings filtered by status
+    # and time are read from it in order.
+    """
+    CREATE TABLE referral_statuses (
+        code INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+
+    INSERT INTO referral_statuses (code, name) VALUES (0, 'pending'), (1, 'confirmed'), (2, 'held');
+
+    CREATE TABLE referrals_compact (
+        id INTEGER PRIMARY KEY,
+        source_user_id INTEGER NOT NULL,
+        target_user_id INTEGER NOT NULL UNIQUE,
+        created_at INTEGER NOT NULL CHECK (typeof(created_at) = 'integer'),
+        status INTEGER NOT NULL CHECK (typeof(status) = 'integer'),
+        FOREIGN KEY (source_user_id) REFERENCES users(id) ON DELETE RESTRICT,
+        FOREIGN KEY (target_user_id) REFERENCES users(id) ON DELETE RESTRICT,
+        FOREIGN KEY (status) REFERENCES referral_statuses(code)
+    );
+
+    INSERT INTO referrals_compact (id, source_user_id, target_user_id, created_at, status)
+    SELECT r.id, r.source_user_id, r.target_user_id, iso_to_microseconds(r.created_at), s.code
+    FROM referrals r
+    LEFT JOIN referral_statuses s ON s.name = r.status;
+
+    DROP TABLE referrals;
+    ALTER TABLE referrals_compact RENAME TO referrals;
+
+    CREATE INDEX referrals_source_user_id ON referrals (source_user_id, id, target_user_id, status, created_at);
+    CREATE INDEX referrals_source_user_id_status_created_at ON referrals (source_user_id, status, created_at);
+
+    CREATE TRIGGER referrals_version_insert AFTER INSERT ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id = NEW.source_user_id;
+    END;
+
+    CREATE TRIGGER referrals_version_update AFTER UPDATE ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id IN (OLD.source_user_id, NEW.source_user_id);
+    END;
+
+    CREATE TRIGGER referrals_version_delete AFTER DELETE ON referrals
+    BEGIN
+        UPDATE users SET referral_version = referral_version + 1 WHERE id = OLD.source_user_id;
+    END;
+
+    CREATE TRIGGER referrals_paths_check_insert BEFORE INSERT ON referrals
+    BEGIN
+        SELECT RAISE(ABORT, 'referral would create a cycle')
+        WHERE NEW.source_user_id = NEW.target_user_id
+            OR EXISTS (
+                SELECT 1 FROM referral_paths WHERE ancestor_id = NEW.target_user_id AND descendant_id = NEW.source_user_id
+            );
+    END;
+
+    CREATE TRIGGER referrals_paths_insert AFTER INSERT ON referrals
+    BEGIN
+        INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM (
+            SELECT NEW.source_user_id AS ancestor_id, 0 AS depth
+            UNION ALL
+            SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = NEW.source_user_id
+        ) a, (
+            SELECT NEW.target_user_id AS descendant_id, 0 AS depth
+            UNION ALL
+            SELECT descendant_id, depth FROM referral_paths WHERE ancestor_id = NEW.target_user_id
+        ) d;
+    END;
+
+    CREATE TRIGGER referrals_paths_delete AFTER DELETE ON referrals
+    BEGIN
+        DELETE FROM referral_paths
+        WHERE ancestor_id IN (
+            SELECT OLD.source_user_id UNION ALL SELECT ancestor_id FROM referral_paths WHERE descendant_id = OLD.source_user_id
+        )
+        AND descendant_id IN (
+            SELECT OLD.target_user_id UNION ALL SELECT descendant_id FROM referral_paths WHERE ancestor_id = OLD.target_user_id
+        );
+    END;
+
+    CREATE TRIGGER referrals_paths_check_update BEFORE UPDATE OF source_user_id, target_user_id ON referrals
+    BEGIN
+        SELECT RAISE(ABORT, 'referral would create a cycle')
+        WHERE NEW.source_user_id = NEW.target_user_id
+            OR EXISTS (
+                SELECT 1 FROM referral_paths
+                WHERE ancestor_id = NEW.target_user_id AND descendant_id = NEW.source_user_id
+                    AND NOT (NEW.target_user_id = OLD.target_user_id AND NEW.source_user_id = OLD.source_user_id)
+            );
+    END;
+
+    CREATE TRIGGER referrals_paths_update AFTER UPDATE OF source_user_id, target_user_id ON referrals
+    BEGIN
+        DELETE FROM referral_paths
+        WHERE ancestor_id IN (
+            SELECT OLD.source_user_id UNION ALL SELECT ancestor_id FROM referral_paths WHERE descendant_id = OLD.source_user_id
+        )
+        AND descendant_id IN (
+            SELECT OLD.target_user_id UNION ALL SELECT descendant_id FROM referral_paths WHERE ancestor_id = OLD.target_user_id
+        );
+
+        INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM (
+            SELECT NEW.source_user_id AS ancestor_id, 0 AS depth
+            UNION ALL
+            SELECT ancestor_id, depth FROM referral_paths WHERE descendant_id = NEW.source_user_id
+        ) a, (
+            SELECT NEW.target_user_id AS descendant_id, 0 AS depth
+            UNION ALL
+            SELECT descendant_id, depth FROM referral_paths WHERE ancestor_id = NEW.target_user_id
+        ) d;
+    END;
+
+    DROP TABLE referral_counts;
+
+    CREATE TABLE referral_counts (
+        user_id INTEGER NOT NULL,
+        status INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, status)
+    ) WITHOUT ROWID;
+
+    INSERT INTO referral_counts (user_id, status, count)
+    SELECT source_user_id, status, COUNT(*) FROM referrals GROUP BY source_user_id, status;
+
+    CREATE TRIGGER referrals_counts_insert AFTER INSERT ON referrals
+    BEGIN
+        INSERT INTO referral_counts (user_id, status, count) VALUES (NEW.source_user_id, NEW.status, 1)
+        ON CONFLICT (user_id, status) DO UPDATE SET count = count + 1;
+    END;
+
+    CREATE TRIGGER referrals_counts_update AFTER UPDATE OF source_user_id, status ON referrals
+    BEGIN
+        UPDATE referral_counts SET count = count - 1 WHERE user_id = OLD.source_user_id AND status = OLD.status;
+        DELETE FROM referral_counts WHERE user_id = OLD.source_user_id AND status = OLD.status AND count <= 0;
+        INSERT INTO referral_counts (user_id, status, count) VALUES (NEW.source_user_id, NEW.status, 1)
+        ON CONFLICT (user_id, status) DO UPDATE SET count = count + 1;
+    END;
+
+    CREATE TRIGGER referrals_counts_delete AFTER DELETE ON referrals
+    BEGIN
+        UPDATE referral_counts SET count = count - 1 WHERE user_id = OLD.source_user_id AND status = OLD.status;
+        DELETE FROM referral_counts WHERE user_id = OLD.source_user_id AND status = OLD.status AND count <= 0;
+    END;
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Returns the schema version of the database."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> list[int]:
+    """
+    Brings the database up to the current schema version, in place.
+
+    Each migration runs in its own transaction along with the bump to
+    `user_version`, so a failed migration leaves the database at the last
+    version that succeeded. Returns the versions that were applied.
+    """
+    version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this app supports ({SCHEMA_VERSION})")
+
+    # Migration 8 converts stored ISO 8601 strings, which SQLite can't parse to the microsecond.
+    conn.create_function("iso_to_microseconds", 1, to_microseconds, deterministic=True)
+
+    applied = []
+    for version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.executescript(f"BEGIN IMMEDIATE; {script}; PRAGMA user_version = {version}; COMMIT;")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        applied.append(version)
+    return applied
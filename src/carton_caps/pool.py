@@ -0,0 +1,186 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import aiosqlite
+
+from carton_caps.connection import connect
+
+
+class PoolTimeoutError(Exception):
+    """Raised when a connection could not be acquired within the configured timeout."""
+
+
+@dataclass
+class PoolStats:
+    """A point-in-time snapshot of pool usage."""
+
+    size: int
+    idle: int
+    in_use: int
+    acquired: int
+    waits: int
+    wait_time: float
+    max_wait_time: float
+    timeouts: int
+    health_check_failures: int
+
+
+@dataclass
+class _IdleConnection:
+    conn: aiosqlite.Connection
+    released_at: float
+
+
+class ConnectionPool:
+    """
+    A bounded pool of aiosqlite connections that lives for the lifetime of the app.
+
+    Every aiosqlite connection owns a background thread, so opening one per
+    request is expensive. The pool keeps up to `max_size` connections open and
+    leases them out to requests, reusing them in LIFO order so that a small
+    working set of warm connections handles most of the traffic.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        min_size: int = 1,
+        max_size: int = 10,
+        acquire_timeout: float = 5.0,
+        health_check_interval: float = 30.0,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+
+        self._path = path
+        self._min_size = min_size
+        self._max_size = max_size
+        self._acquire_timeout = acquire_timeout
+        self._health_check_interval = health_check_interval
+
+        # The semaphore bounds the number of leased connections, and its
+        # waiters queue up in FIFO order when the pool is exhausted.
+        self._slots = asyncio.Semaphore(max_size)
+        self._idle: deque[_IdleConnection] = deque()
+        self._size = 0
+        self._closed = False
+
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._health_check_failures = 0
+
+    async def open(self) -> None:
+        """Opens the minimum number of connections up front."""
+        while self._size < self._min_size:
+            conn = await self._open_conn()
+            self._idle.append(_IdleConnection(conn, time.monotonic()))
+
+    async def close(self) -> None:
+        """Closes all idle connections. Leased connections are closed when released."""
+        self._closed = True
+        while self._idle:
+            await self._close_conn(self._idle.pop().conn)
+
+    async def acquire(self) -> aiosqlite.Connection:
+        """Leases a connection from the pool, waiting up to `acquire_timeout` seconds."""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+
+        started = time.monotonic()
+        waited = self._slots.locked()
+        try:
+            async with asyncio.timeout(self._acquire_timeout):
+                await self._slots.acquire()
+        except TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeoutError(
+                f"Timed out after {self._acquire_timeout}s waiting for a database connection"
+            ) from None
+
+        if waited:
+            elapsed = time.monotonic() - started
+            self._waits += 1
+            self._wait_time += elapsed
+            self._max_wait_time = max(self._max_wait_time, elapsed)
+
+        try:
+            conn = await self._take_idle()
+            if conn is None:
+                conn = await self._open_conn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        self._acquired += 1
+        return conn
+
+    async def release(self, conn: aiosqlite.Connection) -> None:
+        """Returns a leased connection to the pool."""
+        try:
+            if self._closed:
+                await self._close_conn(conn)
+                return
+
+            # Never hand the next request a connection with an open transaction.
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+            except Exception:
+                await self._close_conn(conn)
+                return
+
+            self._idle.append(_IdleConnection(conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def stats(self) -> PoolStats:
+        """Returns a snapshot of the pool size and wait metrics."""
+        return PoolStats(
+            size=self._size,
+            idle=len(self._idle),
+            in_use=self._size - len(self._idle),
+            acquired=self._acquired,
+            waits=self._waits,
+            wait_time=self._wait_time,
+            max_wait_time=self._max_wait_time,
+            timeouts=self._timeouts,
+            health_check_failures=self._health_check_failures,
+        )
+
+    async def _take_idle(self) -> aiosqlite.Connection | None:
+        """Pops the most recently used idle connection, discarding any that fail a health check."""
+        while self._idle:
+            idle = self._idle.pop()
+            if time.monotonic() - idle.released_at < self._health_check_interval:
+                return idle.conn
+            if await self._is_healthy(idle.conn):
+                return idle.conn
+            self._health_check_failures += 1
+            await self._close_conn(idle.conn)
+        return None
+
+    async def _is_healthy(self, conn: aiosqlite.Connection) -> bool:
+        try:
+            async with conn.execute("SELECT 1") as cursor:
+                await cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    async def _open_conn(self) -> aiosqlite.Connection:
+        conn = await connect(self._path)
+        self._size += 1
+        return conn
+
+    async def _close_conn(self, conn: aiosqlite.Connection) -> None:
+        self._size -= 1
+        try:
+            await conn.close()
+        except Exception:
+            # The connection is being discarded either way.
+            pass
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from typing import Any, AsyncIterator, Callable, TextIO
+
+from carton_caps.database import Database
+
+
+@dataclass(slots=True, frozen=True)
+class PurchaseEvent:
+    """A referred user's purchase, which confirms their referral if it is pending."""
+
+    event_id: str
+    user_id: int
+    # When the purchase was made, in seconds since the epoch, if the event says.
+    # Times without a timezone are taken to be UTC.
+    occurred_at: float | None
+
+
+@dataclass
+class ConfirmResult:
+    """A summary of a finished run of purchase events."""
+
+    read: int
+    duplicates: int
+    invalid: int
+    confirmed: int
+    seconds: float
+    # The furthest behind the purchases the confirmations fell, in seconds.
+    max_lag: float | None
+
+    @property
+    def events_per_second(self) -> float:
+        return self.read / self.seconds if self.seconds else 0.0
+
+
+def parse_event(record: Any) -> PurchaseEvent:
+    """
+    Reads a purchase event from a decoded NDJSON record.
+
+    Raises ValueError if the record isn't a purchase event.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("an event must be a JSON object")
+    event_id = record.get("event_id")
+    user_id = record.get("user_id")
+    if not isinstance(event_id, str) or not event_id:
+        raise ValueError("event_id must be a non-empty string")
+    if type(user_id) is not int:
+        raise ValueError("user_id must be an integer")
+    occurred_at = record.get("occurred_at")
+    if occurred_at is not None:
+        if not isinstance(occurred_at, str):
+            raise ValueError("occurred_at must be an ISO 8601 timestamp")
+        occurred = datetime.fromisoformat(occurred_at)
+        # Times without a timezone are UTC, whatever timezone the server is in.
+        if occurred.tzinfo is None:
+            occurred = occurred.replace(tzinfo=UTC)
+        occurred_at = occurred.timestamp()
+    return PurchaseEvent(event_id=event_id, user_id=user_id, occurred_at=occurred_at)
+
+
+class RecentIds:
+    """The most recently seen `max_size` ids, for spotting events that are delivered more than once."""
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._ids: OrderedDict[str, None] = OrderedDict()
+
+    def add(self, id: str) -> bool:
+        """Remembers an id, and returns whether it was new."""
+        if id in self._ids:
+            self._ids.move_to_end(id)
+            return False
+        self._ids[id] = None
+        if len(self._ids) > self._max_size:
+            self._ids.popitem(last=False)
+        return True
+
+
+# How much of a byte stream is read at once. Reads return whatever has
+# arrived, up to this much, so lines are handed over in blocks.
+_READ_SIZE = 64 * 1024
+
+
+class _ChunkReader:
+    """
+    Reads lines from a stream in a thread of their own, and hands them over in chunks.
+
+    Blocks of lines are queued as they are read, so the thread never blocks
+    the event loop, and lines cross between threads a block rather than a
+    line at a time. The queue is bounded, so reading doesn't run far ahead of
+    writing. An error reading the stream, such as bytes that aren't UTF-8, is
+    queued too, and raised once the lines read before it have been taken, so
+    a failed read is never mistaken for the end of the stream.
+    """
+
+    def __init__(self, stream: TextIO, chunk_size: int, max_latency: float):
+        self._chunk_size = chunk_size
+        self._max_latency = max_latency
+        self._blocks: queue.Queue[list[str] | Exception | None] = queue.Queue(maxsize=16)
+        self._pending: list[str] = []
+        self._done = False
+        self._error: Exception | None = None
+        threading.Thread(target=self._read, args=(stream,), name="purchase-reader", daemon=True).start()
+
+    def _read(self, stream: TextIO) -> None:
+        try:
+            buffer = getattr(stream, "buffer", None)
+            if buffer is None or not hasattr(buffer, "read1"):
+                # A text stream with no bytes underneath, such as a StringIO.
+                for line in stream:
+                    self._blocks.put([line])
+                return
+            partial = b""
+            while block := buffer.read1(_READ_SIZE):
+                # Decode whole lines only, since a block may end part way through a character.
+                complete, newline, partial = (partial + block).rpartition(b"\n")
+                if newline:
+                    self._blocks.put(complete.decode().split("\n"))
+            if partial:
+                self._blocks.put([partial.decode()])
+        except Exception as e:
+            self._blocks.put(e)
+        finally:
+            self._blocks.put(None)
+
+    def take(self) -> list[str] | None:
+        """
+        Waits for a line, then takes more until the chunk is full or `max_latency` has passed.
+
+        Returns None once the stream has ended, and raises the error reading
+        it if there was one. This blocks, so run it in a thread.
+        """
+        deadline = None
+        while not self._done and len(self._pending) < self._chunk_size:
+            if not self._pending:
+                block = self._blocks.get()
+            else:
+                if deadline is None:
+                    deadline = time.monotonic() + self._max_latency
+                try:
+                    block = self._blocks.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if block is None:
+                self._done = True
+            elif isinstance(block, Exception):
+                self._done = True
+                self._error = block
+            else:
+                self._pending.extend(block)
+        chunk = self._pending[: self._chunk_size]
+        del self._pending[: self._chunk_size]
+        if not chunk and self._error is not None:
+            raise self._error
+        return chunk or None
+
+
+async def read_line_chunks(stream: TextIO, chunk_size: int, max_latency: float) -> AsyncIterator[list[str]]:
+    """
+    Reads lines from a stream, such as stdin, in chunks of up to `chunk_size` lines.
+
+    A chunk is yielded once it is full, or once `max_latency` seconds have
+    passed since its first line arrived, so a quiet stream doesn't hold
+    events back.
+    """
+    reader = _ChunkReader(stream, chunk_size, max_latency)
+    while (chunk := await asyncio.to_thread(reader.take)) is not None:
+        yield chunk
+
+
+async def confirm_purchases(
+    db: Database,
+    stream: TextIO,
+    chunk_size: int = 5_000,
+    max_latency: float = 1.0,
+    dedup_window: int = 100_000,
+    report: Callable[[str], None] = print,
+) -> ConfirmResult:
+    """
+    Confirms pending referrals from a stream of NDJSON purchase events, a chunk at a time.
+
+    Each chunk is applied in its own transaction. Events whose id was seen in
+    the last `dedup_window` events are skipped, as are further purchases by
+    a user already in the chunk. Confirming only ever moves a referral from
+    pending, so replaying a stream, or part of one, is harmless.
+
+    After each chunk, the throughput so far and the lag (how long ago the
+    latest purchase in the chunk was made) are reported.
+    """
+    started = time.monotonic()
+    recent = RecentIds(dedup_window)
+    line_number = read = duplicates = invalid = confirmed = 0
+    max_lag = None
+
+    async for lines in read_line_chunks(stream, chunk_size, max_latency):
+        user_ids: dict[int, None] = {}
+        latest = None
+        for line in lines:
+            line_number += 1
+            if not line.strip():
+                continue
+            read += 1
+            try:
+                event = parse_event(json.loads(line))
+            except ValueError as e:
+                invalid += 1
+                report(f"Skipping line {line_number}: {e}")
+                continue
+            if not recent.add(event.event_id) or event.user_id in user_ids:
+                duplicates += 1
+                continue
+            user_ids[event.user_id] = None
+            if event.occurred_at is not None and (latest is None or event.occurred_at > latest):
+                latest = event.occurred_at
+
+        if user_ids:
+            # In index order, so each lookup lands near the one before it.
+            confirmed += await db.confirm_referrals(sorted(user_ids))
+
+        message = (
+            f"Read {read} events, confirmed {confirmed} referrals ({read / (time.monotonic() - started):.0f} events/s"
+        )
+        if latest is not None:
+            lag = max(0.0, time.time() - latest)
+            max_lag = lag if max_lag is None else max(max_lag, lag)
+            message += f", lag {lag:.1f}s"
+        report(message + ")")
+
+    return ConfirmResult(
+        read=read,
+        duplicates=duplicates,
+        invalid=invalid,
+        confirmed=confirmed,
+        seconds=time.monotonic() - started,
+        max_lag=max_lag,
+    )
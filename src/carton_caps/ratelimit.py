@@ -0,0 +1,128 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+# Idle buckets swept from the front of a shard on each check. More than one,
+# so that sweeping keeps up with keys arriving.
+_SWEEP_PER_CHECK = 2
+
+
+@dataclass
+class RateLimiterStats:
+    """A point-in-time snapshot of rate limiter usage."""
+
+    keys: int
+    allowed: int
+    rejected: int
+    evictions: int
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated_at", "refill_at")
+
+    def __init__(self, tokens: float, updated_at: float, refill_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        # When the bucket will be full again, after which it is no different from having no bucket at all.
+        self.refill_at = refill_at
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Ordered from least to most recently checked.
+        self.buckets: OrderedDict[tuple[str, Hashable], _Bucket] = OrderedDict()
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits, each keyed by something about the request (a client IP, a referral code).
+
+    `limits` maps a rule's name to how many requests it allows and over how
+    many seconds, as in `{"signup": (10, 60.0)}`. Each key starts with a full
+    bucket of that many tokens, which refills steadily over the period, so a
+    client may burst up to the limit and then continues at its average rate.
+
+    Buckets are spread over `shards` independently locked shards, each holding
+    at most its share of `max_keys`. Each check is O(1): it updates one bucket
+    and sweeps a couple of buckets that have refilled, which are no different
+    from having none, from the front of the shard. When a shard is full, its
+    least recently checked key is evicted.
+    """
+
+    def __init__(self, limits: dict[str, tuple[int, float]], max_keys: int = 100_000, shards: int = 16):
+        self._limits = {rule: (float(count), count / period) for rule, (count, period) in limits.items()}
+        self._shards = [_Shard() for _ in range(shards)]
+        self._max_keys_per_shard = max(1, max_keys // shards)
+
+        self._allowed = 0
+        self._rejected = 0
+        self._evictions = 0
+
+    def acquire(self, rule: str, key: Hashable) -> float:
+        """
+        Takes a token from the key's bucket for a rule.
+
+        Returns 0 if the request is allowed, or else how many seconds to wait
+        before a token is available. A rule that isn't configured allows
+        everything.
+        """
+        limit = self._limits.get(rule)
+        if limit is None:
+            return 0.0
+        capacity, rate = limit
+
+        bucket_key = (rule, key)
+        shard = self._shards[hash(bucket_key) % len(self._shards)]
+        now = time.monotonic()
+        with shard.lock:
+            bucket = shard.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = shard.buckets[bucket_key] = _Bucket(capacity, now, now)
+            else:
+                bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated_at) * rate)
+                bucket.updated_at = now
+                shard.buckets.move_to_end(bucket_key)
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - bucket.tokens) / rate
+            bucket.refill_at = now + (capacity - bucket.tokens) / rate
+
+            self._sweep(shard, now)
+
+        if retry_after:
+            self._rejected += 1
+        else:
+            self._allowed += 1
+        return retry_after
+
+    def _sweep(self, shard: _Shard, now: float) -> None:
+        for _ in range(_SWEEP_PER_CHECK):
+            oldest_key = next(iter(shard.buckets))
+            if shard.buckets[oldest_key].refill_at > now:
+                break
+            del shard.buckets[oldest_key]
+
+        while len(shard.buckets) > self._max_keys_per_shard:
+            shard.buckets.popitem(last=False)
+            self._evictions += 1
+
+    def stats(self) -> RateLimiterStats:
+        """Returns a snapshot of how many keys are tracked and how many requests were let through."""
+        return RateLimiterStats(
+            keys=sum(len(shard.buckets) for shard in self._shards),
+            allowed=self._allowed,
+            rejected=self._rejected,
+            evictions=self._evictions,
+        )
+
+
+def retry_after_header(seconds: float) -> str:
+    """Formats a wait as a `Retry-After` header, which only takes whole seconds."""
+    return str(max(1, math.ceil(seconds)))
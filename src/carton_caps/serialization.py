@@ -0,0 +1,78 @@
+import json
+from typing import Any, Callable
+
+from carton_caps.database import Referral, Relative
+
+try:
+    # orjson is an optional dependency (pip install carton-caps[fast]) which
+    # encodes several times faster than the standard library.
+    import orjson  # pyright: ignore[reportMissingImports]
+except ImportError:
+    orjson = None
+
+try:
+    # msgpack is an optional dependency (pip install carton-caps[msgpack]).
+    # Without it, clients asking for MessagePack are sent JSON.
+    import msgpack  # pyright: ignore[reportMissingImports]
+except ImportError:
+    msgpack = None
+
+# Compact and UTF-8, which is what orjson produces, so the bytes on the wire
+# (and so the ETag) don't depend on which encoder is installed.
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps(obj: Any) -> bytes:
+    """Encodes an object as JSON, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _encoder.encode(obj).encode()
+
+
+def packb(obj: Any) -> bytes:
+    """Encodes an object as MessagePack. Only available if msgpack is installed."""
+    if msgpack is None:
+        raise RuntimeError("MessagePack requires the msgpack package (pip install carton-caps[msgpack])")
+    return msgpack.packb(obj)  # pyright: ignore[reportReturnType]
+
+
+# The representations a response can be encoded as, by content type. JSON
+# comes first, so it is what clients get unless they ask for something else.
+REPRESENTATIONS: dict[str, Callable[[Any], bytes]] = {"application/json": dumps}
+if msgpack is not None:
+    REPRESENTATIONS["application/msgpack"] = packb
+    REPRESENTATIONS["application/x-msgpack"] = packb
+
+
+def referral_to_dict(referral: Referral) -> dict[str, Any]:
+    """
+    Converts a Referral to a dictionary ready to be encoded as JSON.
+
+    This is what `dataclasses.asdict` would return, without the recursive
+    deep copy of every field.
+    """
+    user = referral.user
+    return {
+        "id": referral.id,
+        "user": {
+            "id": user.id,
+            "name": user.name,
+            "avatar_url": user.avatar_url,
+        },
+        "status": referral.status,
+        "created_at": referral.created_at,
+    }
+
+
+def relative_to_dict(relative: Relative) -> dict[str, Any]:
+    """Converts a Relative to a dictionary ready to be encoded as JSON."""
+    user = relative.user
+    return {
+        "user": {
+            "id": user.id,
+            "name": user.name,
+            "avatar_url": user.avatar_url,
+        },
+        "depth": relative.depth,
+        "referred_by": relative.referred_by,
+    }
@@ -0,0 +1,56 @@
+import importlib.util
+
+from hypercorn.config import Config
+from hypercorn.run import run
+
+
+def uvloop_available() -> bool:
+    """Returns whether uvloop is installed (pip install -e '.[fast]')."""
+    return importlib.util.find_spec("uvloop") is not None
+
+
+def server_config(
+    application_path: str,
+    host: str = "0.0.0.0",
+    port: int = 5000,
+    workers: int = 1,
+    keep_alive: float = 5.0,
+    graceful_timeout: float = 30.0,
+    h2_max_concurrent_streams: int = 100,
+    certfile: str | None = None,
+    keyfile: str | None = None,
+    access_log: bool = False,
+    use_uvloop: bool = True,
+) -> Config:
+    """
+    Builds the Hypercorn configuration for serving the app in production.
+
+    `application_path` is how each worker loads the app, as in
+    `"carton_caps.app:create_app()"`. Workers are fresh processes (spawned,
+    not forked) which call the factory themselves, so each has its own
+    connection pool, writer, cache and rate limits.
+
+    HTTP/2 is negotiated over TLS when a certificate is given, and otherwise
+    offered to clients that ask for it in cleartext (h2c). On SIGTERM or
+    SIGINT, each worker stops accepting connections, gives in-flight requests
+    up to `graceful_timeout` seconds to finish, and then runs the app's
+    after_serving handlers, which commit queued writes and close the
+    database connections.
+    """
+    config = Config()
+    config.application_path = application_path
+    config.bind = [f"{host}:{port}"]
+    config.workers = workers
+    config.worker_class = "uvloop" if use_uvloop and uvloop_available() else "asyncio"
+    config.keep_alive_timeout = keep_alive
+    config.graceful_timeout = graceful_timeout
+    config.h2_max_concurrent_streams = h2_max_concurrent_streams
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.accesslog = "-" if access_log else None
+    return config
+
+
+def serve(config: Config) -> int:
+    """Runs Hypercorn until it is told to shut down, and returns its exit code."""
+    return run(config)
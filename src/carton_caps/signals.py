@@ -0,0 +1,72 @@
+import hashlib
+import ipaddress
+from dataclasses import dataclass
+
+# How much each kind of signal counts towards holding a referral when it has
+# already been seen in the referrer's tree. No one signal is enough: a family
+# shares a tablet or a mailbox, and many people share an IP prefix behind a
+# carrier or office network. Any two together are.
+SIGNAL_WEIGHTS = {"device": 0.75, "email": 0.75, "ip": 0.5}
+
+# Referrals scoring at least this much are held for review rather than pending.
+HOLD_SCORE = 1.0
+
+# Mail providers that ignore dots in the local part of an address.
+_DOTLESS_DOMAINS = {"gmail.com", "googlemail.com"}
+
+
+def normalize_email(email: str) -> str | None:
+    """
+    Reduces an email address to the mailbox it delivers to, or None if it isn't one.
+
+    Case and any `+tag` are dropped, as are dots for providers that ignore
+    them, so that `Fox.Mulder+2@gmail.com` and `foxmulder@gmail.com` match.
+    """
+    local, at, domain = email.strip().lower().rpartition("@")
+    if not at or not local or not domain:
+        return None
+    local = local.split("+", 1)[0]
+    if domain in _DOTLESS_DOMAINS:
+        local = local.replace(".", "")
+        domain = "gmail.com"
+    return f"{local}@{domain}"
+
+
+def ip_prefix(address: str) -> str | None:
+    """
+    Returns the network an IP address belongs to, or None if it isn't an address.
+
+    IPv4 addresses are reduced to their /24 and IPv6 addresses to their /64,
+    the smallest block usually handed to a single customer.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    prefix = 24 if ip.version == 4 else 64
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+def signal_hash(kind: str, value: str) -> bytes:
+    """Hashes a signal, so that raw device ids and email addresses are never stored."""
+    return hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=16).digest()
+
+
+@dataclass(slots=True, frozen=True)
+class SignupSignals:
+    """What a signup request tells us about who is signing up, any of which may be missing."""
+
+    device_id: str | None = None
+    ip_address: str | None = None
+    email: str | None = None
+
+    def hashed(self) -> list[tuple[str, bytes]]:
+        """Returns the kind and hash of each signal that is present, normalized first."""
+        signals = []
+        if self.device_id:
+            signals.append(("device", self.device_id))
+        if self.ip_address and (prefix := ip_prefix(self.ip_address)) is not None:
+            signals.append(("ip", prefix))
+        if self.email and (email := normalize_email(self.email)) is not None:
+            signals.append(("email", email))
+        return [(kind, signal_hash(kind, value)) for kind, value in signals]
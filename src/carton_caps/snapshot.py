@@ -0,0 +1,50 @@
+import os
+import sqlite3
+
+from carton_caps.connection import apply_pragmas
+
+# Pages copied per step of a backup. Between steps the source is unlocked, so
+# a snapshot of a live database doesn't hold up its writer for long.
+_PAGES_PER_STEP = 4096
+
+
+def create_snapshot(database_path: str, snapshot_path: str) -> None:
+    """
+    Writes a consistent copy of a database to `snapshot_path`, using SQLite's backup API.
+
+    The database may be in use. The copy is written next to its destination
+    and renamed into place once complete, so a reader never sees half a
+    snapshot.
+    """
+    partial_path = snapshot_path + ".partial"
+    source = sqlite3.connect(database_path)
+    try:
+        target = sqlite3.connect(partial_path)
+        try:
+            source.backup(target, pages=_PAGES_PER_STEP)
+            # A snapshot is a single file, so it mustn't be left waiting on a WAL.
+            target.execute("PRAGMA journal_mode = DELETE").fetchall()
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(partial_path, snapshot_path)
+
+
+def restore_snapshot(snapshot_path: str, database_path: str) -> None:
+    """
+    Replaces the contents of a database with a snapshot, using SQLite's backup API.
+
+    This is for bootstrapping a database before the app starts: nothing else
+    may be using the database.
+    """
+    source = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    try:
+        target = sqlite3.connect(database_path)
+        try:
+            source.backup(target, pages=_PAGES_PER_STEP)
+            apply_pragmas(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
@@ -0,0 +1,45 @@
+from datetime import UTC, datetime, timedelta
+
+# Timestamps are stored as whole microseconds since the Unix epoch, UTC: an
+# 8 byte integer rather than a 32 character string, which compares as a
+# number. Microseconds keep every timestamp `datetime.isoformat()` wrote
+# before exactly.
+_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def to_microseconds(value: datetime | str) -> int:
+    """
+    Converts a datetime, or an ISO 8601 string, to microseconds since the epoch.
+
+    Times without a timezone are taken to be UTC. Raises ValueError if a
+    string isn't a timestamp.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def now_microseconds() -> int:
+    """Returns the current time in microseconds since the epoch."""
+    return to_microseconds(datetime.now(UTC))
+
+
+def to_iso(microseconds: int) -> str:
+    """Converts microseconds since the epoch to an ISO 8601 string in UTC, as `datetime.isoformat()` writes it."""
+    return (_EPOCH + microseconds * _MICROSECOND).isoformat()
+
+
+def iso_sql(column: str) -> str:
+    """
+    Returns an SQL expression converting a column of microseconds since the epoch to the string `to_iso` returns.
+
+    For queries whose rows are passed on as they are, such as exports,
+    without a Python function call per row.
+    """
+    return (
+        f"strftime('%Y-%m-%dT%H:%M:%S', {column} / 1000000, 'unixepoch')"
+        f" || CASE WHEN {column} % 1000000 THEN printf('.%06d', {column} % 1000000) ELSE '' END || '+00:00'"
+    )
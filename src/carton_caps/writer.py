@@ -0,0 +1,161 @@
+import asyncio
+import sqlite3
+from dataclasses import dataclass
+from typing import Any, Callable, TypeVar
+
+import aiosqlite
+
+from carton_caps.connection import connect, run_sync
+
+T = TypeVar("T")
+
+WriteJob = Callable[[sqlite3.Connection], Any]
+"""A unit of write work. It runs on the writer's thread inside the batch transaction."""
+
+
+@dataclass
+class WriterStats:
+    """A point-in-time snapshot of writer throughput."""
+
+    jobs: int
+    batches: int
+    largest_batch: int
+    queued: int
+
+
+def apply_batch(conn: sqlite3.Connection, jobs: list[WriteJob]) -> list[tuple[bool, Any]]:
+    """
+    Applies a batch of write jobs in a single transaction.
+
+    Each job runs inside its own savepoint so that a job which fails (say, on
+    a UNIQUE constraint) is rolled back on its own without taking the rest of
+    the batch down with it. Returns a list of `(succeeded, result_or_error)`.
+    """
+    outcomes: list[tuple[bool, Any]] = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for job in jobs:
+            conn.execute("SAVEPOINT job")
+            try:
+                result = job(conn)
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                outcomes.append((False, e))
+            else:
+                conn.execute("RELEASE job")
+                outcomes.append((True, result))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return outcomes
+
+
+class Writer:
+    """
+    A single task that owns the only write connection to the database.
+
+    SQLite allows one writer at a time, so rather than having every request
+    fight over the write lock, write jobs are queued up and applied by this
+    task. Jobs that arrive while a batch is being committed are grouped into
+    the next transaction (group commit), so a burst of writes costs one fsync
+    instead of one per write. `max_latency` bounds how long the writer will
+    linger waiting for more jobs once a batch has started.
+    """
+
+    def __init__(self, path: str, max_batch_size: int = 64, max_latency: float = 0.001):
+        self._path = path
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+        self._queue: asyncio.Queue[tuple[WriteJob, asyncio.Future] | None] = asyncio.Queue()
+        self._conn: aiosqlite.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+        self._jobs = 0
+        self._batches = 0
+        self._largest_batch = 0
+
+    async def start(self) -> None:
+        """Opens the write connection and starts the writer task."""
+        # Transactions are managed explicitly by apply_batch.
+        self._conn = await connect(self._path, isolation_level=None)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Applies any queued jobs, then stops the writer task and closes the write connection."""
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def submit(self, job: Callable[[sqlite3.Connection], T]) -> T:
+        """Queues a write job and waits for the transaction containing it to commit."""
+        if self._task is None:
+            raise RuntimeError("Writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, future))
+        return await future
+
+    def stats(self) -> WriterStats:
+        """Returns a snapshot of the number of jobs and batches applied."""
+        return WriterStats(
+            jobs=self._jobs,
+            batches=self._batches,
+            largest_batch=self._largest_batch,
+            queued=self._queue.qsize(),
+        )
+
+    async def _run(self) -> None:
+        assert self._conn is not None
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            stopping = await self._fill_batch(batch)
+
+            jobs = [job for job, _ in batch]
+            try:
+                outcomes = await run_sync(self._conn, apply_batch, jobs)
+            except Exception as e:
+                # The transaction itself failed, so every job in it failed.
+                outcomes = [(False, e)] * len(batch)
+
+            for (_, future), (succeeded, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if succeeded:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+            self._jobs += len(batch)
+            self._batches += 1
+            self._largest_batch = max(self._largest_batch, len(batch))
+
+    async def _fill_batch(self, batch: list[tuple[WriteJob, asyncio.Future]]) -> bool:
+        """Adds queued jobs to the batch until it is full or `max_latency` has passed. Returns True on stop."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_latency
+        while len(batch) < self._max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except TimeoutError:
+                    break
+            if item is None:
+                return True
+            batch.append(item)
+        return False
@@ -5,6 +5,7 @@ import pytest
 import pytest_asyncio
 
 from carton_caps.app import create_app, get_db
+from carton_caps.database import Database
 
 
 @pytest_asyncio.fixture
@@ -17,6 +18,8 @@ async def app():
             test_config={
                 "TESTING": True,
                 "DATABASE": db_path,
+                # Tests make many requests from one client. Rate limiting is tested on its own.
+                "RATE_LIMITS": None,
             },
             instance_path=instance_path,
         )
@@ -33,3 +36,30 @@ async def app():
 def client(app):
     """A test client for the app."""
     return app.test_client()
+
+
+@pytest_asyncio.fixture
+async def db_path():
+    """Pytest fixture providing the path of a migrated, empty database file."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.sqlite")
+        database = Database(path)
+        await database.init_db()
+        await database.close()
+        yield path
+
+
+@pytest.fixture
+def directory():
+    """Pytest fixture providing an empty temporary directory."""
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+
+@pytest_asyncio.fixture
+async def db():
+    """Pytest fixture to set up and tear down an empty in-memory database."""
+    database = Database(":memory:")
+    await database.init_db()
+    yield database
+    await database.close()
@@ -1,6 +1,15 @@
+import asyncio
+import gzip
+import json
+import tempfile
+
 import pytest
+from quart.testing.app import LifespanError
 
-from carton_caps.app import get_db
+from carton_caps.app import create_app, get_db, hold_stream_slot, stream_json_array
+from carton_caps.connection import run_sync
+from carton_caps.database import Database, Referral, ReferralUser
+from carton_caps.ratelimit import RateLimiter
 
 
 @pytest.mark.asyncio
@@ -72,3 +81,1005 @@ async def test_get_user_referrals_not_found(client):
     assert response.status_code == 404
     data = await response.get_json()
     assert data["error"] == f"User with ID {user_id} not found"
+
+
+@pytest.mark.asyncio
+async def test_requests_lease_connections_from_pool(app):
+    """Tests that while serving, requests share connections from the app-wide pool."""
+    # Arrange
+    async with app.app_context():
+        db = get_db()
+        mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+
+    # Bypass the cache so that every request reads from the database
+    app.extensions.pop("referral_cache")
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        pool = app.extensions["db_pool"]
+
+        # Act
+        for _ in range(5):
+            response = await client.get(f"/users/{mulder.id}/referrals")
+            assert response.status_code == 200
+
+        stats = pool.stats()
+
+    # Assert
+    assert stats.acquired == 5
+    assert stats.size == 1
+    assert stats.in_use == 0
+    assert "db_pool" not in app.extensions
+
+
+async def _wait_until_ready(client):
+    """Waits for a serving app to finish warming up, and returns the last readiness response."""
+    for _ in range(100):
+        response = await client.get("/health/ready")
+        if response.status_code == 200:
+            break
+        await asyncio.sleep(0.01)
+    return response
+
+
+async def _create_user_with_referrals(app, count: int) -> int:
+    """Creates a user who has referred `count` other users, and returns their id."""
+    async with app.app_context():
+        db = get_db()
+        source = await db.create_user("Fox Mulder", "TRUSTNO1")
+        for i in range(count):
+            target = await db.create_user(f"Referred User {i}", f"CODE{i}")
+            await db.create_referral(source.id, target.id, "pending")
+    return source.id
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_paginates(app, client):
+    """Tests that a client can page through referrals by following the next link."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 5)
+    url = f"/users/{user_id}/referrals?limit=2"
+
+    # Act
+    pages = []
+    while url:
+        response = await client.get(url)
+        assert response.status_code == 200
+        pages.append(await response.get_json())
+        link = response.headers.get("Link")
+        url = link[1 : link.index(">")] if link else None
+
+    # Assert
+    assert [len(page) for page in pages] == [2, 2, 1]
+    ids = [item["id"] for page in pages for item in page]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 5
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_last_page_has_no_next_link(app, client):
+    """Tests that no next link is returned when a page holds the remaining referrals exactly."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?limit=2")
+
+    # Assert
+    assert response.status_code == 200
+    assert len(await response.get_json()) == 2
+    assert "Link" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_stream_matches_buffered(app, client):
+    """Tests that a streamed listing has the same content as a buffered one."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 150)
+
+    # Act
+    buffered = await client.get(f"/users/{user_id}/referrals")
+    streamed = await client.get(f"/users/{user_id}/referrals?stream=true")
+
+    # Assert
+    assert streamed.status_code == 200
+    assert streamed.mimetype == "application/json"
+    assert await streamed.get_json() == await buffered.get_json()
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_stream_paginates(app, client):
+    """Tests that a streamed page carries a next link pointing after its last referral."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?stream=true&limit=2")
+
+    # Assert
+    data = await response.get_json()
+    assert len(data) == 2
+    assert f"after={data[-1]['id']}" in response.headers["Link"]
+    assert "stream=true" in response.headers["Link"]
+
+
+@pytest.mark.asyncio
+async def test_stream_closes_referrals_before_connection():
+    """Tests that a stream the client abandons closes its referral cursor before it closes the connection."""
+    # Arrange
+    closed = []
+
+    class ClosingDatabase:
+        async def close(self):
+            closed.append("connection")
+
+    async def referrals():
+        try:
+            for i in range(1000):
+                yield Referral(
+                    id=i,
+                    user=ReferralUser(id=i, name=f"User {i}", avatar_url="https://place-hold.it/64x64"),
+                    status="pending",
+                    created_at="2025-08-10T20:03:00+00:00",
+                )
+        finally:
+            closed.append("referrals")
+
+    body = stream_json_array(ClosingDatabase(), referrals())  # pyright: ignore[reportArgumentType]
+
+    # Act
+    assert await anext(body) == b"["
+    await anext(body)
+    await body.aclose()
+
+    # Assert
+    assert closed == ["referrals", "connection"]
+
+
+@pytest.mark.asyncio
+async def test_stream_slot_held_until_body_closes():
+    """Tests that a stream slot is taken when the body starts, and given back when the client goes away."""
+    # Arrange
+    slots = asyncio.Semaphore(1)
+
+    async def chunks():
+        for _ in range(1000):
+            yield b"chunk"
+
+    body = hold_stream_slot(slots, chunks())
+
+    # Act
+    before = slots.locked()
+    await anext(body)
+    during = slots.locked()
+    await body.aclose()
+
+    # Assert
+    assert not before
+    assert during
+    assert not slots.locked()
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_stream_limit(app, client):
+    """Tests that a stream is turned away with a 503 while every stream slot is taken."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+    slots = app.extensions["stream_slots"]
+    for _ in range(app.config["MAX_STREAMS"]):
+        await slots.acquire()
+
+    # Act
+    refused = await client.get(f"/users/{user_id}/referrals?stream=true")
+    slots.release()
+    accepted = await client.get(f"/users/{user_id}/referrals?stream=true")
+
+    # Assert
+    assert refused.status_code == 503
+    assert accepted.status_code == 200
+    assert len(await accepted.get_json()) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", ["limit=0", "limit=abc", "after=abc"])
+async def test_get_user_referrals_invalid_page(app, client, query):
+    """Tests that a 400 is returned for a page size outside the allowed range, or a limit or cursor that isn't an integer."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?{query}")
+
+    # Assert
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_filtered(app, client):
+    """Tests filtering referrals by status and time, newest first, with the next link keeping the filters."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+    async with app.app_context():
+        db = get_db()
+        for i in range(3):
+            target = await db.create_user(f"Held User {i}", f"HELD{i}")
+            await db.create_referral(user_id, target.id, "held")
+    url = f"/users/{user_id}/referrals?status=held&since=2000-01-01T00:00:00%2B00:00&order=desc&limit=2"
+
+    # Act
+    pages = []
+    while url:
+        response = await client.get(url)
+        assert response.status_code == 200
+        pages.append(await response.get_json())
+        link = response.headers.get("Link")
+        url = link[1 : link.index(">")] if link else None
+
+    # Assert
+    assert [len(page) for page in pages] == [2, 1]
+    names = [item["user"]["name"] for page in pages for item in page]
+    assert names == ["Held User 2", "Held User 1", "Held User 0"]
+    assert all(item["status"] == "held" for page in pages for item in page)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", ["status=lapsed", "since=yesterday", "until=2025-13-01", "order=newest"])
+async def test_get_user_referrals_invalid_filter(app, client, query):
+    """Tests that a 400 is returned for an unknown status or order, or a time that isn't ISO 8601."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?{query}")
+
+    # Assert
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_reads_in_one_trip(app, client, monkeypatch):
+    """Tests that a page of referrals, and the check that their user exists, are read in one trip to the database."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+    trips = []
+
+    async def counted(conn, fn, *args):
+        trips.append(fn)
+        return await run_sync(conn, fn, *args)
+
+    monkeypatch.setattr("carton_caps.database.run_sync", counted)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?limit=2")
+    missing = await client.get("/users/999/referrals?limit=2")
+
+    # Assert
+    assert response.status_code == 200
+    assert len(await response.get_json()) == 2
+    assert missing.status_code == 404
+    assert len(trips) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_served_from_cache(app, client):
+    """Tests that repeat requests are served from the cache until a new referral is created."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+    cache = app.extensions["referral_cache"]
+    await client.get(f"/users/{user_id}/referrals")
+    hits = cache.stats().hits
+
+    # Act
+    cached = await client.get(f"/users/{user_id}/referrals")
+    async with app.app_context():
+        db = get_db()
+        target = await db.create_user("Leonard Betts", "REGENERATE")
+        await db.create_referral(user_id, target.id, "pending")
+    refreshed = await client.get(f"/users/{user_id}/referrals")
+
+    # Assert
+    # The repeat request hits, the one after the new referral misses
+    assert cache.stats().hits == hits + 1
+    assert len(await cached.get_json()) == 2
+    assert len(await refreshed.get_json()) == 3
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_not_modified(app, client, monkeypatch):
+    """Tests that a matching If-None-Match gets a 304 without the referrals being read."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+    response = await client.get(f"/users/{user_id}/referrals")
+    etag = response.headers["ETag"]
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("referrals should not be read")
+
+    monkeypatch.setattr(Database, "get_referrals_by_source_id", fail)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"If-None-Match": etag})
+
+    # Assert
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert await response.get_data() == b""
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_etag_changes_with_referrals(app, client):
+    """Tests that a new referral changes the ETag, so a stale If-None-Match gets the new list."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+    response = await client.get(f"/users/{user_id}/referrals")
+    etag = response.headers["ETag"]
+
+    # Write with a connection of its own, as another process would, so the
+    # app's cache isn't told about it.
+    db = Database(app.config["DATABASE"])
+    target = await db.create_user("Leonard Betts", "REGENERATE")
+    await db.create_referral(user_id, target.id, "pending")
+    await db.close()
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"If-None-Match": etag})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(await response.get_json()) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_referrals_batch(app, client):
+    """Tests fetching the referrals of several users in one request, with a per-entry error for a missing user."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+
+    # Act
+    response = await client.get(f"/referrals?user_ids={user_id},999")
+
+    # Assert
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert [entry["user_id"] for entry in data["results"]] == [user_id, 999]
+    assert len(data["results"][0]["referrals"]) == 3
+    assert data["results"][1]["error"] == "User with ID 999 not found"
+
+
+@pytest.mark.asyncio
+async def test_post_referrals_batch(app, client):
+    """Tests fetching the referrals of several users with the ids in a JSON body."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+
+    # Act
+    response = await client.post("/referrals/batch", json={"user_ids": [user_id]})
+
+    # Assert
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert len(data["results"][0]["referrals"]) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", ["", "user_ids=", "user_ids=1,two", "user_ids=" + ",".join(map(str, range(501)))])
+async def test_get_referrals_batch_invalid(client, query):
+    """Tests that a 400 is returned for missing, malformed or too many user ids."""
+    # Act
+    response = await client.get(f"/referrals?{query}")
+
+    # Assert
+    assert response.status_code == 400
+
+
+async def _create_referral_chain(app, length: int) -> list[int]:
+    """Creates a chain of users, each referred by the one before, and returns their ids in order."""
+    async with app.app_context():
+        db = get_db()
+        ids = [(await db.create_user(f"User {i}", f"CODE{i}")).id for i in range(length)]
+        for source, target in zip(ids, ids[1:]):
+            await db.create_referral(source, target, "confirmed")
+    return ids
+
+
+@pytest.mark.asyncio
+async def test_get_user_downline_paginates(app, client):
+    """Tests that a client can page through a downline by following the next link."""
+    # Arrange
+    ids = await _create_referral_chain(app, 6)
+
+    # Act
+    seen = []
+    url = f"/users/{ids[0]}/downline?limit=2"
+    while url:
+        response = await client.get(url)
+        assert response.status_code == 200
+        seen += [(item["user"]["id"], item["depth"], item["referred_by"]) for item in await response.get_json()]
+        link = response.headers.get("Link")
+        url = link[1 : link.index(">")] if link else None
+
+    # Assert
+    assert seen == [(ids[depth], depth, ids[depth - 1]) for depth in range(1, 6)]
+
+
+@pytest.mark.asyncio
+async def test_get_user_upline_and_downline_size(app, client):
+    """Tests the upline and downline size of a user in the middle of a chain."""
+    # Arrange
+    ids = await _create_referral_chain(app, 5)
+
+    # Act
+    upline = await client.get(f"/users/{ids[2]}/upline")
+    size = await client.get(f"/users/{ids[2]}/downline/size?max_depth=1")
+
+    # Assert
+    assert [item["user"]["id"] for item in await upline.get_json()] == [ids[1], ids[0]]
+    assert await size.get_json() == {"user_id": ids[2], "size": 1, "levels": [{"depth": 1, "count": 1}]}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path, status",
+    [
+        ("/users/999/downline", 404),
+        ("/users/999/upline", 404),
+        ("/users/999/downline/size", 404),
+        ("/users/{id}/downline?max_depth=0", 400),
+        ("/users/{id}/upline?max_depth=two", 400),
+        ("/users/{id}/downline?after=oops", 400),
+        ("/users/{id}/downline?limit=0", 400),
+        ("/users/{id}/downline?limit=ten", 400),
+    ],
+)
+async def test_referral_tree_errors(app, client, path, status):
+    """Tests that missing users and invalid parameters are rejected."""
+    # Arrange
+    ids = await _create_referral_chain(app, 2)
+
+    # Act
+    response = await client.get(path.format(id=ids[0]))
+
+    # Assert
+    assert response.status_code == status
+
+
+@pytest.mark.asyncio
+async def test_get_user_referral_stats(app, client):
+    """Tests reading a user's referral counts, and revalidating them with their ETag."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals/stats")
+    revalidated = await client.get(
+        f"/users/{user_id}/referrals/stats", headers={"If-None-Match": response.headers["ETag"]}
+    )
+
+    # Assert
+    assert response.status_code == 200
+    assert await response.get_json() == {"user_id": user_id, "total": 3, "by_status": {"pending": 3}}
+    assert revalidated.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_get_user_referral_stats_not_found(client):
+    """Tests that a 404 is returned for the stats of a non-existent user."""
+    # Act
+    response = await client.get("/users/999/referrals/stats")
+
+    # Assert
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_resolve_referral_code(app):
+    """Tests resolving a valid referral code, and turning away an invalid one, while serving."""
+    # Arrange
+    async with app.app_context():
+        db = get_db()
+        mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        # The code index is loaded while warming up
+        await _wait_until_ready(client)
+
+        # Act
+        found = await client.get("/referral-codes/TRUSTNO1")
+        missing = await client.get("/referral-codes/NOTACODE")
+        stats = app.extensions["referral_codes"].stats()
+
+    # Assert
+    assert found.status_code == 200
+    data = await found.get_json()
+    assert data["referral_code"] == "TRUSTNO1"
+    assert data["user"]["id"] == mulder.id
+    assert missing.status_code == 404
+    assert (await missing.get_json())["error"] == "Referral code not found"
+    assert stats.rejected == 1
+    assert "referral_codes" not in app.extensions
+
+
+@pytest.mark.asyncio
+async def test_signup(app, client):
+    """Tests signing up with a referral code."""
+    # Arrange
+    async with app.app_context():
+        mulder = await get_db().create_user("Fox Mulder", "TRUSTNO1")
+
+    # Act
+    response = await client.post("/users", json={"name": "Dana Scully", "referral_code": "TRUSTNO1"})
+
+    # Assert
+    assert response.status_code == 201
+    data = await response.get_json()
+    assert data["user"]["name"] == "Dana Scully"
+    assert data["referred_by"] == mulder.id
+    assert data["referral"]["status"] == "pending"
+    referrals = await (await client.get(f"/users/{mulder.id}/referrals")).get_json()
+    assert [referral["user"]["id"] for referral in referrals] == [data["user"]["id"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body, status",
+    [
+        ({"name": "Fox Mulder"}, 409),
+        ({"name": "Dana Scully", "referral_code": "NOTACODE"}, 400),
+        ({"name": "   "}, 400),
+        ({"referral_code": "TRUSTNO1"}, 400),
+        ({"name": "Dana Scully", "referral_code": 1}, 400),
+        ({"name": "Dana Scully", "device_id": ["scully-phone"]}, 400),
+        ([], 400),
+    ],
+)
+async def test_signup_errors(app, client, body, status):
+    """Tests that taken names, unknown codes and malformed bodies are rejected."""
+    # Arrange
+    async with app.app_context():
+        await get_db().create_user("Fox Mulder", "TRUSTNO1")
+
+    # Act
+    response = await client.post("/users", json=body)
+
+    # Assert
+    assert response.status_code == status
+
+
+@pytest.mark.asyncio
+async def test_signup_from_referrer_device_is_held(app, client):
+    """Tests that a signup from the device and network the referrer signed up on is held rather than pending."""
+    # Arrange
+    scope = {"client": ("203.0.113.5", 50000)}
+    body = {"name": "Fox Mulder", "device_id": "mulder-phone"}
+    mulder = await (await client.post("/users", json=body, scope_base=scope)).get_json()
+    body = {"name": "Dana Scully", "referral_code": mulder["user"]["referral_code"], "device_id": "mulder-phone"}
+
+    # Act
+    response = await client.post("/users", json=body, scope_base=scope)
+
+    # Assert
+    assert response.status_code == 201
+    assert (await response.get_json())["referral"]["status"] == "held"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_signups_with_same_referrer(app):
+    """Tests that concurrent signups against one referrer are all attributed to them, while serving."""
+    # Arrange
+    async with app.app_context():
+        mulder = await get_db().create_user("Fox Mulder", "TRUSTNO1")
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+
+        # Act
+        responses = await asyncio.gather(
+            *(client.post("/users", json={"name": f"User {i}", "referral_code": "TRUSTNO1"}) for i in range(50))
+        )
+        stats = await (await client.get(f"/users/{mulder.id}/referrals/stats")).get_json()
+        writer_stats = app.extensions["db_writer"].stats()
+
+    # Assert
+    assert all(response.status_code == 201 for response in responses)
+    assert stats["by_status"] == {"pending": 50}
+    assert writer_stats.batches < writer_stats.jobs
+
+
+@pytest.mark.asyncio
+async def test_signups_are_rate_limited_per_referrer(app, client):
+    """Tests that signups with one referral code are limited, while other codes are unaffected."""
+    # Arrange
+    app.extensions["rate_limiter"] = RateLimiter({"referrer": (2, 3600.0)})
+    async with app.app_context():
+        db = get_db()
+        await db.create_user("Fox Mulder", "TRUSTNO1")
+        await db.create_user("Dana Scully", "SCULLYMD")
+
+    # Act
+    responses = [await client.post("/users", json={"name": f"User {i}", "referral_code": "TRUSTNO1"}) for i in range(3)]
+    other = await client.post("/users", json={"name": "Walter Skinner", "referral_code": "SCULLYMD"})
+
+    # Assert
+    assert [response.status_code for response in responses] == [201, 201, 429]
+    assert responses[2].headers["Retry-After"] == "1800"
+    assert other.status_code == 201
+    async with app.app_context():
+        rows = await (await get_db().get_conn()).execute_fetchall("SELECT COUNT(*) FROM users")
+        assert list(rows)[0][0] == 5
+
+
+@pytest.mark.asyncio
+async def test_rejected_lookups_never_reach_the_database(app, client, monkeypatch):
+    """Tests that a lookup over the limit is turned away before a database connection is opened."""
+    # Arrange
+    app.extensions["rate_limiter"] = RateLimiter({"lookup": (1, 60.0)})
+    user_id = await _create_user_with_referrals(app, 1)
+    await client.get(f"/users/{user_id}/referrals")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the database was opened")
+
+    monkeypatch.setattr("carton_caps.app.open_db", fail)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals")
+
+    # Assert
+    assert response.status_code == 429
+    assert (await response.get_json()) == {"error": "Too many requests"}
+
+
+@pytest.mark.asyncio
+async def test_readiness_follows_warm_up(app, client):
+    """Tests that the server only reports ready while serving, once warm up has finished."""
+    # Arrange
+    before = await client.get("/health/ready")
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+
+        # Act
+        during = await _wait_until_ready(client)
+        live = await client.get("/health/live")
+
+    after = await client.get("/health/ready")
+
+    # Assert
+    assert before.status_code == 503
+    assert during.status_code == 200
+    assert live.status_code == 200
+    assert after.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_serving_requires_current_schema():
+    """Tests that the server refuses to start on a database that init-db hasn't brought up to date."""
+    # Arrange
+    with tempfile.TemporaryDirectory() as instance_path:
+        app = create_app(test_config={"TESTING": True, "RATE_LIMITS": None}, instance_path=instance_path)
+
+        # Act & Assert
+        with pytest.raises(LifespanError, match="Run quart init-db first"):
+            async with app.test_app():
+                pass
+
+
+@pytest.mark.asyncio
+async def test_metrics(app):
+    """Tests that requests, queries and pool statistics are served at /metrics while serving."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 2)
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        await client.get(f"/users/{user_id}/referrals")
+        await client.get("/users/999/referrals")
+
+        # Act
+        response = await client.get("/metrics")
+        text = await response.get_data(as_text=True)
+
+    # Assert
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert (
+        'carton_caps_request_duration_seconds_count{method="GET",route="/users/<int:user_id>/referrals",status="200"} 1'
+        in text
+    )
+    assert 'route="/users/<int:user_id>/referrals",status="404"' in text
+    assert "carton_caps_startup_schema_seconds" in text
+    assert 'carton_caps_query_duration_seconds_count{query="get_referral_version"}' in text
+    assert "carton_caps_pool_acquired " in text
+    assert "carton_caps_writer_jobs " in text
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_compressed(app, client):
+    """Tests that a large listing is gzipped for a client that accepts it, under a weak ETag."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 50)
+    plain = await client.get(f"/users/{user_id}/referrals")
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"Accept-Encoding": "gzip"})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = gzip.decompress(await response.get_data())
+    assert body == await plain.get_data()
+    assert len(body) > int(response.headers["Content-Length"])
+    assert response.headers["ETag"] == plain.headers["ETag"]
+    assert response.headers["ETag"].startswith("W/")
+
+
+@pytest.mark.asyncio
+async def test_small_response_not_compressed(app, client):
+    """Tests that responses under the size threshold are sent as they are."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"Accept-Encoding": "gzip"})
+
+    # Assert
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert len(await response.get_json()) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_stream_compressed(app, client):
+    """Tests that a streamed listing is compressed as it is streamed, whatever its size."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 150)
+    buffered = await client.get(f"/users/{user_id}/referrals")
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals?stream=true", headers={"Accept-Encoding": "gzip"})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(await response.get_data()) == await buffered.get_data()
+
+
+@pytest.mark.asyncio
+async def test_export_referrals(app, client):
+    """Tests streaming an export of referrals as NDJSON, and then only those added since."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+
+    # Act
+    response = await client.get("/admin/exports/referrals")
+    async with app.app_context():
+        target = await get_db().create_user("The Great Mutato", "CHERFAN")
+        await get_db().create_referral(user_id, target.id, "pending")
+    since = await client.get(f"/admin/exports/referrals?after_id={response.headers['Export-Through-Id']}")
+
+    # Assert
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.headers["Export-Through-Id"] == "3"
+    records = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert [record["target_name"] for record in records] == ["Referred User 0", "Referred User 1", "Referred User 2"]
+    assert records[0]["source_name"] == "Fox Mulder"
+    assert [json.loads(line)["target_name"] for line in (await since.get_data(as_text=True)).splitlines()] == [
+        "The Great Mutato"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_export_users_compressed_csv(app, client):
+    """Tests that an export is compressed as it is streamed when the client accepts it."""
+    # Arrange
+    await _create_user_with_referrals(app, 2)
+
+    # Act
+    response = await client.get("/admin/exports/users?format=csv", headers={"Accept-Encoding": "gzip"})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(await response.get_data()).decode().splitlines() == [
+        "id,name,referral_code,referred_by",
+        "1,Fox Mulder,TRUSTNO1,",
+        "2,Referred User 0,CODE0,1",
+        "3,Referred User 1,CODE1,1",
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "url, status",
+    [
+        ("/admin/exports/purchases", 404),
+        ("/admin/exports/referrals?format=xml", 400),
+        ("/admin/exports/referrals?after_id=latest", 400),
+        ("/admin/exports/referrals?since=yesterday", 400),
+        ("/admin/exports/users?since=2025-01-01", 400),
+    ],
+)
+async def test_export_rejects_invalid(client, url, status):
+    """Tests that unknown exports and invalid parameters are rejected."""
+    # Act
+    response = await client.get(url)
+
+    # Assert
+    assert response.status_code == status
+
+
+@pytest.mark.asyncio
+async def test_export_stream_limit(app, client):
+    """Tests that an export is turned away with a 503 while every stream slot is taken."""
+    # Arrange
+    slots = app.extensions["stream_slots"]
+    for _ in range(app.config["MAX_STREAMS"]):
+        await slots.acquire()
+
+    # Act
+    response = await client.get("/admin/exports/users")
+
+    # Assert
+    assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_compression_disabled(app, client):
+    """Tests that no response is compressed when COMPRESSION_MIN_SIZE is None."""
+    # Arrange
+    app.config["COMPRESSION_MIN_SIZE"] = None
+    user_id = await _create_user_with_referrals(app, 50)
+
+    # Act
+    buffered = await client.get(f"/users/{user_id}/referrals", headers={"Accept-Encoding": "gzip"})
+    streamed = await client.get(f"/users/{user_id}/referrals?stream=true", headers={"Accept-Encoding": "gzip"})
+
+    # Assert
+    assert "Content-Encoding" not in buffered.headers
+    assert "Content-Encoding" not in streamed.headers
+    assert len(await streamed.get_json()) == 50
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_msgpack(app, client):
+    """Tests that a client asking for MessagePack gets the same referrals, encoded as MessagePack."""
+    # Arrange
+    msgpack = pytest.importorskip("msgpack")
+    user_id = await _create_user_with_referrals(app, 3)
+    as_json = await client.get(f"/users/{user_id}/referrals")
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"Accept": "application/msgpack"})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.mimetype == "application/msgpack"
+    assert "Accept" in response.headers["Vary"]
+    assert msgpack.unpackb(await response.get_data()) == await as_json.get_json()
+    assert response.headers["ETag"] == as_json.headers["ETag"]
+
+
+@pytest.mark.asyncio
+async def test_unsupported_accept_gets_json(app, client):
+    """Tests that a client asking only for a representation we don't offer is sent JSON."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+
+    # Act
+    response = await client.get(f"/users/{user_id}/referrals", headers={"Accept": "application/xml"})
+
+    # Assert
+    assert response.status_code == 200
+    assert response.mimetype == "application/json"
+
+
+async def _receive(connection) -> bytes:
+    """Reads the next chunk of a streamed response, failing rather than hanging if none comes."""
+    return await asyncio.wait_for(connection.receive(), 5.0)
+
+
+@pytest.mark.asyncio
+async def test_referral_events_stream_signups(app, client):
+    """Tests that a new client is told to resync, then sent each referral as it is made."""
+    # Arrange
+    async with app.app_context():
+        mulder = await get_db().create_user("Fox Mulder", "TRUSTNO1")
+
+    async with client.request(f"/users/{mulder.id}/referrals/events") as connection:
+        await connection.send_complete()
+        first = await _receive(connection)
+
+        # Act
+        response = await client.post("/users", json={"name": "Dana Scully", "referral_code": "TRUSTNO1"})
+        second = await _receive(connection)
+        await connection.disconnect()
+
+    # Assert
+    assert connection.status_code == 200
+    assert connection.headers["Content-Type"].startswith("text/event-stream")
+    assert first == b'id: 0\nevent: resync\ndata: {"version":0}\n\n'
+    assert second.startswith(b"id: 1\nevent: referral.created\ndata: ")
+    referral = (await response.get_json())["referral"]
+    assert json.loads(second.split(b"data: ", 1)[1]) == referral
+
+
+@pytest.mark.asyncio
+async def test_referral_events_resume(app, client):
+    """Tests that a client reconnecting with Last-Event-ID is sent just the events it missed."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 3)
+
+    # Act
+    async with client.request(f"/users/{user_id}/referrals/events", headers={"Last-Event-ID": "1"}) as connection:
+        await connection.send_complete()
+        messages = [await _receive(connection), await _receive(connection)]
+        await connection.disconnect()
+
+    # Assert
+    assert [message.split(b"\n", 1)[0] for message in messages] == [b"id: 2", b"id: 3"]
+    assert all(b"event: referral.created" in message for message in messages)
+
+
+@pytest.mark.asyncio
+async def test_referral_events_resync_after_unpublished_change(app, client):
+    """Tests that a client is told to resync when changes it missed were made by another process."""
+    # Arrange
+    user_id = await _create_user_with_referrals(app, 1)
+    # A Database without the app's bus stands in for another process.
+    other_process = Database(app.config["DATABASE"])
+    target = await other_process.create_user("Walter Skinner", "SKINMAN")
+    await other_process.create_referral(user_id, target.id, "pending")
+    await other_process.close()
+
+    # Act
+    async with client.request(f"/users/{user_id}/referrals/events", query_string={"last_event_id": "1"}) as connection:
+        await connection.send_complete()
+        message = await _receive(connection)
+        await connection.disconnect()
+
+    # Assert
+    assert message == b'id: 2\nevent: resync\ndata: {"version":2}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_referral_events_heartbeat_notices_changes(app, client):
+    """Tests that an idle stream sends heartbeats, and resyncs when one finds a change made elsewhere."""
+    # Arrange
+    app.config["EVENTS_HEARTBEAT_INTERVAL"] = 0.05
+    user_id = await _create_user_with_referrals(app, 0)
+
+    async with client.request(f"/users/{user_id}/referrals/events") as connection:
+        await connection.send_complete()
+        await _receive(connection)
+        heartbeat = await _receive(connection)
+
+        # Act
+        other_process = Database(app.config["DATABASE"])
+        target = await other_process.create_user("Walter Skinner", "SKINMAN")
+        await other_process.create_referral(user_id, target.id, "pending")
+        await other_process.close()
+        message = await _receive(connection)
+        while message == heartbeat:
+            message = await _receive(connection)
+        await connection.disconnect()
+
+    # Assert
+    assert heartbeat == b": heartbeat\n\n"
+    assert message == b'id: 1\nevent: resync\ndata: {"version":1}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_referral_events_errors(client):
+    """Tests that an unknown user gets a 404 and an unusable Last-Event-ID a 400."""
+    # Act
+    missing = await client.get("/users/999/referrals/events")
+    invalid = await client.get("/users/1/referrals/events", headers={"Last-Event-ID": "abc"})
+
+    # Assert
+    assert missing.status_code == 404
+    assert invalid.status_code == 400
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+
+from carton_caps.cache import Cache, estimate_size
+
+
+def _loader(value, calls: list, delay: float = 0):
+    """Returns a loader that records each call and returns `value`."""
+
+    async def load():
+        calls.append(value)
+        await asyncio.sleep(delay)
+        return value
+
+    return load
+
+
+@pytest.mark.asyncio
+async def test_get_or_load_caches_value():
+    """Tests that a loaded value is served from the cache afterwards."""
+    # Arrange
+    cache = Cache()
+    calls = []
+
+    # Act
+    first = await cache.get_or_load("key", _loader("value", calls))
+    second = await cache.get_or_load("key", _loader("other", calls))
+
+    # Assert
+    assert first == second == "value"
+    assert calls == ["value"]
+    stats = cache.stats()
+    assert (stats.hits, stats.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_ttl():
+    """Tests that an entry is reloaded once its TTL has passed."""
+    # Arrange
+    cache = Cache(ttl=0.01)
+    calls = []
+    await cache.get_or_load("key", _loader("old", calls))
+    await asyncio.sleep(0.02)
+
+    # Act
+    value = await cache.get_or_load("key", _loader("new", calls))
+
+    # Assert
+    assert value == "new"
+    assert calls == ["old", "new"]
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_entry_is_evicted():
+    """Tests that the least recently used entry is evicted when the cache is full."""
+    # Arrange
+    cache = Cache(max_entries=2)
+    calls = []
+    await cache.get_or_load("a", _loader("a", calls))
+    await cache.get_or_load("b", _loader("b", calls))
+    cache.get("a")
+
+    # Act
+    await cache.get_or_load("c", _loader("c", calls))
+
+    # Assert
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.stats().evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_memory_cap_evicts_entries():
+    """Tests that entries are evicted to keep the estimated size under the memory cap."""
+    # Arrange
+    rows = list(range(10))
+    cache = Cache(max_size=estimate_size(rows) * 4)
+    calls = []
+
+    # Act
+    for key in range(5):
+        await cache.get_or_load(key, _loader(rows, calls))
+
+    # Assert
+    stats = cache.stats()
+    assert stats.entries == 4
+    assert stats.size <= estimate_size(rows) * 4
+    assert cache.get(0) is None
+
+
+@pytest.mark.asyncio
+async def test_memory_cap_counts_versioned_listings():
+    """Tests that a versioned listing is costed by its length, so the memory cap evicts it and skips huge ones."""
+    # Arrange
+    listing = (1, list(range(10)))
+    cache = Cache(max_size=estimate_size(listing) * 4)
+    calls = []
+
+    # Act
+    for key in range(5):
+        await cache.get_or_load(key, _loader(listing, calls))
+    await cache.get_or_load("huge", _loader((1, list(range(100_000))), calls))
+
+    # Assert
+    assert estimate_size(listing) == estimate_size(list(range(10)))
+    stats = cache.stats()
+    assert stats.entries == 4
+    assert stats.size <= estimate_size(listing) * 4
+    assert cache.get(0) is None
+    assert cache.get("huge") is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_are_coalesced():
+    """Tests that concurrent misses for the same key share a single load."""
+    # Arrange
+    cache = Cache()
+    calls = []
+
+    # Act
+    values = await asyncio.gather(*(cache.get_or_load("key", _loader("value", calls, delay=0.01)) for _ in range(5)))
+
+    # Assert
+    assert values == ["value"] * 5
+    assert calls == ["value"]
+    assert cache.stats().coalesced == 4
+
+
+@pytest.mark.asyncio
+async def test_invalidate_during_load_discards_result():
+    """Tests that a value loaded before an invalidation isn't cached."""
+    # Arrange
+    cache = Cache()
+    calls = []
+    load = asyncio.create_task(cache.get_or_load("key", _loader("stale", calls, delay=0.01)))
+    await asyncio.sleep(0)
+
+    # Act
+    cache.invalidate("key")
+    stale = await load
+    fresh = await cache.get_or_load("key", _loader("fresh", calls))
+
+    # Assert
+    assert stale == "stale"
+    assert fresh == "fresh"
+    assert calls == ["stale", "fresh"]
+
+
+@pytest.mark.asyncio
+async def test_load_failure_is_shared_and_not_cached():
+    """Tests that waiters see the loader's error, and the next call tries again."""
+    # Arrange
+    cache = Cache()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    # Act
+    results = await asyncio.gather(
+        cache.get_or_load("key", fail), cache.get_or_load("key", fail), return_exceptions=True
+    )
+    value = await cache.get_or_load("key", _loader("value", []))
+
+    # Assert
+    assert all(isinstance(result, ValueError) for result in results)
+    assert value == "value"
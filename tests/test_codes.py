@@ -0,0 +1,142 @@
+import sqlite3
+
+import pytest
+
+from carton_caps.codes import BloomFilter, ReferralCodeIndex
+from carton_caps.database import Database
+
+
+def _insert_user(path: str, name: str, referral_code: str) -> None:
+    """Inserts a user from another connection, as another process would."""
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO users (name, referral_code) VALUES (?, ?)", (name, referral_code))
+
+
+def test_bloom_filter_has_no_false_negatives():
+    """Tests that every added item is reported as present, and most others aren't."""
+    # Arrange
+    bloom = BloomFilter(10_000, error_rate=0.01)
+    added = [f"CODE{i}" for i in range(10_000)]
+
+    # Act
+    for item in added:
+        bloom.add(item)
+
+    # Assert
+    assert all(item in bloom for item in added)
+    false_positives = sum(f"OTHER{i}" in bloom for i in range(10_000))
+    assert false_positives < 300
+    assert len(bloom) == 10_000
+
+
+@pytest.mark.asyncio
+async def test_index_loads_existing_codes(db_path: str):
+    """Tests that opening the index loads the codes already in the database."""
+    # Arrange
+    _insert_user(db_path, "Fox Mulder", "TRUSTNO1")
+    index = ReferralCodeIndex(db_path)
+
+    # Act
+    await index.open()
+    try:
+        found = await index.might_contain("TRUSTNO1")
+        missing = await index.might_contain("NOTACODE")
+        stats = index.stats()
+    finally:
+        await index.close()
+
+    # Assert
+    assert found
+    assert not missing
+    assert stats.lookups == 2
+    assert stats.rejected == 1
+
+
+@pytest.mark.asyncio
+async def test_unloaded_index_turns_nothing_away(db_path: str):
+    """Tests that before the codes are loaded, every code may be valid."""
+    # Arrange
+    index = ReferralCodeIndex(db_path)
+
+    # Act
+    await index.open(load=False)
+    try:
+        before = await index.might_contain("NOTACODE")
+        await index.load()
+        after = await index.might_contain("NOTACODE")
+    finally:
+        await index.close()
+
+    # Assert
+    assert before
+    assert not after
+
+
+@pytest.mark.asyncio
+async def test_index_picks_up_codes_from_other_processes_once_stale(db_path: str):
+    """Tests that a code created elsewhere is found once the refresh interval has passed."""
+    # Arrange
+    index = ReferralCodeIndex(db_path, refresh_interval=3600)
+    await index.open()
+    _insert_user(db_path, "Dana Scully", "SCULLYMD")
+
+    # Act
+    try:
+        before = await index.might_contain("SCULLYMD")
+        index._refresh_interval = 0
+        after = await index.might_contain("SCULLYMD")
+        stats = index.stats()
+    finally:
+        await index.close()
+
+    # Assert
+    assert not before
+    assert after
+    assert stats.refreshes == 1
+
+
+@pytest.mark.asyncio
+async def test_index_reloads_when_over_capacity(db_path: str):
+    """Tests that a filter holding more codes than it was sized for is rebuilt larger."""
+    # Arrange
+    index = ReferralCodeIndex(db_path, refresh_interval=0, min_capacity=8)
+    await index.open()
+    for i in range(10):
+        _insert_user(db_path, f"User {i}", f"CODE{i}")
+        index.add(f"CODE{i}")
+
+    # Act
+    try:
+        await index.refresh()
+        stats = index.stats()
+        found = [await index.might_contain(f"CODE{i}") for i in range(10)]
+    finally:
+        await index.close()
+
+    # Assert
+    assert stats.reloads == 2
+    assert stats.capacity == 20
+    assert all(found)
+
+
+@pytest.mark.asyncio
+async def test_resolve_referral_code_skips_database_for_rejected_codes(db_path: str):
+    """Tests that codes the index rejects are never looked up."""
+    # Arrange
+    index = ReferralCodeIndex(db_path, refresh_interval=3600)
+    await index.open()
+    db = Database(db_path, codes=index)
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+
+    # Act
+    try:
+        found = await db.resolve_referral_code("TRUSTNO1")
+        missing = await db.resolve_referral_code("NOTACODE")
+    finally:
+        await db.close()
+        await index.close()
+
+    # Assert
+    assert found == mulder
+    assert missing is None
+    assert index.stats().rejected == 1
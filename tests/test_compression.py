@@ -0,0 +1,91 @@
+import gzip
+
+import pytest
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from carton_caps.compression import ENCODINGS, choose_encoding, compress, compress_stream
+
+BODY = b'{"id":1,"user":{"id":2,"name":"Eugene Victor Tooms"},"status":"confirmed"}' * 100
+
+
+def _decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br":
+        return pytest.importorskip("brotli").decompress(data)
+    return pytest.importorskip("zstandard").ZstdDecompressor().decompressobj().decompress(data)
+
+
+def _accept(header: str) -> Accept:
+    return parse_accept_header(header)
+
+
+@pytest.mark.parametrize("encoding", list(ENCODINGS))
+def test_compress_round_trips(encoding: str):
+    """Tests that each available encoding decompresses to the original body, and shrinks it."""
+    # Act
+    compressed = compress(BODY, encoding)
+
+    # Assert
+    assert _decompress(compressed, encoding) == BODY
+    assert len(compressed) < len(BODY)
+
+
+def test_gzip_is_deterministic():
+    """Tests that gzip output carries no timestamp, so the same body always compresses the same."""
+    # Act / Assert
+    assert compress(BODY, "gzip") == compress(BODY, "gzip")
+
+
+def test_choose_encoding():
+    """Tests that the client's preferences are followed, with ties going to the best encoding we offer."""
+    # Act / Assert
+    assert choose_encoding(_accept("gzip")) == "gzip"
+    assert choose_encoding(_accept("gzip, deflate, br, zstd")) == next(iter(ENCODINGS))
+    assert choose_encoding(_accept("gzip;q=1.0, br;q=0.5, zstd;q=0.5")) == "gzip"
+    assert choose_encoding(_accept("gzip;q=0")) is None
+    assert choose_encoding(_accept("identity")) is None
+    assert choose_encoding(_accept("")) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("encoding", list(ENCODINGS))
+async def test_compress_stream_round_trips(encoding: str):
+    """Tests that a body compressed a chunk at a time decompresses to the whole body."""
+    # Arrange
+    chunks = [BODY[i : i + 1000] for i in range(0, len(BODY), 1000)]
+
+    async def produce():
+        for chunk in chunks:
+            yield chunk
+
+    # Act
+    compressed = b"".join([chunk async for chunk in compress_stream(produce(), encoding)])
+
+    # Assert
+    assert _decompress(compressed, encoding) == BODY
+
+
+@pytest.mark.asyncio
+async def test_compress_stream_closes_source():
+    """Tests that closing the compressed stream early closes the stream it reads from."""
+    # Arrange
+    closed = False
+
+    async def produce():
+        nonlocal closed
+        try:
+            while True:
+                yield BODY
+        finally:
+            closed = True
+
+    stream = compress_stream(produce(), "gzip")
+
+    # Act
+    await anext(stream)
+    await stream.aclose()
+
+    # Assert
+    assert closed
@@ -1,17 +1,27 @@
+from datetime import UTC, datetime
+
 import pytest
 import aiosqlite
-import pytest_asyncio
 
-from carton_caps.database import Database, ReferralUser
+from carton_caps.cache import Cache
+from carton_caps import database
+from carton_caps.database import (
+    ConflictError,
+    Database,
+    InvalidReferralCodeError,
+    NewReferral,
+    NewUser,
+    ReferralFilter,
+    ReferralUser,
+)
+from carton_caps.events import EventBus
+from carton_caps.signals import SignupSignals
 
 
-@pytest_asyncio.fixture
-async def db():
-    """Pytest fixture to set up and tear down an empty in-memory database."""
-    database = Database(":memory:")
-    await database.init_db()
-    yield database
-    await database.close()
+async def _count_users(db: Database) -> int:
+    """Counts the users in the database, which the app itself never needs to do."""
+    rows = await (await db.get_conn()).execute_fetchall("SELECT COUNT(*) FROM users")
+    return list(rows)[0][0]
 
 
 @pytest.mark.asyncio
@@ -143,3 +153,746 @@ async def test_create_referral_success(db: Database):
     assert len(scully_referrals) == 1
     assert scully_referrals[0].id == new_referral.id
     assert scully_referrals[0].user.name == target_user.name
+
+
+@pytest.mark.asyncio
+async def test_get_referrals_by_source_id_pages_by_id(db: Database):
+    """Tests that referrals can be paged through with `after` and `limit`."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    for name, code in [
+        ("The Flukeman", "FLUKEMAN"),
+        ("Eugene Victor Tooms", "LIVERLVR"),
+        ("Leonard Betts", "REGENERATE"),
+    ]:
+        target = await db.create_user(name, code)
+        await db.create_referral(mulder.id, target.id, "pending")
+
+    # Act
+    first_page = await db.get_referrals_by_source_id(mulder.id, limit=2)
+    second_page = await db.get_referrals_by_source_id(mulder.id, after=first_page[-1].id, limit=2)
+
+    # Assert
+    assert [r.user.name for r in first_page] == ["The Flukeman", "Eugene Victor Tooms"]
+    assert [r.user.name for r in second_page] == ["Leonard Betts"]
+
+
+@pytest.mark.asyncio
+async def test_get_referrals_by_source_id_descending():
+    """Tests that referrals can be paged through newest first, with the same pages cached or not."""
+    # Arrange
+    database = Database(":memory:", cache=Cache())
+    await database.init_db()
+    mulder = await database.create_user("Fox Mulder", "TRUSTNO1")
+    for i in range(5):
+        target = await database.create_user(f"User {i}", f"CODE{i}")
+        await database.create_referral(mulder.id, target.id, "pending")
+
+    # Act
+    uncached = await database.get_referrals_by_source_id(mulder.id, after=4, limit=2, descending=True)
+    await database.get_referrals_by_source_id(mulder.id)
+    first_page = await database.get_referrals_by_source_id(mulder.id, limit=2, descending=True)
+    second_page = await database.get_referrals_by_source_id(mulder.id, after=4, limit=2, descending=True)
+    await database.close()
+
+    # Assert
+    assert [r.id for r in first_page] == [5, 4]
+    assert [r.id for r in second_page] == [3, 2]
+    assert uncached == second_page
+
+
+@pytest.mark.asyncio
+async def test_get_referrals_by_source_id_filtered(db: Database):
+    """Tests that a filtered listing holds the referrals of a status in a time range, in creation order."""
+    # Arrange
+    await db.bulk_create_users([NewUser(name=f"User {i}", referral_code=f"CODE{i}", id=i) for i in range(1, 7)])
+    await db.bulk_create_referrals(
+        [
+            NewReferral(source_user_id=1, target_user_id=2, status="held", created_at="2025-03-01T00:00:00+00:00"),
+            NewReferral(source_user_id=1, target_user_id=3, status="held", created_at="2025-01-01T00:00:00+00:00"),
+            NewReferral(source_user_id=1, target_user_id=4, status="pending", created_at="2025-02-01T00:00:00+00:00"),
+            NewReferral(source_user_id=1, target_user_id=5, status="held", created_at="2025-02-01T00:00:00+00:00"),
+            NewReferral(source_user_id=1, target_user_id=6, status="held", created_at="2024-12-01T00:00:00+00:00"),
+        ]
+    )
+    held = ReferralFilter(status="held", since=datetime(2025, 1, 1, tzinfo=UTC))
+    early = ReferralFilter(until=datetime(2025, 2, 15, tzinfo=UTC))
+
+    # Act
+    first_page = await db.get_referrals_by_source_id(1, limit=2, filter=held)
+    second_page = await db.get_referrals_by_source_id(1, after=first_page[-1].id, limit=2, filter=held)
+    newest = await db.get_referrals_by_source_id(1, filter=held, descending=True)
+    iterated = [r async for r in db.iter_referrals_by_source_id(1, after=first_page[-1].id, filter=held)]
+    next_cursor = await db.get_next_referral_cursor(1, None, 2, filter=held)
+
+    # Assert
+    assert [r.user.id for r in first_page] == [3, 5]
+    assert [r.user.id for r in second_page] == [2]
+    assert first_page[0].status == "held"
+    assert first_page[0].created_at == "2025-01-01T00:00:00+00:00"
+    assert [r.user.id for r in newest] == [2, 5, 3]
+    assert iterated == second_page
+    assert next_cursor == first_page[-1].id
+    assert [r.user.id for r in await db.get_referrals_by_source_id(1, filter=early)] == [6, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cached", [False, True])
+async def test_get_referral_page(cached: bool):
+    """Tests reading a user's referral version with a page of their referrals, cached or not."""
+    # Arrange
+    database = Database(":memory:", cache=Cache() if cached else None)
+    await database.init_db()
+    mulder = await database.create_user("Fox Mulder", "TRUSTNO1")
+    scully = await database.create_user("Dana Scully", "SCULLYMD")
+    for i in range(3):
+        target = await database.create_user(f"User {i}", f"CODE{i}")
+        await database.create_referral(mulder.id, target.id, "pending")
+
+    # Act
+    full = await database.get_referral_page(mulder.id)
+    page = await database.get_referral_page(mulder.id, after=2, limit=1)
+    target = await database.create_user("Leonard Betts", "REGENERATE")
+    await database.create_referral(mulder.id, target.id, "held")
+    refreshed = await database.get_referral_page(mulder.id, limit=2, descending=True)
+    held = await database.get_referral_page(mulder.id, filter=ReferralFilter(status="held"))
+    empty = await database.get_referral_page(scully.id)
+    missing = await database.get_referral_page(999)
+    await database.close()
+
+    # Assert
+    assert full is not None and page is not None and refreshed is not None and held is not None
+    assert full[0] == page[0] == 3
+    assert [r.id for r in full[1]] == [1, 2, 3]
+    assert [r.id for r in page[1]] == [3]
+    assert refreshed[0] == 4
+    assert [r.id for r in refreshed[1]] == [4, 3]
+    assert [r.user.name for r in held[1]] == ["Leonard Betts"]
+    assert empty == (0, [])
+    assert missing is None
+
+
+@pytest.mark.asyncio
+async def test_iter_referrals_by_source_id(db: Database):
+    """Tests that iterating over referrals yields the same rows as fetching them."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    for i in range(100):
+        target = await db.create_user(f"User {i}", f"CODE{i}")
+        await db.create_referral(mulder.id, target.id, "pending")
+
+    # Act
+    iterated = [r async for r in db.iter_referrals_by_source_id(mulder.id, after=10)]
+    fetched = await db.get_referrals_by_source_id(mulder.id, after=10)
+
+    # Assert
+    assert len(iterated) == 90
+    assert iterated == fetched
+
+
+@pytest.mark.asyncio
+async def test_iter_export(db: Database):
+    """Tests exporting users and referrals in batches, joined to the users they refer to."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    for i in range(5):
+        target = await db.create_user(f"User {i}", f"CODE{i}")
+        await db.create_referral(mulder.id, target.id, "pending")
+
+    # Act
+    users = [batch async for batch in db.iter_export("users", batch_size=2)]
+    referrals = [batch async for batch in db.iter_export("referrals", after_id=1, through_id=4)]
+    watermark = await db.get_export_watermark("referrals")
+
+    # Assert
+    assert [len(batch) for batch in users] == [2, 2, 2]
+    assert tuple(users[0][0]) == (mulder.id, "Fox Mulder", "TRUSTNO1", None)
+    assert tuple(users[0][1]) == (mulder.id + 1, "User 0", "CODE0", mulder.id)
+    assert [row["id"] for row in referrals[0]] == [2, 3, 4]
+    assert tuple(referrals[0][0])[:6] == (2, mulder.id, "Fox Mulder", mulder.id + 2, "User 1", "pending")
+    assert watermark == 5
+
+
+@pytest.mark.asyncio
+async def test_iter_export_since(db: Database):
+    """Tests exporting only the referrals created at or after a time."""
+    # Arrange
+    await db.bulk_create_users([NewUser(name=f"User {i}", referral_code=f"CODE{i}", id=i) for i in range(1, 4)])
+    await db.bulk_create_referrals(
+        [
+            NewReferral(source_user_id=1, target_user_id=2, status="pending", created_at="2024-01-01T00:00:00+00:00"),
+            NewReferral(source_user_id=1, target_user_id=3, status="pending", created_at="2025-01-01T00:00:00+00:00"),
+        ]
+    )
+
+    # Act
+    batches = [batch async for batch in db.iter_export("referrals", since=datetime(2024, 6, 1, tzinfo=UTC))]
+
+    # Assert
+    assert [row["target_user_id"] for batch in batches for row in batch] == [3]
+
+
+@pytest.mark.asyncio
+async def test_iter_export_rejects_invalid(db: Database):
+    """Tests that unknown kinds of data, and users since a time, are rejected with a ValueError."""
+    # Act / Assert
+    with pytest.raises(ValueError):
+        [batch async for batch in db.iter_export("purchases")]
+    with pytest.raises(ValueError):
+        [batch async for batch in db.iter_export("users", since=datetime(2024, 1, 1, tzinfo=UTC))]
+    with pytest.raises(ValueError):
+        await db.get_export_watermark("purchases")
+
+
+@pytest.mark.asyncio
+async def test_get_next_referral_cursor(db: Database):
+    """Tests that the next cursor is the last id on the page, or None on the last page."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    referrals = []
+    for i in range(3):
+        target = await db.create_user(f"User {i}", f"CODE{i}")
+        referrals.append(await db.create_referral(mulder.id, target.id, "pending"))
+
+    # Act / Assert
+    assert await db.get_next_referral_cursor(mulder.id, None, 2) == referrals[1].id
+    assert await db.get_next_referral_cursor(mulder.id, referrals[1].id, 2) is None
+    assert await db.get_next_referral_cursor(mulder.id, None, 3) is None
+
+
+@pytest.mark.asyncio
+async def test_init_db_keeps_existing_data(db: Database):
+    """Tests that initializing an existing database migrates it rather than wiping it."""
+    # Arrange
+    await db.create_user("Fox Mulder", "TRUSTNO1")
+
+    # Act
+    applied = await db.init_db()
+
+    # Assert
+    assert applied == []
+    assert await _count_users(db) == 1
+
+
+@pytest.mark.asyncio
+async def test_has_users(db: Database):
+    """Tests that has_users tells an empty database from one with users in it."""
+    # Act / Assert
+    assert not await db.has_users()
+    await db.create_user("Fox Mulder", "TRUSTNO1")
+    assert await db.has_users()
+
+
+@pytest.mark.asyncio
+async def test_cached_referrals_are_invalidated_by_create_referral():
+    """Tests that creating a referral invalidates the cached referral list of its source user."""
+    # Arrange
+    cache = Cache()
+    database = Database(":memory:", cache=cache)
+    await database.init_db()
+    mulder = await database.create_user("Fox Mulder", "TRUSTNO1")
+    flukeman = await database.create_user("The Flukeman", "FLUKEMAN")
+    tooms = await database.create_user("Eugene Victor Tooms", "LIVERLVR")
+    await database.create_referral(mulder.id, flukeman.id, "confirmed")
+    await database.get_referrals_by_source_id(mulder.id)
+
+    # Act
+    cached = await database.get_referrals_by_source_id(mulder.id)
+    await database.create_referral(mulder.id, tooms.id, "pending")
+    refreshed = await database.get_referrals_by_source_id(mulder.id)
+    page = await database.get_referrals_by_source_id(mulder.id, after=refreshed[0].id, limit=1)
+    await database.close()
+
+    # Assert
+    assert [r.user.name for r in cached] == ["The Flukeman"]
+    assert [r.user.name for r in refreshed] == ["The Flukeman", "Eugene Victor Tooms"]
+    assert [r.user.name for r in page] == ["Eugene Victor Tooms"]
+    assert cache.stats().hits == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_missing_user_is_invalidated_by_create_user():
+    """Tests that a user cached as missing is found once they are created."""
+    # Arrange
+    database = Database(":memory:", cache=Cache())
+    await database.init_db()
+    missing = await database.get_user_by_id(1)
+
+    # Act
+    await database.create_user("Fox Mulder", "TRUSTNO1")
+    found = await database.get_user_by_id(1)
+    await database.close()
+
+    # Assert
+    assert missing is None
+    assert found is not None
+
+
+@pytest.mark.asyncio
+async def test_get_referral_version_changes_on_write(db: Database):
+    """Tests that a user's referral version changes when one of their referrals is created."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    flukeman = await db.create_user("The Flukeman", "FLUKEMAN")
+    before = await db.get_referral_version(mulder.id)
+
+    # Act
+    await db.create_referral(mulder.id, flukeman.id, "pending")
+    after = await db.get_referral_version(mulder.id)
+
+    # Assert
+    assert before is not None and after is not None
+    assert after > before
+    assert await db.get_referral_version(flukeman.id) == 0
+    assert await db.get_referral_version(999) is None
+
+
+@pytest.mark.asyncio
+async def test_get_referrals_by_source_ids(db: Database):
+    """Tests that the referrals of many users are fetched at once, with missing users reported as None."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    skinner = await db.create_user("Walter Skinner", "SKINNERAD")
+    scully = await db.create_user("Dana Scully", "SCULLYMD")
+    flukeman = await db.create_user("The Flukeman", "FLUKEMAN")
+    tooms = await db.create_user("Eugene Victor Tooms", "LIVERLVR")
+    await db.create_referral(mulder.id, flukeman.id, "confirmed")
+    await db.create_referral(skinner.id, mulder.id, "confirmed")
+    await db.create_referral(mulder.id, tooms.id, "pending")
+
+    # Act
+    results = await db.get_referrals_by_source_ids([mulder.id, 999, scully.id, skinner.id, mulder.id])
+
+    # Assert
+    assert list(results) == [mulder.id, 999, scully.id, skinner.id]
+    mulder_referrals = results[mulder.id]
+    skinner_referrals = results[skinner.id]
+    assert mulder_referrals is not None and skinner_referrals is not None
+    assert [r.user.name for r in mulder_referrals] == ["The Flukeman", "Eugene Victor Tooms"]
+    assert [r.user.name for r in skinner_referrals] == ["Fox Mulder"]
+    assert results[scully.id] == []
+    assert results[999] is None
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_users_and_referrals(db: Database):
+    """Tests creating users and referrals in chunks, from generators."""
+    # Arrange
+    users = (NewUser(name=f"User {i}", referral_code=f"CODE{i}", id=i + 1) for i in range(25))
+    referrals = (NewReferral(source_user_id=1, target_user_id=i, status="pending") for i in range(2, 26))
+    chunks = []
+
+    # Act
+    created_users = await db.bulk_create_users(users, chunk_size=10, on_chunk=chunks.append)
+    created_referrals = await db.bulk_create_referrals(referrals, chunk_size=10, import_name="test")
+
+    # Assert
+    assert created_users == 25
+    assert created_referrals == 24
+    assert chunks == [10, 10, 5]
+    assert len(await db.get_referrals_by_source_id(1)) == 24
+    assert await db.get_import_progress("test") == 24
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_rolls_back_failed_chunk(db: Database):
+    """Tests that a failed chunk is rolled back while earlier chunks stay committed."""
+    # Arrange
+    users = [NewUser(name=f"User {i}", referral_code=f"CODE{i}") for i in range(3)]
+    users.append(NewUser(name="User 0", referral_code="DUPLICATE"))
+
+    # Act
+    with pytest.raises(aiosqlite.IntegrityError):
+        await db.bulk_create_users(users, chunk_size=2, import_name="test")
+
+    # Assert
+    assert await _count_users(db) == 2
+    assert await db.get_import_progress("test") == 2
+
+
+@pytest.mark.asyncio
+async def test_confirm_referrals(db: Database):
+    """Tests that only pending referrals are confirmed, and that confirming them again changes nothing."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    pending = await db.create_user("Dana Scully", "SCULLYMD")
+    held = await db.create_user("Eugene Victor Tooms", "LIVERLVR")
+    unreferred = await db.create_user("Walter Skinner", "SKINNERAD")
+    await db.create_referral(mulder.id, pending.id, "pending")
+    await db.create_referral(mulder.id, held.id, "held")
+
+    # Act
+    confirmed = await db.confirm_referrals([pending.id, held.id, unreferred.id])
+    version = await db.get_referral_version(mulder.id)
+    confirmed_again = await db.confirm_referrals([pending.id])
+
+    # Assert
+    assert confirmed == 1
+    assert confirmed_again == 0
+    assert await db.get_referral_version(mulder.id) == version
+    stats = await db.get_referral_stats(mulder.id)
+    assert stats is not None
+    assert stats.counts == {"confirmed": 1, "held": 1}
+    assert [referral.status for referral in await db.get_referrals_by_source_id(mulder.id)] == ["confirmed", "held"]
+
+
+@pytest.mark.asyncio
+async def test_confirm_referrals_publishes_events():
+    """Tests that each confirmed referral is published to its referrer's subscribers, with their new version."""
+    # Arrange
+    bus = EventBus()
+    db = Database(":memory:", events=bus)
+    await db.init_db()
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    scully = await db.create_user("Dana Scully", "SCULLYMD")
+    skinner = await db.create_user("Walter Skinner", "SKINNERAD")
+    await db.create_referral(mulder.id, scully.id, "pending")
+    await db.create_referral(mulder.id, skinner.id, "pending")
+    subscription = bus.subscribe(mulder.id)
+
+    # Act
+    confirmed = await db.confirm_referrals([scully.id, skinner.id])
+    events = await subscription.get(1.0)
+    version = await db.get_referral_version(mulder.id)
+    await db.close()
+
+    # Assert
+    assert confirmed == 2
+    assert [event.type for event in events] == ["referral.updated", "referral.updated"]
+    assert [event.referral.user.name for event in events] == ["Dana Scully", "Walter Skinner"]
+    assert all(event.referral.status == "confirmed" for event in events)
+    assert [event.version for event in events] == [version - 1, version]
+
+
+async def _create_referral_tree(db: Database) -> dict[str, int]:
+    """
+    Creates the referral tree from `seed_db` and returns each user's id by name.
+
+    Spender referred Skinner, who referred Mulder and Scully, and Mulder
+    referred Flukeman and Tooms.
+    """
+    users = [("spender", "CANCERMAN"), ("skinner", "SKINNERAD"), ("mulder", "TRUSTNO1")]
+    users += [("scully", "SCULLYMD"), ("flukeman", "FLUKEMAN"), ("tooms", "LIVERLVR")]
+    ids = {name: (await db.create_user(name, code)).id for name, code in users}
+    for source, target in [
+        ("spender", "skinner"),
+        ("skinner", "mulder"),
+        ("skinner", "scully"),
+        ("mulder", "flukeman"),
+        ("mulder", "tooms"),
+    ]:
+        await db.create_referral(ids[source], ids[target], "confirmed")
+    return ids
+
+
+@pytest.mark.asyncio
+async def test_get_downline(db: Database):
+    """Tests that a user's downline includes indirect referrals, ordered by depth."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+
+    # Act
+    downline = await db.get_downline(ids["spender"])
+    shallow = await db.get_downline(ids["spender"], max_depth=2)
+
+    # Assert
+    assert [(r.user.name, r.depth, r.referred_by) for r in downline] == [
+        ("skinner", 1, ids["spender"]),
+        ("mulder", 2, ids["skinner"]),
+        ("scully", 2, ids["skinner"]),
+        ("flukeman", 3, ids["mulder"]),
+        ("tooms", 3, ids["mulder"]),
+    ]
+    assert [r.user.name for r in shallow] == ["skinner", "mulder", "scully"]
+
+
+@pytest.mark.asyncio
+async def test_get_downline_pages_by_depth_and_id(db: Database):
+    """Tests paging through a downline with a (depth, id) cursor."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+
+    # Act
+    first = await db.get_downline(ids["spender"], limit=2)
+    second = await db.get_downline(ids["spender"], after=(first[-1].depth, first[-1].user.id), limit=2)
+
+    # Assert
+    assert [r.user.name for r in first] == ["skinner", "mulder"]
+    assert [r.user.name for r in second] == ["scully", "flukeman"]
+
+
+@pytest.mark.asyncio
+async def test_get_upline(db: Database):
+    """Tests that a user's upline runs from their referrer to the root of the tree."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+
+    # Act
+    upline = await db.get_upline(ids["tooms"])
+    nearest = await db.get_upline(ids["tooms"], max_depth=1)
+
+    # Assert
+    assert [(r.user.name, r.depth, r.referred_by) for r in upline] == [
+        ("mulder", 1, ids["skinner"]),
+        ("skinner", 2, ids["spender"]),
+        ("spender", 3, None),
+    ]
+    assert [r.user.name for r in nearest] == ["mulder"]
+    assert await db.get_upline(ids["spender"]) == []
+
+
+@pytest.mark.asyncio
+async def test_get_downline_size(db: Database):
+    """Tests counting a user's downline at each depth."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+
+    # Act
+    levels = await db.get_downline_size(ids["spender"])
+
+    # Assert
+    assert levels == {1: 1, 2: 2, 3: 2}
+    assert await db.get_downline_size(ids["spender"], max_depth=1) == {1: 1}
+    assert await db.get_downline_size(ids["tooms"]) == {}
+
+
+@pytest.mark.asyncio
+async def test_downline_is_connected_when_referrals_arrive_out_of_order(db: Database):
+    """Tests that referring a user who already has a downline connects it to the new upline."""
+    # Arrange
+    users = [NewUser(name=f"User {i}", referral_code=f"CODE{i}", id=i) for i in range(1, 5)]
+    await db.bulk_create_users(users)
+
+    # Act
+    await db.bulk_create_referrals(
+        [
+            NewReferral(source_user_id=3, target_user_id=4, status="confirmed"),
+            NewReferral(source_user_id=1, target_user_id=2, status="confirmed"),
+            NewReferral(source_user_id=2, target_user_id=3, status="confirmed"),
+        ]
+    )
+
+    # Assert
+    assert [(r.user.id, r.depth) for r in await db.get_downline(1)] == [(2, 1), (3, 2), (4, 3)]
+    assert [(r.user.id, r.depth) for r in await db.get_upline(4)] == [(3, 1), (2, 2), (1, 3)]
+
+
+@pytest.mark.asyncio
+async def test_create_referral_rejects_cycle(db: Database):
+    """Tests that a user can't be referred by someone in their own downline."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+
+    # Act / Assert
+    with pytest.raises(aiosqlite.IntegrityError):
+        await db.create_referral(ids["tooms"], ids["spender"], "pending")
+    assert await db.get_upline(ids["spender"]) == []
+
+
+@pytest.mark.asyncio
+async def test_deleting_referral_disconnects_downline(db: Database):
+    """Tests that deleting a referral removes the paths that ran through it."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+    conn = await db.get_conn()
+
+    # Act
+    await conn.execute("DELETE FROM referrals WHERE target_user_id = ?", (ids["mulder"],))
+    await conn.commit()
+
+    # Assert
+    assert [r.user.name for r in await db.get_downline(ids["spender"])] == ["skinner", "scully"]
+    assert [r.user.name for r in await db.get_downline(ids["mulder"])] == ["flukeman", "tooms"]
+    assert [r.user.name for r in await db.get_upline(ids["tooms"])] == ["mulder"]
+
+
+@pytest.mark.asyncio
+async def test_referral_stats_follow_writes(db: Database):
+    """Tests that the referral counts are kept current as referrals are created, updated and deleted."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+    await db.create_referral(ids["mulder"], (await db.create_user("mutato", "CHERFAN")).id, "pending")
+    conn = await db.get_conn()
+
+    # Act
+    before = await db.get_referral_stats(ids["mulder"])
+    await conn.execute(
+        "UPDATE referrals SET status = (SELECT code FROM referral_statuses WHERE name = 'confirmed') "
+        "WHERE source_user_id = ?",
+        (ids["mulder"],),
+    )
+    await conn.execute("DELETE FROM referrals WHERE target_user_id = ?", (ids["tooms"],))
+    await conn.commit()
+    after = await db.get_referral_stats(ids["mulder"])
+
+    # Assert
+    assert before is not None and after is not None
+    assert before.counts == {"confirmed": 2, "pending": 1}
+    assert before.total == 3
+    assert after.counts == {"confirmed": 2}
+    assert after.version > before.version
+
+
+@pytest.mark.asyncio
+async def test_referral_stats_no_referrals_and_missing_user(db: Database):
+    """Tests the stats of a user with no referrals, and of a user who doesn't exist."""
+    # Arrange
+    scully = await db.create_user("Dana Scully", "SCULLYMD")
+
+    # Act
+    stats = await db.get_referral_stats(scully.id)
+
+    # Assert
+    assert stats is not None
+    assert stats.counts == {}
+    assert stats.total == 0
+    assert await db.get_referral_stats(999) is None
+
+
+@pytest.mark.asyncio
+async def test_reconcile_referral_counts(db: Database):
+    """Tests that drifted counts are reported, and rebuilt unless it is a dry run."""
+    # Arrange
+    ids = await _create_referral_tree(db)
+    conn = await db.get_conn()
+    await conn.execute("UPDATE referral_counts SET count = 5 WHERE user_id = ?", (ids["mulder"],))
+    await conn.execute("DELETE FROM referral_counts WHERE user_id = ?", (ids["spender"],))
+    await conn.commit()
+
+    # Act
+    reported = await db.reconcile_referral_counts(fix=False)
+    fixed = await db.reconcile_referral_counts()
+    remaining = await db.reconcile_referral_counts()
+
+    # Assert
+    assert [(d.user_id, d.status, d.stored, d.actual) for d in reported] == [
+        (ids["spender"], "confirmed", 0, 1),
+        (ids["mulder"], "confirmed", 5, 2),
+    ]
+    assert fixed == reported
+    assert remaining == []
+    stats = await db.get_referral_stats(ids["mulder"])
+    assert stats is not None and stats.counts == {"confirmed": 2}
+
+
+@pytest.mark.asyncio
+async def test_signup_with_referral_code(db: Database):
+    """Tests that signing up with a referral code creates the user and their pending referral."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+
+    # Act
+    signup = await db.signup("Dana Scully", referred_by_code="TRUSTNO1")
+
+    # Assert
+    assert signup.user.name == "Dana Scully"
+    assert len(signup.user.referral_code) == 8
+    assert signup.referred_by == mulder.id
+    assert signup.referral is not None
+    assert signup.referral.status == "pending"
+    assert signup.referral.user.id == signup.user.id
+    assert await db.get_referrals_by_source_id(mulder.id) == [signup.referral]
+
+
+@pytest.mark.asyncio
+async def test_signup_without_referral_code(db: Database):
+    """Tests that a user can sign up without having been referred."""
+    # Act
+    signup = await db.signup("Dana Scully")
+
+    # Assert
+    assert signup.referral is None
+    assert signup.referred_by is None
+    assert await db.get_user_by_id(signup.user.id) == signup.user
+
+
+@pytest.mark.asyncio
+async def test_signup_with_invalid_referral_code_creates_nothing(db: Database):
+    """Tests that signing up with an unknown referral code fails without creating the user."""
+    # Act / Assert
+    with pytest.raises(InvalidReferralCodeError):
+        await db.signup("Dana Scully", referred_by_code="NOTACODE")
+    assert await _count_users(db) == 0
+
+
+@pytest.mark.asyncio
+async def test_signup_duplicate_name_conflicts(db: Database):
+    """Tests that signing up with a name that is taken raises a ConflictError and creates no referral."""
+    # Arrange
+    mulder = await db.create_user("Fox Mulder", "TRUSTNO1")
+    await db.create_user("Dana Scully", "SCULLYMD")
+
+    # Act / Assert
+    with pytest.raises(ConflictError):
+        await db.signup("Dana Scully", referred_by_code="TRUSTNO1")
+    assert await db.get_referrals_by_source_id(mulder.id) == []
+
+
+@pytest.mark.asyncio
+async def test_signup_draws_new_code_on_collision(db: Database, monkeypatch):
+    """Tests that a generated referral code that is already taken is replaced by another."""
+    # Arrange
+    await db.create_user("Fox Mulder", "TRUSTNO1")
+    codes = iter(["TRUSTNO1", "SCULLYMD"])
+    monkeypatch.setattr(database, "new_referral_code", lambda: next(codes))
+
+    # Act
+    signup = await db.signup("Dana Scully")
+
+    # Assert
+    assert signup.user.referral_code == "SCULLYMD"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "signals, status",
+    [
+        # The referrer's own device and network
+        (SignupSignals(device_id="mulder-phone", ip_address="203.0.113.99"), "held"),
+        # The email address of someone the referrer already referred, lightly disguised, and the referrer's network
+        (SignupSignals(email="Dana.Scully+2@gmail.com", ip_address="203.0.113.99"), "held"),
+        # The network of the referrer's referrer, and the referrer's device
+        (SignupSignals(ip_address="198.51.100.7", device_id="mulder-phone"), "held"),
+        # One signal alone isn't enough
+        (SignupSignals(device_id="mulder-phone"), "pending"),
+        (SignupSignals(ip_address="203.0.113.99"), "pending"),
+        # Nothing seen before
+        (SignupSignals(device_id="krycek-phone", ip_address="192.0.2.1"), "pending"),
+    ],
+)
+async def test_signup_holds_referral_when_signals_seen_in_referrer_tree(db: Database, signals, status):
+    """Tests that a signup is held when its signals have been seen in the referrer's upline, downline or own signup."""
+    # Arrange
+    skinner = await db.signup("Walter Skinner", signals=SignupSignals(ip_address="198.51.100.1"))
+    mulder = await db.signup(
+        "Fox Mulder",
+        referred_by_code=skinner.user.referral_code,
+        signals=SignupSignals(device_id="mulder-phone", ip_address="203.0.113.5"),
+    )
+    await db.signup(
+        "Dana Scully", referred_by_code=mulder.user.referral_code, signals=SignupSignals(email="dana.scully@gmail.com")
+    )
+
+    # Act
+    signup = await db.signup("New User", referred_by_code=mulder.user.referral_code, signals=signals)
+
+    # Assert
+    assert signup.referral is not None
+    assert signup.referral.status == status
+
+
+@pytest.mark.asyncio
+async def test_signals_outside_referrer_tree_are_ignored(db: Database):
+    """Tests that a signal seen elsewhere in the graph doesn't hold a referral."""
+    # Arrange
+    krycek = SignupSignals(device_id="krycek-phone", ip_address="192.0.2.1")
+    await db.signup("Alex Krycek", signals=krycek)
+    mulder = await db.signup("Fox Mulder")
+
+    # Act
+    signup = await db.signup("Dana Scully", referred_by_code=mulder.user.referral_code, signals=krycek)
+
+    # Assert
+    assert signup.referral is not None
+    assert signup.referral.status == "pending"
+    assert (await db.get_referral_stats(mulder.user.id)).counts == {"pending": 1}
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from carton_caps.database import Referral, ReferralUser
+from carton_caps.events import EventBus, ReferralEvent, sse_message
+
+
+def _event(user_id: int, version: int) -> ReferralEvent:
+    return ReferralEvent(
+        user_id=user_id,
+        version=version,
+        type="referral.created",
+        referral=Referral(
+            id=version,
+            user=ReferralUser(
+                id=100 + version, name=f"Referred User {version}", avatar_url="https://place-hold.it/64x64"
+            ),
+            status="pending",
+            created_at="2025-08-10T20:03:00.123456+00:00",
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_publish_reaches_only_the_users_subscribers():
+    """Tests that an event is queued for each subscriber to its user, and no one else."""
+    # Arrange
+    bus = EventBus()
+    first = bus.subscribe(1)
+    second = bus.subscribe(1)
+    other = bus.subscribe(2)
+
+    # Act
+    bus.publish(_event(1, 1))
+
+    # Assert
+    assert [event.version for event in await first.get(1.0)] == [1]
+    assert [event.version for event in await second.get(1.0)] == [1]
+    assert await other.get(0.01) == []
+    assert bus.stats().published == 1
+
+
+@pytest.mark.asyncio
+async def test_get_wakes_on_publish():
+    """Tests that a waiting subscriber is woken as soon as an event is published."""
+    # Arrange
+    bus = EventBus()
+    subscription = bus.subscribe(1)
+
+    # Act
+    waiting = asyncio.create_task(subscription.get(5.0))
+    await asyncio.sleep(0)
+    bus.publish(_event(1, 1))
+    events = await asyncio.wait_for(waiting, 1.0)
+
+    # Assert
+    assert [event.version for event in events] == [1]
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_dropped():
+    """Tests that a subscriber falling too far behind is dropped, without affecting the others."""
+    # Arrange
+    bus = EventBus(max_queued=2)
+    slow = bus.subscribe(1)
+    fast = bus.subscribe(1)
+
+    # Act
+    for version in range(1, 4):
+        bus.publish(_event(1, version))
+        if version < 3:
+            await fast.get(1.0)
+    events = await slow.get(1.0)
+
+    # Assert
+    assert slow.dropped
+    assert events == []
+    assert not fast.dropped
+    assert [event.version for event in await fast.get(1.0)] == [3]
+    assert bus.stats().dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_close_wakes_and_unsubscribes():
+    """Tests that closing the bus wakes waiting subscribers and forgets them."""
+    # Arrange
+    bus = EventBus()
+    subscription = bus.subscribe(1)
+    waiting = asyncio.create_task(subscription.get(5.0))
+    await asyncio.sleep(0)
+
+    # Act
+    bus.close()
+
+    # Assert
+    assert await asyncio.wait_for(waiting, 1.0) == []
+    assert subscription.closed
+    assert bus.stats().subscribers == 0
+
+
+def test_replay_returns_missed_events():
+    """Tests that the events after a client's last one are replayed, when none are missing."""
+    # Arrange
+    bus = EventBus()
+    for version in range(1, 6):
+        bus.publish(_event(1, version))
+
+    # Act
+    events = bus.replay(1, 2, 5)
+
+    # Assert
+    assert events is not None
+    assert [event.version for event in events] == [3, 4, 5]
+    assert bus.replay(1, 5, 5) == []
+    assert bus.stats().replayed == 3
+
+
+def test_replay_detects_gaps():
+    """Tests that a replay is refused when an event wasn't published here, or is no longer kept."""
+    # Arrange
+    bus = EventBus(replay_size=3)
+    for version in (1, 2, 4, 5, 6):
+        bus.publish(_event(1, version))
+
+    # Act / Assert
+    assert bus.replay(1, 1, 6) is None
+    assert bus.replay(1, 3, 6) is not None
+    assert bus.replay(1, 3, 7) is None
+    assert bus.replay(2, 0, 1) is None
+    assert bus.stats().resyncs == 3
+
+
+def test_replay_keeps_recent_users_only():
+    """Tests that only the most recently published to users' events are kept for replay."""
+    # Arrange
+    bus = EventBus(replay_users=2)
+
+    # Act
+    bus.publish(_event(1, 1))
+    bus.publish(_event(2, 1))
+    bus.publish(_event(1, 2))
+    bus.publish(_event(3, 1))
+
+    # Assert
+    assert bus.replay(1, 0, 2) is not None
+    assert bus.replay(2, 0, 1) is None
+    assert bus.replay(3, 0, 1) is not None
+
+
+def test_sse_message():
+    """Tests the server-sent event wire format, with and without an id."""
+    # Act / Assert
+    assert sse_message("resync", b'{"version":3}', id=3) == b'id: 3\nevent: resync\ndata: {"version":3}\n\n'
+    assert sse_message("resync", b"{}") == b"event: resync\ndata: {}\n\n"
@@ -0,0 +1,88 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+import pytest
+import pytest_asyncio
+
+from carton_caps.database import Database
+from carton_caps.export import encode_export, export_file, infer_compression
+from carton_caps.importer import import_file
+
+
+@pytest_asyncio.fixture
+async def source_db():
+    """Pytest fixture to set up and tear down an in-memory database with a few referrals, to export."""
+    database = Database(":memory:")
+    await database.init_db()
+    mulder = await database.create_user("Fox Mulder", "TRUSTNO1")
+    for name, code in [("The Flukeman", "FLUKEMAN"), ("Eugene Victor Tooms", "LIVERLVR"), ("Leonard Betts", "REGEN")]:
+        target = await database.create_user(name, code)
+        await database.create_referral(mulder.id, target.id, "pending")
+    yield database
+    await database.close()
+
+
+def test_infer_compression():
+    """Tests that the compression extension picks the encoding, and is stripped to find the format."""
+    # Act / Assert
+    assert infer_compression("referrals.ndjson.gz") == ("gzip", "referrals.ndjson")
+    assert infer_compression("referrals.csv") == (None, "referrals.csv")
+
+
+@pytest.mark.asyncio
+async def test_encode_export_csv(source_db: Database):
+    """Tests that a CSV export has a header, and writes nulls as empty fields."""
+    # Act
+    body = b"".join([chunk async for chunk in encode_export(source_db.iter_export("users"), "users", "csv")])
+
+    # Assert
+    rows = list(csv.reader(io.StringIO(body.decode())))
+    assert rows[0] == ["id", "name", "referral_code", "referred_by"]
+    assert rows[1] == ["1", "Fox Mulder", "TRUSTNO1", ""]
+    assert rows[2] == ["2", "The Flukeman", "FLUKEMAN", "1"]
+    assert len(rows) == 5
+
+
+@pytest.mark.asyncio
+async def test_export_file_incremental(source_db: Database):
+    """Tests that an export reports the id it ran through, and that exporting after it picks up only newer rows."""
+    # Arrange
+    first_output = io.BytesIO()
+    second_output = io.BytesIO()
+
+    # Act
+    first = await export_file(source_db, first_output, "referrals", "ndjson", report=lambda _: None)
+    target = await source_db.create_user("The Great Mutato", "CHERFAN")
+    await source_db.create_referral(1, target.id, "confirmed")
+    second = await export_file(
+        source_db, second_output, "referrals", "ndjson", after_id=first.through_id, report=lambda _: None
+    )
+
+    # Assert
+    assert first.exported == 3
+    assert first.through_id == 3
+    assert second.exported == 1
+    assert second.through_id == 4
+    records = [json.loads(line) for line in second_output.getvalue().splitlines()]
+    assert records[0]["target_name"] == "The Great Mutato"
+    assert records[0]["status"] == "confirmed"
+
+
+@pytest.mark.asyncio
+async def test_export_round_trips_through_import(source_db: Database, db: Database, directory: str):
+    """Tests that compressed exports can be decompressed and imported again as they are."""
+    # Act
+    for kind in ("users", "referrals"):
+        with open(os.path.join(directory, f"{kind}.csv.gz"), "wb") as f:
+            await export_file(source_db, f, kind, "csv", encoding="gzip", report=lambda _: None)
+        with open(os.path.join(directory, f"{kind}.csv"), "wb") as f:
+            with gzip.open(os.path.join(directory, f"{kind}.csv.gz")) as compressed:
+                f.write(compressed.read())
+        await import_file(db, os.path.join(directory, f"{kind}.csv"), kind, report=lambda _: None)
+
+    # Assert
+    assert await db.get_referrals_by_source_id(1) == await source_db.get_referrals_by_source_id(1)
+    assert await db.get_user_by_id(4) == await source_db.get_user_by_id(4)
@@ -0,0 +1,48 @@
+from collections import Counter
+
+from carton_caps.generate import generate_referrals, generate_users, make_referral_code
+
+
+def test_generated_users_have_unique_codes():
+    """Tests that generated users get distinct ids and referral codes."""
+    # Act
+    users = list(generate_users(10_000))
+
+    # Assert
+    assert [user.id for user in users] == list(range(1, 10_001))
+    assert len({user.referral_code for user in users}) == 10_000
+    assert users[0].referral_code == make_referral_code(1)
+
+
+def test_generated_referrals_are_reproducible():
+    """Tests that the same seed generates the same referrals, and a different seed doesn't."""
+    # Act
+    first = list(generate_referrals(1_000, seed=1))
+    second = list(generate_referrals(1_000, seed=1))
+    third = list(generate_referrals(1_000, seed=2))
+
+    # Assert
+    assert first == second
+    assert first != third
+
+
+def test_generated_referrals_are_valid():
+    """Tests that each user is referred at most once, by a user who signed up before them."""
+    # Act
+    referrals = list(generate_referrals(1_000))
+
+    # Assert
+    targets = [referral.target_user_id for referral in referrals]
+    assert len(targets) == len(set(targets))
+    assert all(1 <= referral.source_user_id < referral.target_user_id for referral in referrals)
+
+
+def test_generated_referrals_are_skewed():
+    """Tests that a larger skew concentrates referrals on fewer referrers."""
+    # Act
+    uniform = Counter(r.source_user_id for r in generate_referrals(10_000, skew=1.0))
+    skewed = Counter(r.source_user_id for r in generate_referrals(10_000, skew=3.0))
+
+    # Assert
+    assert skewed.most_common(1)[0][1] > uniform.most_common(1)[0][1]
+    assert len(skewed) < len(uniform)
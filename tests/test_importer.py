@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from carton_caps.database import Database
+from carton_caps.importer import import_file
+
+
+def _write_ndjson(path: str, records: list[dict]) -> None:
+    with open(path, "w") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+
+
+async def _count_users(db: Database) -> int:
+    """Counts the users in the database, which the app itself never needs to do."""
+    rows = await (await db.get_conn()).execute_fetchall("SELECT COUNT(*) FROM users")
+    return list(rows)[0][0]
+
+
+@pytest.mark.asyncio
+async def test_import_users_and_referrals(db: Database, directory: str):
+    """Tests importing users from NDJSON and referrals from CSV."""
+    # Arrange
+    users_path = os.path.join(directory, "users.ndjson")
+    _write_ndjson(
+        users_path,
+        [
+            {"id": 10, "name": "Fox Mulder", "referral_code": "TRUSTNO1"},
+            {"id": 20, "name": "The Flukeman", "referral_code": "FLUKEMAN"},
+            {"name": "Leonard Betts", "referral_code": "REGENERATE"},
+        ],
+    )
+    referrals_path = os.path.join(directory, "referrals.csv")
+    with open(referrals_path, "w") as f:
+        f.write("source_user_id,target_user_id,status,created_at\n")
+        f.write("10,20,confirmed,2013-09-13T00:00:00+00:00\n")
+        f.write("10,21,pending,\n")
+
+    # Act
+    users = await import_file(db, users_path, "users", chunk_size=2, report=lambda _: None)
+    referrals = await import_file(db, referrals_path, "referrals", report=lambda _: None)
+
+    # Assert
+    assert users.imported == 3
+    assert referrals.imported == 2
+    assert await _count_users(db) == 3
+    imported = await db.get_referrals_by_source_id(10)
+    assert [r.user.name for r in imported] == ["The Flukeman", "Leonard Betts"]
+    assert imported[0].created_at == "2013-09-13T00:00:00+00:00"
+
+
+@pytest.mark.asyncio
+async def test_import_resumes_after_failure(db: Database, directory: str):
+    """Tests that a failed import keeps its committed chunks, and a re-run resumes after them."""
+    # Arrange
+    path = os.path.join(directory, "users.ndjson")
+    records = [{"name": f"User {i}", "referral_code": f"CODE{i}"} for i in range(5)]
+    _write_ndjson(path, records[:3] + [{"name": "User 0", "referral_code": "DUPLICATE"}] + records[3:])
+    messages = []
+
+    with pytest.raises(sqlite3.IntegrityError):
+        await import_file(db, path, "users", chunk_size=2, report=messages.append)
+
+    # Fix the bad row, as an operator would, then run the import again
+    _write_ndjson(path, records[:3] + [{"name": "User 5", "referral_code": "CODE5"}] + records[3:])
+
+    # Act
+    result = await import_file(db, path, "users", chunk_size=2, report=messages.append)
+
+    # Assert
+    assert result.skipped == 2
+    assert result.imported == 4
+    assert await _count_users(db) == 6
+    assert "Resuming after 2 rows that were already imported" in messages
+
+
+@pytest.mark.asyncio
+async def test_import_restart_ignores_progress(db: Database, directory: str):
+    """Tests that restarting an import starts from the first row again."""
+    # Arrange
+    path = os.path.join(directory, "users.ndjson")
+    _write_ndjson(path, [{"name": "Fox Mulder", "referral_code": "TRUSTNO1"}])
+    await import_file(db, path, "users", report=lambda _: None)
+
+    # Act / Assert
+    with pytest.raises(sqlite3.IntegrityError):
+        await import_file(db, path, "users", restart=True, report=lambda _: None)
@@ -0,0 +1,116 @@
+import logging
+import sqlite3
+
+import pytest
+
+from carton_caps.database import Database
+from carton_caps.metrics import Histogram, Metrics, run_query
+from carton_caps.migrations import migrate
+from carton_caps.pool import PoolStats
+
+
+def test_histogram_buckets():
+    """Tests that observations land in the first bucket whose bound they don't exceed."""
+    # Arrange
+    histogram = Histogram((1, 10))
+
+    # Act
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+
+    # Assert
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 56.5
+
+
+def test_render_prometheus_text():
+    """Tests that query histograms and stats snapshots are rendered in the Prometheus text format."""
+    # Arrange
+    metrics = Metrics()
+    metrics.observe_query("get_user_by_id", 0.0003, 1)
+    metrics.observe_request("GET", "/users/<int:user_id>/referrals", 200, 0.002)
+    stats = PoolStats(
+        size=2,
+        idle=1,
+        in_use=1,
+        acquired=5,
+        waits=0,
+        wait_time=0.0,
+        max_wait_time=0.0,
+        timeouts=0,
+        health_check_failures=0,
+    )
+
+    # Act
+    text = metrics.render({"pool": stats})
+
+    # Assert
+    lines = text.splitlines()
+    assert "# TYPE carton_caps_query_duration_seconds histogram" in lines
+    assert 'carton_caps_query_duration_seconds_bucket{query="get_user_by_id",le="0.00025"} 0' in lines
+    assert 'carton_caps_query_duration_seconds_bucket{query="get_user_by_id",le="0.0005"} 1' in lines
+    assert 'carton_caps_query_duration_seconds_bucket{query="get_user_by_id",le="+Inf"} 1' in lines
+    assert 'carton_caps_query_duration_seconds_count{query="get_user_by_id"} 1' in lines
+    assert 'carton_caps_query_rows_bucket{query="get_user_by_id",le="1"} 1' in lines
+    assert (
+        'carton_caps_request_duration_seconds_count{method="GET",route="/users/<int:user_id>/referrals",status="200"} 1'
+        in lines
+    )
+    assert "carton_caps_pool_acquired 5" in lines
+    assert text.endswith("\n")
+
+
+def test_run_query_logs_slow_query_with_plan(caplog):
+    """Tests that a query over the threshold is logged with its SQL and query plan."""
+    # Arrange
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    metrics = Metrics(slow_query_threshold=0)
+
+    # Act
+    with caplog.at_level(logging.WARNING, logger="carton_caps.slow_queries"):
+        rows = run_query(conn, metrics, "get_user_by_id", "SELECT * FROM users WHERE id = ?", (1,))
+
+    # Assert
+    assert rows == []
+    assert "Slow query get_user_by_id" in caplog.text
+    assert "SELECT * FROM users WHERE id = ?" in caplog.text
+    assert "SEARCH users USING INTEGER PRIMARY KEY (rowid=?)" in caplog.text
+    assert 'carton_caps_slow_queries_total{query="get_user_by_id"} 1' in metrics.render()
+
+
+def test_run_query_not_slow(caplog):
+    """Tests that a query under the threshold is recorded but not logged."""
+    # Arrange
+    conn = sqlite3.connect(":memory:")
+    metrics = Metrics(slow_query_threshold=None)
+
+    # Act
+    with caplog.at_level(logging.WARNING, logger="carton_caps.slow_queries"):
+        run_query(conn, metrics, "select_one", "SELECT 1")
+
+    # Assert
+    assert caplog.text == ""
+    assert 'carton_caps_query_rows_count{query="select_one"} 1' in metrics.render()
+
+
+@pytest.mark.asyncio
+async def test_database_records_queries_and_writes():
+    """Tests that Database reads and writes are recorded under their names."""
+    # Arrange
+    metrics = Metrics()
+    db = Database(":memory:", metrics=metrics)
+    await db.init_db()
+
+    # Act
+    user = await db.create_user("Fox Mulder", "TRUSTNO1")
+    await db.get_user_by_id(user.id)
+    await db.get_referrals_by_source_id(user.id)
+    await db.close()
+
+    # Assert
+    text = metrics.render()
+    assert 'carton_caps_write_duration_seconds_count{write="create_user"} 1' in text
+    assert 'carton_caps_query_duration_seconds_count{query="get_user_by_id"} 1' in text
+    assert 'carton_caps_query_rows_sum{query="get_referrals_by_source_id"} 0' in text
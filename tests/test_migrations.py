@@ -0,0 +1,268 @@
+import sqlite3
+from datetime import UTC, datetime
+
+import pytest
+
+from carton_caps.database import (
+    _CONFIRM_REFERRAL_SQL,
+    _REFERRALS_BY_SOURCE_SQL,
+    _SIGNAL_IN_TREE_SQL,
+    ReferralFilter,
+    _referral_listing_params,
+    _referral_listing_sql,
+)
+from carton_caps.migrations import MIGRATIONS, SCHEMA_VERSION, get_schema_version, migrate
+
+
+@pytest.fixture
+def conn():
+    """Pytest fixture providing an empty in-memory database."""
+    conn = sqlite3.connect(":memory:")
+    yield conn
+    conn.close()
+
+
+def _query_plan(conn: sqlite3.Connection, sql: str, parameters: tuple) -> list[str]:
+    """Returns the details of each step of a query's plan."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+
+
+def test_migrate_empty_database(conn: sqlite3.Connection):
+    """Tests that an empty database is brought up to the current schema version."""
+    # Act
+    applied = migrate(conn)
+
+    # Assert
+    assert applied == list(range(1, SCHEMA_VERSION + 1))
+    assert get_schema_version(conn) == SCHEMA_VERSION
+
+
+def test_migrate_is_idempotent(conn: sqlite3.Connection):
+    """Tests that migrating a current database does nothing."""
+    # Arrange
+    migrate(conn)
+
+    # Act
+    applied = migrate(conn)
+
+    # Assert
+    assert applied == []
+    assert get_schema_version(conn) == SCHEMA_VERSION
+
+
+def test_migrate_preserves_existing_data(conn: sqlite3.Connection):
+    """Tests that a database created before migrations existed is upgraded without losing data."""
+    # Arrange
+    conn.executescript(
+        """
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY,
+            name TEXT(256) NOT NULL UNIQUE,
+            referral_code TEXT(16) NOT NULL UNIQUE
+        );
+        CREATE TABLE referrals (
+            id INTEGER PRIMARY KEY,
+            source_user_id INTEGER NOT NULL,
+            target_user_id INTEGER NOT NULL UNIQUE,
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL
+        );
+        INSERT INTO users (name, referral_code) VALUES ('Fox Mulder', 'TRUSTNO1'), ('Dana Scully', 'SCULLYMD');
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (1, 2, '2025-08-10T20:03:00.123456+00:00', 'pending');
+        """
+    )
+
+    # Act
+    migrate(conn)
+
+    # Assert
+    assert get_schema_version(conn) == SCHEMA_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM referrals").fetchone()[0] == 1
+
+
+def test_migrate_rejects_newer_database(conn: sqlite3.Connection):
+    """Tests that a database from a newer version of the app is left alone."""
+    # Arrange
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+
+    # Act / Assert
+    with pytest.raises(RuntimeError):
+        migrate(conn)
+
+
+def test_referral_listing_uses_covering_index(conn: sqlite3.Connection):
+    """Tests that the referral listing is answered from the covering index, with no scan or sort."""
+    # Arrange
+    migrate(conn)
+
+    # Act
+    plan = _query_plan(conn, _REFERRALS_BY_SOURCE_SQL, {"source_id": 1, "after": 0, "limit": -1})
+
+    # Assert
+    assert "SEARCH r USING COVERING INDEX referrals_source_user_id (source_user_id=? AND id>?)" in plan
+    assert not any(step.startswith("SCAN") for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_filtered_referral_listing_uses_status_index(conn: sqlite3.Connection, descending: bool):
+    """Tests that a listing filtered by status and time is read from the status index in order, with no sort."""
+    # Arrange
+    migrate(conn)
+    filter = ReferralFilter(
+        status="held", since=datetime(2025, 1, 1, tzinfo=UTC), until=datetime(2026, 1, 1, tzinfo=UTC)
+    )
+
+    # Act
+    plan = _query_plan(
+        conn,
+        _referral_listing_sql(filter, after=5, descending=descending),
+        _referral_listing_params(1, 5, 10, filter, descending),
+    )
+
+    # Assert
+    assert (
+        "SEARCH r USING INDEX referrals_source_user_id_status_created_at"
+        " (source_user_id=? AND status=? AND created_at>? AND created_at<?)"
+    ) in plan
+    assert not any(step.startswith("SCAN") for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_migrate_backfills_referral_paths(conn: sqlite3.Connection):
+    """Tests that the closure table is built from referrals that existed before it."""
+    # Arrange
+    conn.executescript("".join(MIGRATIONS[:4]) + "PRAGMA user_version = 4;")
+    conn.executescript(
+        """
+        INSERT INTO users (name, referral_code) VALUES ('A', 'A'), ('B', 'B'), ('C', 'C');
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (1, 2, '2025-08-10T20:03:00.123456+00:00', 'pending'), (2, 3, '2025-08-10T20:03:00.123456+00:00', 'pending');
+        """
+    )
+
+    # Act
+    migrate(conn)
+
+    # Assert
+    paths = conn.execute("SELECT ancestor_id, descendant_id, depth FROM referral_paths ORDER BY 1, 2").fetchall()
+    assert paths == [(1, 2, 1), (1, 3, 2), (2, 3, 1)]
+
+
+def test_downline_uses_closure_table_primary_key(conn: sqlite3.Connection):
+    """Tests that a depth limited downline is a range scan of the closure table, with no sort."""
+    # Arrange
+    migrate(conn)
+
+    # Act
+    plan = _query_plan(
+        conn,
+        """
+        SELECT descendant_id FROM referral_paths
+        WHERE ancestor_id = ? AND depth <= ? AND (depth, descendant_id) > (?, ?)
+        ORDER BY depth, descendant_id
+        """,
+        (1, 3, 0, 0),
+    )
+
+    # Assert
+    assert any(step.startswith("SEARCH referral_paths USING PRIMARY KEY (ancestor_id=?") for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_signal_lookup_uses_indexes(conn: sqlite3.Connection):
+    """Tests that checking a signal against a referrer's tree never scans a table or a downline."""
+    # Arrange
+    migrate(conn)
+
+    # Act
+    plan = _query_plan(conn, _SIGNAL_IN_TREE_SQL, {"kind": "ip", "value": b"", "referrer": 1, "limit": 1000})
+
+    # Assert
+    assert "SEARCH signup_signals USING PRIMARY KEY (kind=? AND value=?)" in plan
+    paths = [step for step in plan if "referral_paths" in step]
+    assert len(paths) == 2
+    assert all("referral_paths_descendant_id (descendant_id=?)" in step for step in paths)
+    assert not any(step.startswith("SCAN") and step != "SCAN holders" and "CONSTANT" not in step for step in plan)
+
+
+def test_confirm_referral_uses_target_user_id_index(conn: sqlite3.Connection):
+    """Tests that confirming a referred user's referral looks it up by the unique index on target_user_id."""
+    # Arrange
+    migrate(conn)
+
+    # Act
+    plan = _query_plan(conn, _CONFIRM_REFERRAL_SQL, (1,))
+
+    # Assert
+    assert "SEARCH referrals USING INDEX sqlite_autoindex_referrals_1 (target_user_id=?)" in plan
+
+
+def test_migrate_backfills_referral_counts(conn: sqlite3.Connection):
+    """Tests that the referral counts are built from referrals that existed before them."""
+    # Arrange
+    conn.executescript("".join(MIGRATIONS[:5]) + "PRAGMA user_version = 5;")
+    conn.executescript(
+        """
+        INSERT INTO users (name, referral_code) VALUES ('A', 'A'), ('B', 'B'), ('C', 'C');
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (1, 2, '2025-08-10T20:03:00.123456+00:00', 'pending'), (1, 3, '2025-08-10T20:03:00.123456+00:00', 'confirmed');
+        """
+    )
+
+    # Act
+    migrate(conn)
+
+    # Assert
+    counts = conn.execute(
+        """
+        SELECT c.user_id, s.name, c.count
+        FROM referral_counts c
+        JOIN referral_statuses s ON s.code = c.status
+        ORDER BY 1, 2
+        """
+    ).fetchall()
+    assert counts == [(1, "confirmed", 1), (1, "pending", 1)]
+
+
+def test_migrate_compacts_referrals(conn: sqlite3.Connection):
+    """Tests that stored ISO 8601 times become exact microseconds, and statuses become their codes."""
+    # Arrange
+    conn.executescript("".join(MIGRATIONS[:7]) + "PRAGMA user_version = 7;")
+    conn.executescript(
+        """
+        INSERT INTO users (name, referral_code) VALUES ('A', 'A'), ('B', 'B'), ('C', 'C');
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (1, 2, '2025-08-10T20:03:00.123456+00:00', 'held'), (1, 3, '2025-08-10T22:03:00+02:00', 'confirmed');
+        """
+    )
+
+    # Act
+    migrate(conn)
+
+    # Assert
+    rows = conn.execute("SELECT target_user_id, created_at, status FROM referrals ORDER BY id").fetchall()
+    assert rows == [(2, 1754856180123456, 2), (3, 1754856180000000, 1)]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("UPDATE referrals SET status = 'pending' WHERE id = 1")
+
+
+def test_migrate_rejects_unknown_status(conn: sqlite3.Connection):
+    """Tests that a referral with a status that has no code fails the migration, leaving the database as it was."""
+    # Arrange
+    conn.executescript("".join(MIGRATIONS[:7]) + "PRAGMA user_version = 7;")
+    conn.executescript(
+        """
+        INSERT INTO users (name, referral_code) VALUES ('A', 'A'), ('B', 'B');
+        INSERT INTO referrals (source_user_id, target_user_id, created_at, status)
+        VALUES (1, 2, '2025-08-10T20:03:00+00:00', 'lapsed');
+        """
+    )
+
+    # Act / Assert
+    with pytest.raises(sqlite3.IntegrityError):
+        migrate(conn)
+    assert get_schema_version(conn) == 7
+    assert conn.execute("SELECT status FROM referrals").fetchone()[0] == "lapsed"
@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+
+from carton_caps.pool import ConnectionPool, PoolTimeoutError
+
+
+@pytest.mark.asyncio
+async def test_open_creates_min_size_connections(db_path: str):
+    """Tests that opening the pool eagerly creates the minimum number of connections."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=2, max_size=4)
+
+    # Act
+    await pool.open()
+    stats = pool.stats()
+    await pool.close()
+
+    # Assert
+    assert stats.size == 2
+    assert stats.idle == 2
+    assert stats.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_released_connection_is_reused(db_path: str):
+    """Tests that a released connection is handed out again rather than reopened."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=2)
+    await pool.open()
+
+    # Act
+    first = await pool.acquire()
+    await pool.release(first)
+    second = await pool.acquire()
+    await pool.release(second)
+    stats = pool.stats()
+    await pool.close()
+
+    # Assert
+    assert first is second
+    assert stats.size == 1
+    assert stats.acquired == 2
+
+
+@pytest.mark.asyncio
+async def test_acquire_times_out_when_exhausted(db_path: str):
+    """Tests that acquiring from an exhausted pool raises after the timeout."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=1, acquire_timeout=0.05)
+    conn = await pool.acquire()
+
+    # Act / Assert
+    with pytest.raises(PoolTimeoutError):
+        await pool.acquire()
+
+    await pool.release(conn)
+    await pool.close()
+    assert pool.stats().timeouts == 1
+
+
+@pytest.mark.asyncio
+async def test_waiter_is_handed_released_connection(db_path: str):
+    """Tests that a waiting request gets the connection once it is released, and the wait is recorded."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=1)
+    conn = await pool.acquire()
+    waiter = asyncio.create_task(pool.acquire())
+    await asyncio.sleep(0.01)
+
+    # Act
+    await pool.release(conn)
+    leased = await waiter
+    await pool.release(leased)
+    stats = pool.stats()
+    await pool.close()
+
+    # Assert
+    assert leased is conn
+    assert stats.waits == 1
+    assert stats.wait_time > 0
+    assert stats.max_wait_time <= stats.wait_time
+
+
+@pytest.mark.asyncio
+async def test_unhealthy_connection_is_replaced(db_path: str):
+    """Tests that an idle connection which fails its health check is discarded."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=1, health_check_interval=0)
+    broken = await pool.acquire()
+    await pool.release(broken)
+    await broken.close()
+
+    # Act
+    conn = await pool.acquire()
+    async with conn.execute("SELECT 1") as cursor:
+        row = await cursor.fetchone()
+    await pool.release(conn)
+    stats = pool.stats()
+    await pool.close()
+
+    # Assert
+    assert conn is not broken
+    assert row is not None
+    assert stats.health_check_failures == 1
+    assert stats.size == 1
+
+
+@pytest.mark.asyncio
+async def test_release_rolls_back_open_transaction(db_path: str):
+    """Tests that a connection returned mid-transaction is rolled back before reuse."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=1)
+    conn = await pool.acquire()
+    await conn.execute("CREATE TABLE t (x INTEGER)")
+    await conn.commit()
+    await conn.execute("INSERT INTO t (x) VALUES (1)")
+
+    # Act
+    await pool.release(conn)
+    conn = await pool.acquire()
+    async with conn.execute("SELECT COUNT(*) FROM t") as cursor:
+        row = await cursor.fetchone()
+    await pool.release(conn)
+    await pool.close()
+
+    # Assert
+    assert row is not None
+    assert row[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_close_drains_connections(db_path: str):
+    """Tests that closing the pool closes idle connections and those released afterwards."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=1, max_size=2)
+    await pool.open()
+    leased = await pool.acquire()
+    second = await pool.acquire()
+    await pool.release(second)
+
+    # Act
+    await pool.close()
+    await pool.release(leased)
+
+    # Assert
+    assert pool.stats().size == 0
+    with pytest.raises(RuntimeError):
+        await pool.acquire()
+
+
+@pytest.mark.asyncio
+async def test_connections_have_pragmas_applied(db_path: str):
+    """Tests that pooled connections are opened with the production pragmas."""
+    # Arrange
+    pool = ConnectionPool(db_path, min_size=0, max_size=1)
+
+    # Act
+    conn = await pool.acquire()
+    async with conn.execute("PRAGMA journal_mode") as cursor:
+        journal_mode = await cursor.fetchone()
+    async with conn.execute("PRAGMA synchronous") as cursor:
+        synchronous = await cursor.fetchone()
+    await pool.release(conn)
+    await pool.close()
+
+    # Assert
+    assert journal_mode is not None and journal_mode[0] == "wal"
+    assert synchronous is not None and synchronous[0] == 1
@@ -0,0 +1,192 @@
+import asyncio
+import io
+import json
+import os
+import time
+
+import pytest
+
+from carton_caps.database import Database
+from carton_caps.purchases import RecentIds, confirm_purchases, parse_event, read_line_chunks
+
+
+def _ndjson(events: list[dict]) -> io.StringIO:
+    return io.StringIO("".join(json.dumps(event) + "\n" for event in events))
+
+
+async def _create_referred_users(db: Database, count: int) -> tuple[int, list[int]]:
+    """Creates a user who referred `count` others, pending, and returns their id and the others' ids."""
+    source = await db.create_user("Fox Mulder", "TRUSTNO1")
+    targets = []
+    for i in range(count):
+        target = await db.create_user(f"Referred User {i}", f"CODE{i}")
+        await db.create_referral(source.id, target.id, "pending")
+        targets.append(target.id)
+    return source.id, targets
+
+
+def test_parse_event():
+    """Tests reading a purchase event, with and without when it occurred."""
+    # Act
+    event = parse_event({"event_id": "evt_1", "user_id": 42, "occurred_at": "2025-08-10T20:03:00+00:00"})
+    undated = parse_event({"event_id": "evt_2", "user_id": 42})
+
+    # Assert
+    assert event.event_id == "evt_1"
+    assert event.user_id == 42
+    assert event.occurred_at == 1754856180.0
+    assert undated.occurred_at is None
+
+
+def test_parse_event_naive_time_is_utc(monkeypatch):
+    """Tests that a purchase time without a timezone is read as UTC, not in the server's timezone."""
+    # Arrange
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+
+    # Act
+    try:
+        event = parse_event({"event_id": "evt_1", "user_id": 42, "occurred_at": "2025-08-10T20:03:00"})
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    # Assert
+    assert event.occurred_at == 1754856180.0
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        [],
+        {"user_id": 42},
+        {"event_id": "", "user_id": 42},
+        {"event_id": "evt_1", "user_id": "42"},
+        {"event_id": "evt_1", "user_id": True},
+        {"event_id": "evt_1", "user_id": 42, "occurred_at": "yesterday"},
+    ],
+)
+def test_parse_event_rejects_invalid(record):
+    """Tests that anything but a well formed purchase event is rejected with a ValueError."""
+    # Act / Assert
+    with pytest.raises(ValueError):
+        parse_event(record)
+
+
+def test_recent_ids_forgets_oldest():
+    """Tests that only the most recently seen ids are remembered."""
+    # Arrange
+    recent = RecentIds(max_size=2)
+
+    # Act / Assert
+    assert recent.add("a")
+    assert recent.add("b")
+    assert not recent.add("a")
+    assert recent.add("c")
+    assert recent.add("b")
+    assert not recent.add("c")
+
+
+@pytest.mark.asyncio
+async def test_read_line_chunks_by_size():
+    """Tests that lines are handed over in full chunks, then whatever is left."""
+    # Arrange
+    stream = io.StringIO("".join(f"{i}\n" for i in range(7)))
+
+    # Act
+    chunks = [chunk async for chunk in read_line_chunks(stream, chunk_size=3, max_latency=5.0)]
+
+    # Assert
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+
+
+@pytest.mark.asyncio
+async def test_read_line_chunks_from_pipe():
+    """Tests that a chunk from a slow pipe is handed over once its latency is up, rather than when it fills."""
+    # Arrange
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "r", encoding="utf-8")
+    os.write(write_fd, b'{"event_id":"caf\xc3\xa9"}\n{"event_id":')
+    chunks = read_line_chunks(reader, chunk_size=100, max_latency=0.05)
+
+    # Act
+    started = time.monotonic()
+    first = await asyncio.wait_for(anext(chunks), 5.0)
+    waited = time.monotonic() - started
+    os.write(write_fd, b'"b"}')
+    os.close(write_fd)
+    rest = [chunk async for chunk in chunks]
+    reader.close()
+
+    # Assert
+    assert first == ['{"event_id":"café"}']
+    assert waited < 5.0
+    assert rest == [['{"event_id":"b"}']]
+
+
+@pytest.mark.asyncio
+async def test_confirm_purchases_raises_on_invalid_utf8(db: Database):
+    """Tests that a stream that isn't UTF-8 raises an error, rather than being taken to have ended."""
+    # Arrange
+    _, targets = await _create_referred_users(db, 1)
+    stream = io.TextIOWrapper(io.BytesIO(f'{{"event_id":"evt_1","user_id":{targets[0]}}}\n\xff\n'.encode("latin-1")))
+
+    # Act / Assert
+    with pytest.raises(UnicodeDecodeError):
+        await confirm_purchases(db, stream, report=lambda message: None)
+
+
+@pytest.mark.asyncio
+async def test_confirm_purchases(db: Database):
+    """Tests confirming referrals from purchase events, skipping duplicates and invalid lines."""
+    # Arrange
+    source_id, targets = await _create_referred_users(db, 3)
+    stream = io.StringIO(
+        "\n".join(
+            [
+                json.dumps({"event_id": "evt_1", "user_id": targets[0], "occurred_at": "2025-08-10T20:03:00+00:00"}),
+                json.dumps({"event_id": "evt_1", "user_id": targets[0]}),
+                json.dumps({"event_id": "evt_2", "user_id": targets[0]}),
+                "not json",
+                "",
+                json.dumps({"event_id": "evt_3", "user_id": targets[1]}),
+                json.dumps({"event_id": "evt_4", "user_id": 999}),
+            ]
+        )
+    )
+    reports = []
+
+    # Act
+    result = await confirm_purchases(db, stream, report=reports.append)
+
+    # Assert
+    assert result.read == 6
+    assert result.duplicates == 2
+    assert result.invalid == 1
+    assert result.confirmed == 2
+    assert result.max_lag is not None and result.max_lag > 0
+    assert any(report.startswith("Skipping line 4:") for report in reports)
+    statuses = {referral.user.id: referral.status for referral in await db.get_referrals_by_source_id(source_id)}
+    assert statuses == {targets[0]: "confirmed", targets[1]: "confirmed", targets[2]: "pending"}
+
+
+@pytest.mark.asyncio
+async def test_confirm_purchases_in_chunks_is_idempotent(db: Database):
+    """Tests that events are applied a chunk at a time, and that replaying them confirms nothing more."""
+    # Arrange
+    source_id, targets = await _create_referred_users(db, 10)
+    events = [{"event_id": f"evt_{i}", "user_id": user_id} for i, user_id in enumerate(targets)]
+    reports = []
+
+    # Act
+    first = await confirm_purchases(db, _ndjson(events), chunk_size=4, report=reports.append)
+    replay = await confirm_purchases(db, _ndjson(events), chunk_size=4, report=lambda message: None)
+
+    # Assert
+    assert first.confirmed == 10
+    assert len(reports) == 3
+    assert replay.confirmed == 0
+    assert replay.duplicates == 0
+    stats = await db.get_referral_stats(source_id)
+    assert stats is not None
+    assert stats.counts == {"confirmed": 10}
@@ -0,0 +1,106 @@
+import pytest
+
+from carton_caps.ratelimit import RateLimiter, retry_after_header
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the limiter's clock with one that only moves when told to."""
+
+    class Clock:
+        now = 1000.0
+
+        def advance(self, seconds: float) -> None:
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr("carton_caps.ratelimit.time.monotonic", lambda: clock.now)
+    return clock
+
+
+def test_allows_a_burst_up_to_the_limit(clock):
+    """Tests that a key may make as many requests as its limit at once, and no more."""
+    # Arrange
+    limiter = RateLimiter({"signup": (3, 60.0)})
+
+    # Act
+    results = [limiter.acquire("signup", "10.0.0.1") for _ in range(4)]
+
+    # Assert
+    assert results[:3] == [0.0, 0.0, 0.0]
+    assert results[3] == pytest.approx(20.0)
+    stats = limiter.stats()
+    assert (stats.allowed, stats.rejected) == (3, 1)
+
+
+def test_tokens_refill_over_the_period(clock):
+    """Tests that a rejected key is allowed again once a token has refilled."""
+    # Arrange
+    limiter = RateLimiter({"signup": (3, 60.0)})
+    for _ in range(3):
+        limiter.acquire("signup", "10.0.0.1")
+
+    # Act
+    clock.advance(19.0)
+    too_soon = limiter.acquire("signup", "10.0.0.1")
+    clock.advance(1.0)
+    refilled = limiter.acquire("signup", "10.0.0.1")
+
+    # Assert
+    assert too_soon == pytest.approx(1.0)
+    assert refilled == 0.0
+
+
+def test_keys_and_rules_are_limited_separately(clock):
+    """Tests that one key using up its limit doesn't affect other keys, or the same key under other rules."""
+    # Arrange
+    limiter = RateLimiter({"signup": (1, 60.0), "lookup": (1, 60.0)})
+    limiter.acquire("signup", "10.0.0.1")
+
+    # Act & Assert
+    assert limiter.acquire("signup", "10.0.0.1") > 0
+    assert limiter.acquire("signup", "10.0.0.2") == 0.0
+    assert limiter.acquire("lookup", "10.0.0.1") == 0.0
+    assert limiter.acquire("unconfigured", "10.0.0.1") == 0.0
+
+
+def test_idle_keys_are_swept(clock):
+    """Tests that keys whose buckets have refilled are dropped as other keys are checked."""
+    # Arrange
+    limiter = RateLimiter({"lookup": (10, 1.0)}, shards=1)
+    for i in range(5):
+        limiter.acquire("lookup", i)
+
+    # Act
+    clock.advance(1.0)
+    for i in range(5, 8):
+        limiter.acquire("lookup", i)
+
+    # Assert
+    stats = limiter.stats()
+    assert stats.keys == 3
+    assert stats.evictions == 0
+
+
+def test_least_recently_checked_key_is_evicted_when_full(clock):
+    """Tests that the number of keys is bounded, evicting the key checked longest ago."""
+    # Arrange
+    limiter = RateLimiter({"signup": (1, 60.0)}, max_keys=2, shards=1)
+    limiter.acquire("signup", "a")
+    limiter.acquire("signup", "b")
+
+    # Act
+    limiter.acquire("signup", "c")
+
+    # Assert
+    assert limiter.stats().keys == 2
+    assert limiter.stats().evictions == 1
+    assert limiter.acquire("signup", "a") == 0.0
+    assert limiter.acquire("signup", "c") > 0
+
+
+@pytest.mark.parametrize("seconds, header", [(0.2, "1"), (1.0, "1"), (20.5, "21")])
+def test_retry_after_header(seconds, header):
+    """Tests that waits are rounded up to whole seconds."""
+    # Act & Assert
+    assert retry_after_header(seconds) == header
@@ -0,0 +1,58 @@
+import dataclasses
+import json
+
+import pytest
+
+from carton_caps.database import Referral, ReferralUser
+from carton_caps.serialization import REPRESENTATIONS, dumps, packb, referral_to_dict
+
+
+@pytest.fixture
+def referral() -> Referral:
+    """Pytest fixture providing a referral to serialize."""
+    return Referral(
+        id=5,
+        user=ReferralUser(id=6, name="Eugene Victor Tooms", avatar_url="https://place-hold.it/64x64"),
+        status="confirmed",
+        created_at="2025-08-10T20:03:00.123456+00:00",
+    )
+
+
+def test_referral_to_dict_matches_asdict(referral: Referral):
+    """Tests that the fast conversion produces exactly what dataclasses.asdict does."""
+    # Act
+    result = referral_to_dict(referral)
+
+    # Assert
+    assert result == dataclasses.asdict(referral)
+
+
+def test_dumps_is_compact_utf8():
+    """Tests that dumps produces compact, UTF-8 encoded JSON, whichever encoder is installed."""
+    # Act
+    result = dumps([{"name": "Dana Scully", "code": "SCULLYMD", "note": "café"}])
+
+    # Assert
+    assert result == '[{"name":"Dana Scully","code":"SCULLYMD","note":"café"}]'.encode()
+    assert json.loads(result)[0]["note"] == "café"
+
+
+def test_packb_round_trips(referral: Referral):
+    """Tests that a referral encoded as MessagePack decodes to the same data as its JSON."""
+    # Arrange
+    msgpack = pytest.importorskip("msgpack")
+    data = referral_to_dict(referral)
+
+    # Act
+    result = packb(data)
+
+    # Assert
+    assert msgpack.unpackb(result) == json.loads(dumps(data))
+    assert REPRESENTATIONS["application/msgpack"] is packb
+
+
+def test_referrals_are_immutable(referral: Referral):
+    """Tests that referrals can't be modified, since cached instances are shared between requests."""
+    # Act / Assert
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        referral.status = "pending"  # pyright: ignore[reportAttributeAccessIssue]
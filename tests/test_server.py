@@ -0,0 +1,29 @@
+from carton_caps.server import server_config, uvloop_available
+
+
+def test_server_config():
+    """Tests that the server options are carried over to Hypercorn's configuration."""
+    # Act
+    config = server_config(
+        "carton_caps.app:create_app()", host="127.0.0.1", port=8000, workers=4, keep_alive=10.0, graceful_timeout=20.0
+    )
+
+    # Assert
+    assert config.bind == ["127.0.0.1:8000"]
+    assert config.workers == 4
+    assert config.keep_alive_timeout == 10.0
+    assert config.graceful_timeout == 20.0
+    assert config.application_path == "carton_caps.app:create_app()"
+    assert config.accesslog is None
+    assert config.ssl_enabled is False
+
+
+def test_server_config_uses_uvloop_when_available():
+    """Tests that uvloop is used if it is installed, unless it is turned off."""
+    # Act
+    default = server_config("carton_caps.app:create_app()")
+    without = server_config("carton_caps.app:create_app()", use_uvloop=False)
+
+    # Assert
+    assert default.worker_class == ("uvloop" if uvloop_available() else "asyncio")
+    assert without.worker_class == "asyncio"
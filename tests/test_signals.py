@@ -0,0 +1,49 @@
+import pytest
+
+from carton_caps.signals import SignupSignals, ip_prefix, normalize_email, signal_hash
+
+
+@pytest.mark.parametrize(
+    "email, normalized",
+    [
+        ("Fox.Mulder+2@Gmail.com", "foxmulder@gmail.com"),
+        ("fox.mulder@googlemail.com", "foxmulder@gmail.com"),
+        ("  dana.scully+fbi@fbi.gov ", "dana.scully@fbi.gov"),
+        ("not an email", None),
+        ("@fbi.gov", None),
+    ],
+)
+def test_normalize_email(email, normalized):
+    """Tests that addresses delivering to the same mailbox normalize to the same string."""
+    # Act & Assert
+    assert normalize_email(email) == normalized
+
+
+@pytest.mark.parametrize(
+    "address, prefix",
+    [
+        ("203.0.113.42", "203.0.113.0/24"),
+        ("2001:db8:1:2:3:4:5:6", "2001:db8:1:2::/64"),
+        ("unknown", None),
+    ],
+)
+def test_ip_prefix(address, prefix):
+    """Tests that addresses are reduced to the network they belong to."""
+    # Act & Assert
+    assert ip_prefix(address) == prefix
+
+
+def test_hashed_normalizes_and_skips_missing_signals():
+    """Tests that only the signals present are hashed, after being normalized."""
+    # Arrange
+    signals = SignupSignals(ip_address="203.0.113.42", email="Fox.Mulder+2@gmail.com")
+
+    # Act
+    hashed = signals.hashed()
+
+    # Assert
+    assert hashed == [
+        ("ip", signal_hash("ip", "203.0.113.0/24")),
+        ("email", signal_hash("email", "foxmulder@gmail.com")),
+    ]
+    assert all(len(value) == 16 for _, value in hashed)
@@ -0,0 +1,34 @@
+import os
+import sqlite3
+
+import pytest
+
+from carton_caps.database import Database
+from carton_caps.migrations import SCHEMA_VERSION, get_schema_version
+from carton_caps.snapshot import create_snapshot, restore_snapshot
+
+
+@pytest.mark.asyncio
+async def test_snapshot_round_trip(directory: str):
+    """Tests that a database restored from a snapshot holds the same data and schema as the original."""
+    # Arrange
+    original_path = os.path.join(directory, "original.sqlite")
+    snapshot_path = os.path.join(directory, "snapshot.sqlite")
+    restored_path = os.path.join(directory, "restored.sqlite")
+    original = Database(original_path)
+    await original.init_db()
+    await original.seed_db()
+
+    # Act
+    create_snapshot(original_path, snapshot_path)
+    await original.close()
+    restore_snapshot(snapshot_path, restored_path)
+
+    # Assert
+    assert not os.path.exists(snapshot_path + "-wal")
+    assert not os.path.exists(snapshot_path + ".partial")
+    with sqlite3.connect(restored_path) as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 8
+        assert conn.execute("SELECT COUNT(*) FROM referral_paths").fetchone()[0] > 0
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
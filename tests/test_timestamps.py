@@ -0,0 +1,51 @@
+import sqlite3
+from datetime import UTC, datetime, timedelta, timezone
+
+import pytest
+
+from carton_caps.timestamps import iso_sql, to_iso, to_microseconds
+
+
+@pytest.mark.parametrize(
+    "iso",
+    [
+        "2025-08-10T20:03:00.123456+00:00",
+        "2025-08-10T20:03:00.000001+00:00",
+        "2013-09-13T00:00:00+00:00",
+        "1970-01-01T00:00:00+00:00",
+    ],
+)
+def test_round_trip(iso):
+    """Tests that timestamps written by isoformat() are stored exactly, and read back as the same string."""
+    # Act
+    microseconds = to_microseconds(iso)
+
+    # Assert
+    assert to_iso(microseconds) == iso
+    assert microseconds == (datetime.fromisoformat(iso) - datetime(1970, 1, 1, tzinfo=UTC)) // timedelta(microseconds=1)
+
+
+def test_to_microseconds_normalizes_timezones():
+    """Tests that times in other timezones are converted to UTC, and that times without one are taken to be UTC."""
+    # Act / Assert
+    assert to_microseconds("2025-08-10T22:03:00+02:00") == to_microseconds("2025-08-10T20:03:00+00:00")
+    assert to_microseconds("2025-08-10T20:03:00") == to_microseconds("2025-08-10T20:03:00+00:00")
+    assert to_microseconds(datetime(2025, 8, 10, 20, 3, tzinfo=timezone(timedelta(hours=-4)))) == to_microseconds(
+        "2025-08-11T00:03:00+00:00"
+    )
+    with pytest.raises(ValueError):
+        to_microseconds("yesterday")
+
+
+def test_iso_sql_matches_to_iso():
+    """Tests that the SQL rendering of a timestamp is the same string as the Python one."""
+    # Arrange
+    conn = sqlite3.connect(":memory:")
+    values = [0, 1, 999_999, 1_000_000, 1_754_856_180_123_456, 1_754_856_180_000_000]
+
+    # Act
+    rendered = [conn.execute(f"SELECT {iso_sql('?1')}", (value,)).fetchone()[0] for value in values]
+    conn.close()
+
+    # Assert
+    assert rendered == [to_iso(value) for value in values]
@@ -0,0 +1,108 @@
+import asyncio
+import sqlite3
+
+import pytest
+import pytest_asyncio
+
+from carton_caps.database import Database
+from carton_caps.writer import Writer
+
+
+@pytest_asyncio.fixture
+async def writer(db_path: str):
+    """Pytest fixture providing a running writer."""
+    writer = Writer(db_path, max_latency=0.01)
+    await writer.start()
+    yield writer
+    await writer.stop()
+
+
+def _insert(name: str):
+    def job(conn: sqlite3.Connection) -> int:
+        return conn.execute(
+            "INSERT INTO users (name, referral_code) VALUES (?, ?) RETURNING id", (name, name)
+        ).fetchall()[0][0]
+
+    return job
+
+
+@pytest.mark.asyncio
+async def test_concurrent_jobs_are_group_committed(writer: Writer):
+    """Tests that jobs submitted together are applied in a single batch."""
+    # Act
+    ids = await asyncio.gather(*(writer.submit(_insert(f"User {i}")) for i in range(10)))
+    stats = writer.stats()
+
+    # Assert
+    assert sorted(ids) == list(range(1, 11))
+    assert stats.jobs == 10
+    assert stats.batches < 10
+    assert stats.largest_batch > 1
+
+
+@pytest.mark.asyncio
+async def test_failed_job_does_not_affect_batch(writer: Writer, db_path: str):
+    """Tests that a job that fails is rolled back on its own while the rest of its batch commits."""
+    # Act
+    results = await asyncio.gather(
+        writer.submit(_insert("Fox Mulder")),
+        writer.submit(_insert("Fox Mulder")),
+        writer.submit(_insert("Dana Scully")),
+        return_exceptions=True,
+    )
+
+    # Assert
+    assert isinstance(results[1], sqlite3.IntegrityError)
+    with sqlite3.connect(db_path) as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM users")}
+    assert names == {"Fox Mulder", "Dana Scully"}
+
+
+@pytest.mark.asyncio
+async def test_writer_enables_wal(writer: Writer, db_path: str):
+    """Tests that the writer switches the database to WAL mode so readers aren't blocked."""
+    # Act
+    with sqlite3.connect(db_path) as conn:
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+    # Assert
+    assert mode == "wal"
+
+
+@pytest.mark.asyncio
+async def test_stop_applies_queued_jobs(db_path: str):
+    """Tests that stopping the writer commits jobs that were already queued."""
+    # Arrange
+    writer = Writer(db_path)
+    await writer.start()
+    pending = [asyncio.create_task(writer.submit(_insert(f"User {i}"))) for i in range(5)]
+    await asyncio.sleep(0)
+
+    # Act
+    await writer.stop()
+
+    # Assert
+    assert all(task.done() and not task.exception() for task in pending)
+    with pytest.raises(RuntimeError):
+        await writer.submit(_insert("Too Late"))
+
+
+@pytest.mark.asyncio
+async def test_database_writes_go_through_writer(writer: Writer, db_path: str):
+    """Tests that a Database given a writer hands its writes to it, and reads see them."""
+    # Arrange
+    db = Database(db_path, writer=writer)
+
+    # Act
+    mulder, scully = await asyncio.gather(
+        db.create_user("Fox Mulder", "TRUSTNO1"),
+        db.create_user("Dana Scully", "SCULLYMD"),
+    )
+    referral = await db.create_referral(mulder.id, scully.id, "pending")
+    referrals = await db.get_referrals_by_source_id(mulder.id)
+    await db.close()
+
+    # Assert
+    assert writer.stats().jobs == 3
+    assert referral.user.name == "Dana Scully"
+    assert [r.id for r in referrals] == [referral.id]